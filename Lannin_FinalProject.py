@@ -15,22 +15,22 @@ Description:
 
 
 import streamlit as st
-import pandas as pd
-import statistics as stats
 import pydeck as pdk
-import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import seaborn as sns
-from datetime import datetime, time
 import numpy as np
-import wikipedia
 import xlrd
 
-st.set_page_config(
-     page_title='Craigslist Cars',
-     layout="wide",
-     initial_sidebar_state="expanded",
-)
+import aggregates
+import charts
+import comparables
+import core
+import datastore
+import filters
+import mapping
+import sqlbackend
+import tracing
+import wikicache
 
 import base64
 
@@ -40,90 +40,236 @@ main_bg_ext = "jpg"
 side_bg = "pexels-kelly-lacy-2402235_2.jpg"
 side_bg_ext = "jpg"
 
-st.markdown(
-    f"""
-    <style>
-    .reportview-container {{
-        background: url(data:image/{main_bg_ext};base64,{base64.b64encode(open(main_bg, "rb").read()).decode()})
-    }}
-   .sidebar .sidebar-content {{
-        background-color:  #011839}})
-    }}
-    </style>
-    """,
-    unsafe_allow_html=True
-)
 
-@st.cache #to avoid re-running the data collected
+# page settings and background, has to run before anything else is put on the page
 
+def setup_page():
 
+    st.set_page_config(
+         page_title='Craigslist Cars',
+         layout="wide",
+         initial_sidebar_state="expanded",
+    )
+
+    st.markdown(
+        f"""
+        <style>
+        .reportview-container {{
+            background: url(data:image/{main_bg_ext};base64,{base64.b64encode(open(main_bg, "rb").read()).decode()})
+        }}
+       .sidebar .sidebar-content {{
+            background-color:  #011839}})
+        }}
+        </style>
+        """,
+        unsafe_allow_html=True
+    )
+
+
+filename = 'cl_used_cars_7000_sample.xls'
+
+#files of new or updated postings put here are upserted by VIN when the data is reloaded
+UPDATES_DIR = 'updates'
+
+#the data work itself (loading, filtering, stats, pie shares, box plot summaries, map
+#payloads) is in core.py, along with its settings (compact dtypes, box plot summaries, ...)
+#this file lays it out on the page and caches it per session where Streamlit has to
+
+#'pandas' holds the listings in memory, 'sql' keeps them in an embedded database (DuckDB when
+#installed, SQLite otherwise) and asks it for each selection, see sqlbackend.py
+QUERY_BACKEND = 'pandas'
+
+#shows a collapsible panel with where the rerun's time went, and exports the traces
+#in Chrome's trace format, see tracing.py
+DEBUG_PANEL = False
+
+
+#the dataset shared by all sessions of this server, loaded once per process instead of being
+#hashed and copied per session, see core.loadDataset
+#cleaned data is cached on disk as parquet, keyed by the file's hash and mtime
+
+def load_dataset():
+
+    return(core.loadDataset(filename))
+
+
+#this session's frame over the shared listings, its values are read-only
 def load_data():
 
-    filename = 'cl_used_cars_7000_sample.xls'
-    
-    df = pd.read_excel(filename)
-    
-    df.columns = ['Unnamed: 0', 'id', 'url', 'region', 'region_url', 'price', 'year',
-       'manufacturer', 'model', 'condition', 'cylinders', 'fuel', 'odometer',
-       'title_status', 'transmission', 'VIN', 'drive', 'size', 'category',
-       'paint_color', 'image_url', 'description', 'state', 'lat', 'lon',
-       'posting_date']
+    return(datastore.sessionFrame(load_dataset()))
 
 
-    df = df.dropna()
-    
-    df['region'] = df['region'].str.title()
-    
-    #dropping columns I don't want, OK to drop 'id' because VIN is a unique identifier
-    df = df.drop(columns = ['Unnamed: 0', 'url', 'region_url', 'description', 'image_url', 'id'])
+#identifies the loaded data, for keys of caches that depend on it
+def load_dataset_version():
 
-    
+    return(load_dataset()['version'])
 
-    df['state'] = df['state'].str.upper() 
-    
-    df.reset_index(inplace = True)
-    
-    df.drop(columns = ['index'], inplace = True)
-    
-    #add datetime component
-    df['posting_date'] = [df['posting_date'][n][0:len(df['posting_date'][n])-5] for n in range(len(df))]
-    df['DTstr'] = pd.Series(df['posting_date'], dtype='string')
-    
 
+#the structures below are derived from the dataset once per version and kept on its handle
 
-    df['date'] = [datetime.strptime(df.loc[n,'DTstr'], "%Y-%m-%dT%H:%M:%S") for n in range(len(df))]
-    
-     
-    return(df)
+#bitmap index over load_data's rows
+def load_filter_index():
 
-#This function helps the suer narrow down the possible options for each column
-#It retunrs a sorted list of possibilities
+    return(core.filterIndex(load_dataset()))
+
+
+#first and last row of every state and region in load_data's frame
+def load_partitions():
+
+    return(core.partitions(load_dataset()))
+
+
+#sorted values and counts of the filter columns per state
+def load_facets():
+
+    return(core.facets(load_dataset()))
+
+
+#map grid cells for every zoom level drawn aggregated
+def load_map_levels():
+
+    return(core.mapLevels(load_dataset()))
+
+
+#counts, sums and quantiles for every state, region and category
+def load_cube():
+
+    return(core.cube(load_dataset()))
+
+
+#names of the states with listings, for the wikipedia summaries
+def load_state_names():
+
+    return(core.stateNames(load_dataset()))
+
+
+#grid index over the listings' positions, for the radius search and the map's viewport
+def load_spatial_index():
+
+    return(core.spatialIndex(load_dataset()))
+
+
+#listings grouped by make and model, for the comparable listings of the data view
+def load_comparables():
+
+    return(core.comparablesIndex(load_dataset()))
+
+
+#the listings database of the sql backend, shared by all sessions
+@st.cache(allow_output_mutation = True)
+def load_database():
+
+    return(sqlbackend.openListings(filename))
+
+
+#map grid cells for every zoom level drawn aggregated, grouped by the sql backend
+@st.cache(allow_output_mutation = True)
+def load_sql_map_levels(version):
+
+    return(core.sqlMapLevels(load_database()))
+
+
+#reloads the data when the source file changed and upserts the delta files in UPDATES_DIR
+#that weren't applied yet
+
+def reload_data():
+
+    core.reloadData(filename, UPDATES_DIR, load_database() if QUERY_BACKEND == 'sql' else None)
+
+
+#rendered pie charts and box plots, shared by all sessions
+@st.cache(allow_output_mutation = True)
+def load_figure_cache():
+
+    return(charts.newCache())
+
+
+#worker processes drawing the charts, one pool for the whole server caps the concurrency
+@st.cache(allow_output_mutation = True)
+def load_render_pool():
+
+    return(charts.newRenderPool())
+
+
+#this session's recently filtered frames, kept across its reruns, see core.newFilterCache
+def load_filter_cache():
+
+    if 'filter_cache' not in st.session_state:
+        st.session_state['filter_cache'] = core.newFilterCache()
+
+    return(st.session_state['filter_cache'])
+
+
+#what each filter widget of this session was last set to, by its key
+#from 0.89 on Streamlit takes a widget whose label, options or default changed for a new one
+#even when it has a key, and the filter widgets' labels carry live counts; a widget starting
+#at the remembered value keeps what the user checked or picked
+def load_widget_memory():
+
+    if 'filter_widgets' not in st.session_state:
+        st.session_state['filter_widgets'] = {}
+
+    return(st.session_state['filter_widgets'])
+
+
+#region summaries shown under the region check boxes, with their number of sentences
+REGION_SUMMARIES = [('Western United States', 3), ('Midwestern United States', 4),
+                    ('Southeastern United States', 4), ('Northeastern United States', 2)]
+
+
+#the first page load waits this many seconds at most for the summaries to be fetched
+WIKI_WAIT = 5
+
+
+def wikiTitles(stateNames):
+
+    return([(name, 4) for name in stateNames] + REGION_SUMMARIES)
+
+
+#wikipedia summaries for every state and region, kept on disk and fetched concurrently on a
+#background thread, so reruns read them from the cache instead of the network
+@st.cache(allow_output_mutation = True)
+def load_wiki_cache(stateNames):
+
+    wiki = wikicache.newCache()
+
+    warming = wikicache.warmInBackground(wiki, wikiTitles(stateNames))
+    if warming is not None:
+        warming.join(WIKI_WAIT)
+
+    return(wiki)
+
+#bytes per column of the cleaned data with and without the compact dtypes
+@st.cache
+def load_memory_report():
+
+    return(core.memoryReport(filename))
 
-def getChoices(df, column):
-    col = df[column]
-    choices = col.drop_duplicates()
-        
-    return(sorted(list(choices)))
 
 ################################## CHECK BOXES ##################################
 
 # creates check boxes for one column of the dataframe 
 # returns a list of what the user has selected in the check boxes
 # this can later be used for filtering
+# choices come from the facet index and each box shows how many listings it would match,
+# e.g. "Gas (412)"; a box stays checked when its count changes, see load_widget_memory
 
-def createCheckboxes(df, column):
-    choices = getChoices(df, column)
+def createCheckboxes(column, choices, counts):
     
     chosen = []
+    memory = load_widget_memory()
     
     st.sidebar.subheader(column.title())
 
     
     for choice in choices:
-        choice = choice.title()
+        label = choice.title()
+        key = f'{column}:{label}'
 
-        if st.sidebar.checkbox(choice):
-            chosen.append(choice)
+        memory[key] = st.sidebar.checkbox(f'{label} ({counts[choice]})', value = memory.get(key, False), key = key)
+
+        if memory[key]:
+            chosen.append(label)
 
              
     return(chosen)
@@ -132,109 +278,120 @@ def createCheckboxes(df, column):
 # cycles through the columns for which we want check boxes
 # calls on a function that creates check boxes and returns a table of the items the user selected
 # creates a dictionary where the key is the column name and the values are the returned table
+# the counts of each column take the state and the boxes checked in the columns above it into
+# account, baseMask being the state's rows in the bitmap index
+# with the sql backend (db) the choices and counts are queried from the database instead
 
-def generateDictChoices(state_df, checkBoxColumns):
+@tracing.traced('generateDictChoices')
+def generateDictChoices(index, facets, state, checkBoxColumns, baseMask, db = None):
     
     selectionsDict = {}
+    applied = {}
     
     for field in checkBoxColumns:      
-        selectionsDict[field] = createCheckboxes(df = state_df, column=field)
+        choices, counts = core.checkBoxChoices(index, facets, state, field, baseMask, db, applied)
+
+        selectionsDict[field] = createCheckboxes(column = field, choices = choices, counts = counts)
+
+        if selectionsDict[field]:
+            baseMask, applied = core.narrowSelection(index, field, core.checkedValues(choices, selectionsDict[field]), baseMask, db, applied)
        
     return(selectionsDict)
 
+
+
+############################ NEAR A LOCATION ############################
+
+# asks for a location and a distance in the sidebar, starting at the middle of the state
+# returns (lat, lon, miles), or None when the search is off
+# the inputs aren't keyed so they move to the new state's middle when the state changes
+
+def nearbyChoices(state_df):
+
+    st.sidebar.subheader('Near a Location')
+
+    if not st.sidebar.checkbox('Only Listings Near a Location', key = 'near'):
+        return(None)
+
+    lat, lon = core.mapCenter(state_df)
+
+    lat = st.sidebar.number_input('Latitude', min_value = -90.0, max_value = 90.0, value = round(lat, 4), format = '%.4f')
+    lon = st.sidebar.number_input('Longitude', min_value = -180.0, max_value = 180.0, value = round(lon, 4), format = '%.4f')
+    miles = st.sidebar.slider('Within Miles', min_value = 5, max_value = 500, value = 50, step = 5)
+
+    return(lat, lon, miles)
+
 ############################ MULTI SELECT BOXES ###########################
 
 
-def createMultiSelect(df,column):
+# every value the state has is offered, shown with how many listings under the current
+# selection have it; what the user picked is kept per state while the counts change, see
+# load_widget_memory
 
-    choices = getChoices(df, column)
-    default = choices[:]
+def createMultiSelect(column, choices, counts, state):
+
+    memory = load_widget_memory()
+    key = f'{column}:{state}'
+
+    default = [choice for choice in memory.get(key, choices) if choice in counts]
     # default = choices[:3] 
    # user_choices = st.sidebar.multiselect(f'Select {column}', choices, default = default)
-    user_choices = st.multiselect(f'Select {column}', choices, default = default)    
+    user_choices = st.multiselect(f'Select {column}', choices, default = default, key = key,
+                                  format_func = lambda choice: f'{choice} ({counts[choice]})')    
+
+    memory[key] = user_choices
+
     return(user_choices)
 
-def generateDictChoicesMulti(state_df, multiSelectColumns):
+# with the sql backend (db) the counts are queried under applied, the checked values from
+# core.checkedSelections, instead of baseMask
+
+@tracing.traced('generateDictChoicesMulti')
+def generateDictChoicesMulti(index, facets, state, multiSelectColumns, baseMask, db = None, applied = None):
     
     selectionsDict = {}
     
     for field in multiSelectColumns:      
-        selectionsDict[field] = createMultiSelect(df = state_df, column=field)
-     #   print(selectionsDict[field])
-      
-  #  print(selectionsDict)
-    return(selectionsDict)
+        choices, counts = core.multiSelectChoices(index, facets, state, field, baseMask, db, applied)
 
-################################## MAP ##################################
-
-# This dataset had duplicate coordinates in some instances
-# This function adds a tiny value to the coordinates that are duplicates to avoid a pydeck error
-# The lon and lat values are then rounded elsewhere
-
-def noDupCoors(df):
-    
-    df_coords = []
-    dupes = []
-    
-    for i in range(len(df)):
-        lon = df['lon'][i]
-        lat = df['lat'][i]
+        selectionsDict[field] = createMultiSelect(column = field, choices = choices, counts = counts, state = state)
 
-    
-        if [lat, lon] in df_coords:
-            lon2 = df['lon'][i] + .0000000001
-            lat2 = df['lat'][i] + .0000000001
-            df_coords.append([lat2, lon2])
-            dupes.append(i)
-        else:
-            lon2 = df['lon'][i] 
-            lat2 = df['lat'][i] 
-            df_coords.append([lat2, lon2])
-    
-    
-    newdf = pd.DataFrame(df_coords, columns =['lat2', 'lon2']).reset_index()
-    df1 = df.reset_index()
-    df1 = df1.merge(newdf, how='left', on = 'index')
-    
+        baseMask, applied = core.narrowSelection(index, field, selectionsDict[field], baseMask, db, applied)
+      
+    return(selectionsDict)
 
-    return(df1)
 
+################################## MAP ##################################
 
 # crateMap
+# Returns the (south, north, west, east) bounds of the map's viewport
 # Uses df to plot all the points
-# Uses state_df to get the view to zoom into the selected state (taking the mean lon and lat values)
+# Uses state_df to get the view to zoom into the selected state (taking the mean lon and lat values),
+# or with the sql backend the mean of the state's listings in db
+# Below mapping.DETAIL_ZOOM only the precomputed grid cells for the zoom level are sent
+# (see load_map_levels), from there on only the listings inside the state's viewport
 
 
-def createMap(df, state_df):
-    
-    df =  noDupCoors(df) #creating coordinates without duplicates to allow the program to map them
+@tracing.traced('createMap')
+def createMap(state_df, version, db = None, state = None):
     
     z = st.slider('Map: Zoom Factor', min_value = 0, max_value = 9, value =5)
 
+    lat, lon = core.mapCenter(state_df, db, state)
+
     view_state = pdk.ViewState(
-        latitude = state_df['lat'].mean(),
-        longitude = state_df['lon'].mean(),
+        latitude = lat,
+        longitude = lon,
         zoom = z)
-    
-    #replacing the lat and lon values with de-duped versions 
-    df['lon'] = df['lon2']
-    df['lat'] = df['lat2']
-    layer1 = pdk.Layer("ScatterplotLayer", 
-                        data = df,
-                        pickable = True,
-                        opacity = 0.8,
-                        stroked = True,
-                     #   filled = True,
-                        
-                        get_position = ['lon', 'lat'],
-                        get_radius = 15000, 
-                        get_fill_color = [255, 140, 0])
-    
-    
-    
-    
-    tool_tip = {"html": "<b>Region Name:</b>  {region} <br/><b> State: </b> {stateName} <br/><b>  Year   : </b> {year} <b> Price: </b> {price} <br/><b> Manufacturer: </b> {manufacturer} <br/> <b> Model: </b> {model} <br/>  <b> Posting Date: </b> {date}", 
-                 "style": {"backgroundColor": "steelblue", "color": "white"}} #
+
+    #the aggregated levels look the same whichever state is selected
+    if z < mapping.DETAIL_ZOOM:
+        layer1, tool_tip, payload = load_map_layer(version, z)
+    else:
+        layer1, tool_tip, payload = load_map_layer(version, z, lat, lon)
+
+    tracing.count('map points', len(layer1.data))
+    tracing.count('map bytes', payload)
     
     
     
@@ -245,101 +402,71 @@ def createMap(df, state_df):
 
     st.pydeck_chart(map_)
 
+    return(mapping.viewportBounds(lat, lon, z))
 
-############################### FILTERING #########################################
 
-# Takes user-selected values and a dataframe (usually narrowed down by state)
-# Checks which line items in the data frame are compatible with user selections
-# One takes in values from the checkboxes, the other one takes in values from the multiselectio boxes
+# Builds the map layer for a zoom level (and a viewport center at detail zoom)
+# Only the position and the tooltip columns are sent, and the layer with its records is
+# cached per dataset version so a rerun with the same view doesn't rebuild it
+# Also returns the size of the records sent, for the debug panel
 
-def updatedDf(df, selectionsDict):
-    
-    df_new = pd.DataFrame(columns = df.columns)
+@st.cache(allow_output_mutation = True, max_entries = 64)
+def load_map_layer(version, z, lat = None, lon = None):
 
-    if all(value == [] for value in selectionsDict.values()):
-        return(df)
-    
-    for key in selectionsDict.keys():
-        df_values = getChoices(df = df, column = key) #unique items in state df
-        selec_values = selectionsDict[key] #boxes checked by user
+    sql = QUERY_BACKEND == 'sql'
 
-        for item in df_values:
+    if z < mapping.DETAIL_ZOOM:
 
-            if item.title() in selec_values:
+        levels = load_sql_map_levels(version) if sql else load_map_levels()
 
-                df_temp = df[df[key] == item]
-                df_new = pd.concat([df_new, df_temp])
-               
-    final_df = df_new.drop_duplicates()
-    
+        records, cells = core.mapRecords(z, levels = levels)
 
-    return(final_df)
+        layer1 = pdk.Layer("ScatterplotLayer",
+                            data = records,
+                            pickable = True,
+                            opacity = 0.6,
+                            stroked = True,
 
+                            get_position = ['lon', 'lat'],
+                            get_radius = 'radius',
+                            get_fill_color = [255, 140, 0])
 
+        tool_tip = {"html": "<b>Listings:</b> {count} <br/><b> Median Price: </b> {median_price}",
+                     "style": {"backgroundColor": "steelblue", "color": "white"}}
 
-def updatedDf2(df, selectionsDict):
-    
-    df_new = pd.DataFrame(columns = df.columns)
-    
-    for key in selectionsDict.keys():
-#        print(selectionsDict.values())
-        df_values = getChoices(df = df, column = key) #unique items in state df
-        selec_values = selectionsDict[key] #boxes checked by user
+    else:
 
-        for item in df_values:
-#            print(item)
+        if sql:
+            records, cells = core.mapRecords(z, lat, lon, db = load_database())
+        else:
+            records, cells = core.mapRecords(z, lat, lon, df = load_data(), grid = load_spatial_index())
+
+        #plotting the de-duped lat and lon values
+        layer1 = pdk.Layer("ScatterplotLayer", 
+                            data = records,
+                            pickable = True,
+                            opacity = 0.8,
+                            stroked = True,
+                         #   filled = True,
+                            
+                            get_position = ['lon', 'lat'],
+                            get_radius = 15000, 
+                            get_fill_color = [255, 140, 0])
+        
+        tool_tip = {"html": "<b>Region Name:</b>  {region} <br/><b> State: </b> {stateName} <br/><b>  Year   : </b> {year} <b> Price: </b> {price} <br/><b> Manufacturer: </b> {manufacturer} <br/> <b> Model: </b> {model} <br/>  <b> Posting Date: </b> {date}", 
+                     "style": {"backgroundColor": "steelblue", "color": "white"}} #
 
-            if item in selec_values:
-#                print(item)
-                df_temp = df[df[key] == item]
-                df_new = pd.concat([df_new, df_temp])
-               
-    final_df = df_new.drop_duplicates()
-#    print(final_df)
-    
+    return(layer1, tool_tip, mapping.payloadBytes(layer1.data))
 
-    return(final_df)
 
 ###################################STATS###########################################    
 
 
-#gets the quantitative metrics we want for a specific area (takes in a df that should encompass the entire area
-# then we iterate to repeat this for each one)
-
-def getStatsForArea(df):
+#table of stats for a list of states, all states by default, see core.statsTable
 
-    statDict = {}
-    
-    statDict['Sales Count'] = df['VIN'].count()
-    
-    statDict['Mean Price'] = round(stats.mean(df.price), 2)
-    statDict['Median Price'] = round(stats.median(df.price), 2)
-
-    
-    
-    statDict['Mean Mileage'] = round(stats.mean(df.odometer),2)
-    statDict['Median Mileage'] = round(stats.median(df.odometer),2)
-
-    
-    statDict['Oldest Car Year'] = min(df.year)
-    statDict['Newest Car Year'] = max(df.year)
-    statDict['Median Car Year'] = stats.median(df.year)
-
-    
-    return(statDict)
-
-
-def statsByState(df):
+def statsByState(cube, states = None, db = None):
   
-    stateChoices = getChoices(df, 'state')
-    byState = {} 
-    
-    for state in stateChoices:
-        state_df = df[df['state'] == state]
-        byState[state] = getStatsForArea(state_df)
-
-        
-    stats_df = pd.DataFrame(byState)
+    stats_df = core.statsTable(cube, states, db)
     
 
  
@@ -352,178 +479,213 @@ def statsByState(df):
 
 ################################# Pie Charts ##############################
 
-#gathers percentages to build pie charts based on column and df
-# depending on what we want, we would use state_df or just df (data comes in filtered)
-def forPie(df, column):
+# Rendered charts are kept in the figure cache from load_figure_cache, keyed by the data,
+# columns and title, and unchanged ones are shown from there without drawing them again
+# dataKey identifies the data when it is known, e.g. the dataset version and state, and
+# saves hashing the frame (a fingerprint of the columns used is taken otherwise)
+# The chart isn't drawn here: a placeholder is reserved where it goes and a chart job is
+# returned, and showCharts draws all the jobs of a rerun at once
 
-    percentages = []
-    labels = []
-    choices = getChoices(df=df, column=column)
-    
-    for choice in choices:
-        df_temp = df[df[column]== choice]
-        percentage = df_temp.shape[0]/df.shape[0]    
-        percentages.append(percentage)
-        labels.append(choice)
-        
+def createPie(df, column, title = 'Pie Chart', cube = None, state = aggregates.ALL, dataKey = None, db = None):
 
-    return(percentages, labels)
+    if dataKey is None:
+        dataKey = charts.dataFingerprint(df, [column])
 
-def createPie(df, column, title = 'Pie Chart'):
+    key = charts.figureKey('pie', dataKey, column, title)
 
-    percentages, labels = forPie(df, column = column)    
+    job = charts.chartJob(load_figure_cache(), key, st.empty())
+    job['name'] = title
 
-    
-    fig1, ax = plt.subplots()
-
-    explode = [0.05 for label in labels]
-    print(explode)
-    
-    ax.pie(percentages,autopct='%1.1f%%', startangle=90, colors = cm, explode = explode)
-    
-    ax.legend(labels,
-          title=column.title(),
-          loc="center left",
-          bbox_to_anchor=(1, 0, 0.5, 1))
-    
+    if job['png'] is None:
+        percentages, labels = core.forPie(df, column = column, cube = cube, state = state, db = db)
+        job['draw'] = charts.drawPie
+        job['args'] = (percentages, labels, column, title, cm)
 
-    
-    ax.axis('equal')
-    ax.set_title(title, color = 'purple', size = 15)
-   
-    st.pyplot(fig1)    
+    return(job)
     
 ################################# Box Plots ##############################
 
-def createBoxPlot(df, title, qual, quant, horizontal = 0):
-    
-    
-    if horizontal == 1:
-        x = quant
-        y = qual
-    else:
-        x= qual
-        y = quant
-    
-    
-    labels = getChoices(df, qual)
+#with core.BOXPLOT_SUMMARIES the boxes are drawn from per-group summaries (see core.boxSummaries)
+#and only those are sent to be drawn instead of the rows
+#cached and drawn like the pie charts, see createPie
+#with the sql backend the boxes are computed in db (for state, the states of region or the
+#whole country) only when the chart has to be drawn
 
+def createBoxPlot(df, title, qual, quant, horizontal = 0, cube = None, state = aggregates.ALL, dataKey = None, db = None, region = None):
 
+    if dataKey is None:
+        dataKey = charts.dataFingerprint(df, [qual, quant])
 
-    fig2, ax2 = plt.subplots()
+    key = charts.figureKey('box', core.BOXPLOT_SUMMARIES, dataKey, qual, quant, horizontal, title)
 
-    df = df.sort_values(by = [qual, quant])
+    job = charts.chartJob(load_figure_cache(), key, st.empty())
+    job['name'] = title
 
-    ax2 = sns.boxplot(x=x, y=y, data=df, palette = cm)
+    if job['png'] is None:
 
-    
-    ax2.legend(labels,
-          title=qual.title(),
-          loc="upper left",
-          bbox_to_anchor=(1, 0, 0.5, 1), labelcolor = cm)
+        if not core.BOXPLOT_SUMMARIES:
+            rows, labels = core.boxRows(df, qual, quant, cube, state, db, region)
+            job['draw'] = charts.drawBoxPlot
+            job['args'] = (rows, title, qual, quant, horizontal, labels, cm)
+            return(job)
 
-    ax2.set_title(title, color = 'purple', size = 15)
-   
-    st.pyplot(fig2)    
+        summaries = core.boxSummaries(df, qual, quant, cube, state, db, region)
+
+        job['draw'] = charts.drawBoxSummaries
+        job['args'] = (summaries, title, qual, quant, horizontal, cm)
+
+    return(job)
+
+
+#draws the chart jobs on the render pool and puts each chart in its place as it finishes
+#each chart is traced from the start of the batch until it is shown
+
+def showCharts(jobs):
+
+    start = tracing.clock()
+
+    for job, png in charts.renderJobs(load_figure_cache(), jobs, load_render_pool()):
+        cached = job['draw'] is None
+        job['slot'].image(png, use_column_width = True)
+
+        tracing.record(f"chart: {job['name']}", start, tracing.clock(), cached = cached, bytes = len(png))
+        tracing.count('charts cached' if cached else 'charts drawn')
+        tracing.count('chart bytes', len(png))
   
 
+################################ Data View ################################
 
-############################### States Mapping ##############################
-
-def abbrevToState(df):
-    # United States of America Python Dictionary to translate States,
-    # Districts & Territories to Two-Letter codes and vice versa.
-    #
-    # https://gist.github.com/rogerallen/1583593
-    #
-    # Dedicated to the public domain.  To the extent possible under law,
-    # Roger Allen has waived all copyright and related or neighboring
-    # rights to this code.
-    
-    
-    us_state_abbrev = {
-        'Alabama': 'AL',
-        'Alaska': 'AK',
-        'American Samoa': 'AS',
-        'Arizona': 'AZ',
-        'Arkansas': 'AR',
-        'California': 'CA',
-        'Colorado': 'CO',
-        'Connecticut': 'CT',
-        'Delaware': 'DE',
-        'District of Columbia': 'DC',
-        'Florida': 'FL',
-        'Georgia': 'GA',
-        'Guam': 'GU',
-        'Hawaii': 'HI',
-        'Idaho': 'ID',
-        'Illinois': 'IL',
-        'Indiana': 'IN',
-        'Iowa': 'IA',
-        'Kansas': 'KS',
-        'Kentucky': 'KY',
-        'Louisiana': 'LA',
-        'Maine': 'ME',
-        'Maryland': 'MD',
-        'Massachusetts': 'MA',
-        'Michigan': 'MI',
-        'Minnesota': 'MN',
-        'Mississippi': 'MS',
-        'Missouri': 'MO',
-        'Montana': 'MT',
-        'Nebraska': 'NE',
-        'Nevada': 'NV',
-        'New Hampshire': 'NH',
-        'New Jersey': 'NJ',
-        'New Mexico': 'NM',
-        'New York': 'NY',
-        'North Carolina': 'NC',
-        'North Dakota': 'ND',
-        'Northern Mariana Islands':'MP',
-        'Ohio': 'OH',
-        'Oklahoma': 'OK',
-        'Oregon': 'OR',
-        'Pennsylvania': 'PA',
-        'Puerto Rico': 'PR',
-        'Rhode Island': 'RI',
-        'South Carolina': 'SC',
-        'South Dakota': 'SD',
-        'Tennessee': 'TN',
-        'Texas': 'TX',
-        'Utah': 'UT',
-        'Vermont': 'VT',
-        'Virgin Islands': 'VI',
-        'Virginia': 'VA',
-        'Washington': 'WA',
-        'West Virginia': 'WV',
-        'Wisconsin': 'WI',
-        'Wyoming': 'WY'
-    }
-    
-    # thank you to @kinghelix and @trevormarburger for this idea
-    abbrev_us_state = dict(map(reversed, us_state_abbrev.items()))
-
-    dfNames = pd.DataFrame.from_dict(abbrev_us_state, orient = 'index')
-    
-    dfNames = dfNames.reset_index()
-    
-    dfNames.columns = ['abbrev', 'stateName']
-    
-    updated_df = df.merge(dfNames, how = 'left', left_on = 'state', right_on = 'abbrev')
-    
-    return(updated_df)
-    
-    
+#rows per page the data view offers
+DATA_PAGE_SIZES = [25, 50, 100, 250]
+
+# shows the listings one page at a time, sorted and projected by core.dataPage before
+# anything is styled, so only the visible page is turned into HTML and sent
+# the page number resets to the first page when the number of pages changes
+
+def showDataView(df):
+
+    row7_1, row7_2, row7_3, row7_4 = st.beta_columns((3, 1, 1, 1))
+
+    with row7_1:
+        columns = st.multiselect('Columns', list(df.columns), default = [column for column in core.DATA_COLUMNS if column in df.columns], key = 'data_columns')
+
+    with row7_2:
+        sortColumn = st.selectbox('Sort by', ['(none)'] + columns, key = 'data_sort')
+
+    with row7_3:
+        ascending = st.selectbox('Order', ['Ascending', 'Descending'], key = 'data_order') == 'Ascending'
+
+    with row7_4:
+        pageSize = st.selectbox('Rows per page', DATA_PAGE_SIZES, index = DATA_PAGE_SIZES.index(core.DATA_PAGE_SIZE), key = 'data_page_size')
+
+    pages = core.pageCount(len(df), pageSize)
+
+    page = st.number_input(f'Page (of {pages})', min_value = 1, max_value = pages, value = 1, step = 1)
+
+    view = core.dataPage(df, columns, None if sortColumn == '(none)' else sortColumn, ascending, page - 1, pageSize)
+
+    st.dataframe(view.style.set_properties(**{'background-color': 'lightsalmon', 'color': 'black'}))
+
+    first = (page - 1) * pageSize
+    st.write(f'Listings {min(first + 1, len(df))} to {first + len(view)} of {len(df)}')
+
+    tracing.count('rows sent', len(view))
+
+    return(view)
+
+
+#where the comparables are looked for, see comparables.scopeStates
+COMPARABLE_SCOPES = {'All States': None, 'Same State': 'state', 'Same Region': 'region'}
+
+# the listings most like one picked from the visible page of the data view, by make and
+# model, year, odometer and price (see comparables.py); the page's row labels are the
+# listings' positions in df
+
+def showComparables(view, df, index):
+
+    if view.empty:
+        return
+
+    row8_1, row8_2, row8_3 = st.beta_columns((3, 1, 1))
+
+    with row8_1:
+        position = st.selectbox('Comparables for', list(view.index), key = 'comparables_for',
+                                format_func = lambda row: f"{df['year'].iat[row]:.0f} {df['manufacturer'].iat[row]} {df['model'].iat[row]}, ${df['price'].iat[row]:,.0f}")
+
+    with row8_2:
+        scope = st.selectbox('Look In', list(COMPARABLE_SCOPES), key = 'comparables_scope')
+
+    with row8_3:
+        k = st.slider('How Many', 1, 25, comparables.COMPARABLES, key = 'comparables_k')
+
+    st.dataframe(core.comparableListings(df, index, position, k, COMPARABLE_SCOPES[scope], list(view.columns)))
 
 
 ##################################################################################
 
 
+#the per-stage breakdown and counters of this rerun, with a button writing the recent
+#traces to a Chrome trace file
+
+def showDebugPanel():
+
+    trace = tracing.currentTrace()
+
+    with st.beta_expander('Debug: rerun timings'):
+        st.write(f'Rerun so far: {tracing.elapsedMs(trace):.0f} ms')
+        st.dataframe(tracing.breakdown(trace))
+        st.write(dict(trace['counters']))
+
+        if st.button('Export Traces'):
+            st.write(f'Traces written to {tracing.exportTraces()}')
+
+
 def main():
 
-    df = load_data()
-    
-    df = abbrevToState(df) #get state names
+    tracing.startTrace('rerun')
+
+    sql = QUERY_BACKEND == 'sql'
+
+    if st.sidebar.button('Reload Data'):
+        reload_data() #only reloads what changed
+
+    if sql:
+        #nothing is held in memory, each selection is queried from db
+        db = load_database()
+
+        df = index = facets = partitions = cube = grid = None
+
+        version = db['version']
+
+        stateChoices = sqlbackend.distinctValues(db, 'state')
+
+        stateNames = core.sqlStateNames(db)
+
+    else:
+        db = None
+
+        df = load_data()
+
+        grid = load_spatial_index()
+
+        index = load_filter_index()
+
+        facets = load_facets()
+
+        partitions = load_partitions()
+
+        cube = load_cube()
+
+        version = load_dataset_version()
+
+        stateChoices = filters.facetValues(facets, 'state')
+
+        stateNames = load_state_names()
+
+    wiki = load_wiki_cache(stateNames)
+
+    #expired and failed summaries are fetched again in the background
+    wikicache.warmInBackground(wiki, wikiTitles(stateNames))
     
     
     global cm #universal color theme for app
@@ -537,7 +699,6 @@ def main():
     row0_1.title('Cars Sales on Craigslist')
     
     with row0_1:
-        stateChoices = getChoices(df, 'state')
         defaultValue = stateChoices.index('MA')
         
         selectedState = st.selectbox("Select a state", stateChoices, index =defaultValue)
@@ -555,11 +716,11 @@ def main():
     row1_spacer1, row1_1, row1_spacer2 = st.beta_columns((.1, 3.2, .1))
     
     with row1_1:
-        state_df = df[df['state'] == selectedState]
+        state_df = core.stateDf(df, partitions, selectedState, db)
 
-        stateName = df[df['state'] == selectedState]['stateName']
+        stateName = core.stateName(selectedState)
         
-        result = wikipedia.summary(stateName, sentences = 4) 
+        result = wikicache.getSummary(wiki, stateName, sentences = 4) 
     
         st.subheader(result)
 
@@ -579,35 +740,23 @@ def main():
         (.2, 1, 1, 1, 1, 1, .1))
         
         
+    #region frames are only sliced out of df (see load_partitions) when their box is checked,
+    #see core.regionDf
     with row3_1:
-
-        #setting up tables for each retion with the states therein
-        WEST =  ['WA', 'ID', 'MT', 'CO', 'UT', 'NV', 'OR', 'CA', 'WY', 'AK', 'HI']
-        MIDWEST = ['ND', 'SD', 'NE', 'KS', 'MN', 'IA', 'MO', 'WI', 'IL', 'IN', 'OH', 'MI' ]
-        SOUTHWEST = ['AZ', 'NM', 'OK', 'TX']
-        SOUTHEAST = ['AR', 'LA', 'MS', 'AL', 'TN', 'KY', 'GA', 'FL', 'SC', 'NC', 'VA', 'WV']
-        NORTHEAST = ['ME', 'NH', 'MA','VT', 'NY', 'NJ', 'PA', 'DE', 'MD', 'CT', 'RI']
-        
-        #creating data frame for each region
-        df_w = df[df['state'].isin(WEST)]
         w = st.checkbox('Western US')
         
     #repeat this process for all regions
     with row3_spacer2:
-        df_mw = df[df['state'].isin(MIDWEST)]
         mw = st.checkbox('Midwestern US')
         
         
     with row3_2:
-        df_sw = df[df['state'].isin(SOUTHWEST)]
         sw = st.checkbox('Southwestern US')
         
     with row3_spacer3:    
-        df_se = df[df['state'].isin(SOUTHEAST)]
         se = st.checkbox('Southeastern US')
     
     with row3_3:            
-        df_ne = df[df['state'].isin(NORTHEAST)]
         ne = st.checkbox('Northeastern US')
         
     row4_spacer1, row4_1, row4_spacer2, row4_2, row4_spacer3 = st.beta_columns(
@@ -616,26 +765,30 @@ def main():
     #takes input from above of whether the boxes are checked and if so creating a summary view for the selected region
     #repeated for each of the 5 regions
     
+    jobs = [] #charts of this rerun, drawn together by showCharts
+
     with row4_1:
         if w:
             region1 = 'Western'
-            createBoxPlot(df_w, qual = 'state', quant = 'price', title = f'Box Plot for States in {region1} United States', horizontal=1)           
+            df_w = core.regionDf(df, partitions, region1, db)
+            jobs.append(createBoxPlot(df_w, qual = 'state', quant = 'price', title = f'Box Plot for States in {region1} United States', horizontal=1, cube = cube, dataKey = (version, region1), db = db, region = region1))
             
             with row4_2:
-                statsByState(df_w)
+                statsByState(cube, filters.US_REGIONS['Western'], db = db)
                 st.subheader(f'About the {region1} United States Region')
 
-                result = wikipedia.summary(f'{region1} United States', sentences = 3) 
+                result = wikicache.getSummary(wiki, f'{region1} United States', sentences = 3) 
                 st.write(result)
 
 
         if sw:
             region2 = 'Southwestern'
+            df_sw = core.regionDf(df, partitions, region2, db)
 
-            createBoxPlot(df_sw, qual = 'state', quant = 'price', title = f'Box Plot for States in {region2} United States', horizontal=1)           
+            jobs.append(createBoxPlot(df_sw, qual = 'state', quant = 'price', title = f'Box Plot for States in {region2} United States', horizontal=1, cube = cube, dataKey = (version, region2), db = db, region = region2))
             
             with row4_2:
-                statsByState(df_w)
+                statsByState(cube, filters.US_REGIONS['Southwestern'], db = db)
                 st.subheader(f'About the {region2} United States Region')
 
                 result = "The southeastern United States, also referred to as the American Southeast or simply the Southeast, is broadly the eastern portion of the southern United States and the southern portion of the eastern United States. It comprises at least a core of states on the lower East Coast of the United States and eastern Gulf Coast. Expansively, it includes everything south of the Mason–Dixon line, the Ohio River, the 36°30' parallel, and stretches far west as Arkansas and Louisiana.[1] There is no official U.S. government definition of the region, though various agencies and departments use different definitions."
@@ -644,63 +797,90 @@ def main():
 
         if mw:
             region3 = 'Midwestern'
+            df_mw = core.regionDf(df, partitions, region3, db)
 
             
-            createBoxPlot(df_mw, qual = 'state', quant = 'price', title = f'Box Plot for States in {region3} United States', horizontal=1)
+            jobs.append(createBoxPlot(df_mw, qual = 'state', quant = 'price', title = f'Box Plot for States in {region3} United States', horizontal=1, cube = cube, dataKey = (version, region3), db = db, region = region3))
 
             
             with row4_2:
 
-                statsByState(df_mw)
+                statsByState(cube, filters.US_REGIONS['Midwestern'], db = db)
                 st.subheader(f'About the {region3} United States Region')
 
-                result = wikipedia.summary(f'{region3} United States', sentences = 4) 
+                result = wikicache.getSummary(wiki, f'{region3} United States', sentences = 4) 
                 st.write(result)
 
         if se:
 
             region4 = 'Southeastern'
+            df_se = core.regionDf(df, partitions, region4, db)
 
-            createBoxPlot(df_se, qual = 'state', quant = 'price', title = f'Box Plot for States in {region4} United States', horizontal=1)
+            jobs.append(createBoxPlot(df_se, qual = 'state', quant = 'price', title = f'Box Plot for States in {region4} United States', horizontal=1, cube = cube, dataKey = (version, region4), db = db, region = region4))
             
             with row4_2:
                 
-                result = wikipedia.summary(f'{region4} United States', sentences = 4) 
+                result = wikicache.getSummary(wiki, f'{region4} United States', sentences = 4) 
                 st.subheader(f'About the {region4} United States Region')
 
                 st.write(result)
-                statsByState(df_se)
+                statsByState(cube, filters.US_REGIONS['Southeastern'], db = db)
 
         if ne:
             region5 = 'Northeastern'
+            df_ne = core.regionDf(df, partitions, region5, db)
 
-            createBoxPlot(df_ne, qual = 'state', quant = 'price', title = f'Box Plot for States in {region5} United States', horizontal=1)
+            jobs.append(createBoxPlot(df_ne, qual = 'state', quant = 'price', title = f'Box Plot for States in {region5} United States', horizontal=1, cube = cube, dataKey = (version, region5), db = db, region = region5))
             
             with row4_2:
-                statsByState(df_ne)        
+                statsByState(cube, filters.US_REGIONS['Northeastern'], db = db)        
 
                 st.subheader(f'About the {region5} United States Region')
                 
-                result = wikipedia.summary(f'{region5} United States', sentences = 2) 
+                result = wikicache.getSummary(wiki, f'{region5} United States', sentences = 2) 
                 st.write(result)
 
     #columns we want to be able to filter on using check boxes
     checkBoxColumns = ['fuel', 'drive', 'condition', 'cylinders', 'size']
 
-    #options in check boxes will change based on state since we're passing in a dataframe filtered down by state
+    #options in check boxes will change based on state since we're looking them up for the selected state
+    stateMask = None if sql else filters.facetMask(index, 'state', [selectedState])
+
+    #listings within some miles of a location, looked up in the spatial index and filtered
+    #like one more check box (the search isn't offered with the sql backend)
+    near = None if sql else nearbyChoices(state_df)
+
+    if near is not None:
+        nearMask = core.nearMask(grid, *near)
+        stateMask = filters.andMasks(stateMask, nearMask)
+        filter_df = filters.applyMask(state_df, grid, nearMask)
+    else:
+        filter_df = state_df
     
-    selectionsDict = generateDictChoices(state_df = state_df, checkBoxColumns = checkBoxColumns)
+    selectionsDict = generateDictChoices(index, facets, selectedState, checkBoxColumns = checkBoxColumns, baseMask = stateMask, db = db)
 
-    new_df = updatedDf(df = state_df, selectionsDict=selectionsDict)
+    #the filtered frames are reused while the state and selections stay the same
+    filterCache = load_filter_cache()
+    checkKey = (version, selectedState, near, core.selectionKey(selectionsDict))
+
+    new_df = core.cachedFrame(filterCache, ('checks',) + checkKey,
+                              lambda: core.updatedDf(df = filter_df, selectionsDict=selectionsDict, index = index, db = db, state = selectedState))
 
     multiSelectColumns = ['paint_color', 'manufacturer']
 
     row6_spacer1, row6_1, row6_spacer2 = st.beta_columns((.1, 3.2, .1))
     
     with row6_1:
-        selectionsDict_multi = generateDictChoicesMulti(new_df, multiSelectColumns)
+        if sql:
+            checkedMask = None
+            checked = core.checkedSelections(db, selectedState, selectionsDict)
+        else:
+            checkedMask = filters.andMasks(stateMask, filters.selectionMask(index, selectionsDict, normalize = str.title))
+            checked = None
+        selectionsDict_multi = generateDictChoicesMulti(index, facets, selectedState, multiSelectColumns, baseMask = checkedMask, db = db, applied = checked)
 
-    new_df2 = updatedDf2(df = new_df, selectionsDict=selectionsDict_multi)
+    new_df2 = core.cachedFrame(filterCache, ('multi',) + checkKey + (core.selectionKey(selectionsDict_multi, emptyMeansAll = False),),
+                               lambda: core.updatedDf2(df = new_df, selectionsDict=selectionsDict_multi, index = index, db = db, state = selectedState, checked = checked))
     
     
     
@@ -725,17 +905,23 @@ def main():
         x= x.lower() # changing x and y so the program can serach for it since titles are in lowercase
         y= y.lower()
         
+    #the filters are combined, so they can leave no listings at all
+    noMatches = new_df2.empty
+
     with row5_1:
-        createPie(new_df2, column = x, title = f'Pie Chart by  {x} category for {selectedState} - filtered')
-        createBoxPlot(new_df2, qual = x, quant = y, title= f'Distribution of {y} by {x} for {selectedState} - filtered')
+        if noMatches:
+            st.info('No listings match these filters')
+        else:
+            jobs.append(createPie(new_df2, column = x, title = f'Pie Chart by  {x} category for {selectedState} - filtered'))
+            jobs.append(createBoxPlot(new_df2, qual = x, quant = y, title= f'Distribution of {y} by {x} for {selectedState} - filtered'))
 
     with row5_2:
-        createPie(state_df, column = x, title = f'Pie Chart by  {x} category for {selectedState}')
-        createBoxPlot(state_df, qual = x, quant = y, title= f'Distribution of {y} by {x} for {selectedState}')
+        jobs.append(createPie(state_df, column = x, title = f'Pie Chart by  {x} category for {selectedState}', cube = cube, state = selectedState, dataKey = (version, selectedState), db = db))
+        jobs.append(createBoxPlot(state_df, qual = x, quant = y, title= f'Distribution of {y} by {x} for {selectedState}', cube = cube, state = selectedState, dataKey = (version, selectedState), db = db))
         
     with row5_3:
-        createPie(df, column = x, title = f'Pie Chart by {x} category for the United States')
-        createBoxPlot(df, qual = x, quant = y, title= f'Distribution of {y} by {x} for the United States')
+        jobs.append(createPie(df, column = x, title = f'Pie Chart by {x} category for the United States', cube = cube, dataKey = (version,), db = db))
+        jobs.append(createBoxPlot(df, qual = x, quant = y, title= f'Distribution of {y} by {x} for the United States', cube = cube, dataKey = (version,), db = db))
         
     if additional:
         row6_spacer1, row6_1, row6_spacer2, row6_2, row6_spacer3, row6_3, row6_spacer4 = st.beta_columns(
@@ -747,16 +933,17 @@ def main():
         with row5_spacer1:
             y1 = st.selectbox('Second Category', columns2, index = defaultValue3)
             y1 = y1.lower()
-        with row5_1:
-            createBoxPlot(new_df2, qual = x, quant = y1, title= f'Distribution of {y1} by {x} for {selectedState} - filtered')
+        if not noMatches:
+            with row5_1:
+                jobs.append(createBoxPlot(new_df2, qual = x, quant = y1, title= f'Distribution of {y1} by {x} for {selectedState} - filtered'))
     
         with row5_2:
-            createBoxPlot(state_df, qual = x, quant = y1, title= f'Distribution of {y1} by {x} for {selectedState}')
+            jobs.append(createBoxPlot(state_df, qual = x, quant = y1, title= f'Distribution of {y1} by {x} for {selectedState}', cube = cube, state = selectedState, dataKey = (version, selectedState), db = db))
             
         with row5_3:
-            createBoxPlot(df, qual = x, quant = y1, title= f'Distribution of {y1} by {x} for the United States')                      
+            jobs.append(createBoxPlot(df, qual = x, quant = y1, title= f'Distribution of {y1} by {x} for the United States', cube = cube, dataKey = (version,), db = db))
 
-        state_df.reset_index(inplace = True)
+    showCharts(jobs)
     
 
     
@@ -765,16 +952,33 @@ def main():
     #options in multi-select boxes will change based on state since we're passing in a dataframe filtered down by state
 
     #calling function to create map
-    createMap(df = df, state_df = state_df)
+    mapBounds = createMap(state_df = state_df, version = version, db = db, state = selectedState)
     
 
     if st.checkbox('View Data'):
         st.subheader('All transactions in %s' %selectedState)
-        st.dataframe(new_df2.style.set_properties(**{'background-color': 'lightsalmon', 'color': 'black'}))
+
+        view_df = new_df2
+        if not sql and st.checkbox('Only Listings in the Map View'):
+            view_df = filters.applyMask(new_df2, grid, core.boundsMask(grid, mapBounds))
+
+        view = showDataView(view_df)
+
+        if not sql and st.checkbox('Show Comparable Listings'):
+            showComparables(view, df, load_comparables())
 
     
     if st.checkbox('View Stats for All States'):
-        statsByState(df)
+        statsByState(cube, db = db)
+
+    if st.checkbox('View Memory Report'):
+        st.dataframe(load_memory_report())
+
+    if DEBUG_PANEL:
+        showDebugPanel()
     
 
-main()
+#the chart workers import this file as __mp_main__, they mustn't build the page too
+if __name__ == '__main__':
+    setup_page()
+    main()
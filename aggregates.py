@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed aggregates for the Craigslist Used Cars app.
+
+The cube holds the listing count, sums and quantiles of price, odometer and year for
+every (state, region, qualitative column, value) combination, rolled up to the state and
+national level as well, with ALL standing in for "every state/region/column/value". It is
+built once per dataset, after which stats tables, pie charts and box plot labels for a
+state or the whole country are dictionary lookups.
+
+The build is done with numpy rather than groupbys: each quantitative column is sorted once,
+and for every grouping a stable (radix) sort of the rows' group codes lays each group's
+values out in ascending order, from which quantiles, whiskers and outliers are read off by
+position.
+
+When a delta of postings is upserted the cells of the states it touched are rebuilt from
+those states' rows and the national cells from every row, since exact quantiles can't be
+updated from the changed rows alone; a delta spread over most states costs a full build.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+ALL = '*'
+
+#qualitative columns the pie charts and box plots can be drawn by
+QUAL_COLUMNS = ['fuel', 'drive', 'condition', 'cylinders', 'size']
+
+QUANT_COLUMNS = ['price', 'odometer', 'year']
+
+QUANTILES = [0, .25, .5, .75, 1]
+
+#how far down the cube goes geographically: the whole country, each state, each region
+SCOPES = [[], ['state'], ['state', 'region']]
+
+#box plot summaries are kept for the country and each state, regions aren't plotted
+BOX_SCOPES = [[], ['state']]
+
+#most outliers kept per box, an evenly spaced sample of them when there are more
+MAX_FLIERS = 50
+
+
+################################## BUILDING ##################################
+
+# Numbers the groups of rows sharing the same keys in sorted order, like a groupby with
+# observed=True
+# Returns (group code of every row, -1 for rows missing a key; list of the groups' key
+# tuples in code order)
+
+def groupCodes(df, keys):
+
+    if not keys:
+        return(np.zeros(len(df), dtype = np.int64), [()])
+
+    combined = np.zeros(len(df), dtype = np.int64)
+    missing = np.zeros(len(df), dtype = bool)
+    levels = []
+
+    for key in keys:
+        if isinstance(df[key].dtype, pd.CategoricalDtype):
+            codes, uniques = df[key].cat.codes.to_numpy(dtype = np.int64), df[key].cat.categories
+        else:
+            codes, uniques = pd.factorize(df[key], sort = True)
+
+        missing |= codes < 0
+        combined = combined * max(len(uniques), 1) + codes
+        levels.append(np.asarray(uniques, dtype = object))
+
+    size = int(np.prod([max(len(uniques), 1) for uniques in levels]))
+    codes = np.full(len(df), -1, dtype = np.int64)
+
+    #a table over every combination of the keys when that is small, a sort otherwise
+    if size <= 4 * len(df) + 1024:
+        seen = np.bincount(combined[~missing], minlength = size) > 0
+        present = np.flatnonzero(seen)
+        codes[~missing] = (np.cumsum(seen) - 1)[combined[~missing]]
+    else:
+        present, codes[~missing] = np.unique(combined[~missing], return_inverse = True)
+
+    #the keys of each group back out of its combined code
+    labels = []
+    for uniques in reversed(levels):
+        labels.insert(0, uniques[present % max(len(uniques), 1)])
+        present = present // max(len(uniques), 1)
+
+    return(codes, list(zip(*labels)))
+
+
+# Lays out the non-missing values of every group one group after the other, each group's
+# in ascending order. order is the argsort of a column's non-missing values and values those
+# values in that order, which every grouping of the column shares: a stable sort of the
+# groups' codes (a radix sort for small codes) keeps each group's values sorted
+# Returns (sorted values, number of them in each group)
+
+def groupRuns(codes, groups, values, order):
+
+    codes = codes[order]
+    keep = codes >= 0
+    codes = codes[keep]
+
+    small = np.uint16 if groups <= np.iinfo(np.uint16).max else np.int64
+    runs = values[keep][np.argsort(codes.astype(small), kind = 'stable')]
+
+    return(runs, np.bincount(codes, minlength = groups))
+
+
+# The argsort of a column's non-missing values and those values in that order, see groupRuns
+
+def sortedValues(values):
+
+    order = np.argsort(values, kind = 'stable')[:np.count_nonzero(~np.isnan(values))]
+
+    return(order, values[order])
+
+
+# Linearly interpolated quantile q of every group of runs, like pandas' quantile, NaN for
+# groups without values
+
+def runQuantile(runs, sizes, q):
+
+    if not len(runs):
+        return(np.full(len(sizes), np.nan))
+
+    starts = np.cumsum(sizes) - sizes
+    last = np.maximum(sizes - 1, 0)
+
+    position = q * last.astype('float64')
+    lower = np.floor(position).astype(np.int64)
+    frac = position - lower
+
+    #empty groups point past their start, their result is dropped below
+    below = runs[np.minimum(starts + lower, len(runs) - 1)]
+    above = runs[np.minimum(starts + np.minimum(lower + 1, last), len(runs) - 1)]
+
+    quantile = np.where(frac == 0, below, below + (above - below) * frac)
+
+    return(np.where(sizes > 0, quantile, np.nan))
+
+
+# What a box plot needs for every group of runs, without the raw rows: quartiles, whiskers
+# at the furthest values within 1.5 IQR of the box (like seaborn and matplotlib draw them)
+# and a sample of at most maxFliers outliers, every step-th one when there are more
+# Returns a dictionary of arrays q1, med, q3, whislo, whishi and fliers, a list per group
+
+def runBoxes(runs, sizes, maxFliers = MAX_FLIERS):
+
+    q1, med, q3 = (runQuantile(runs, sizes, q) for q in (.25, .5, .75))
+
+    low = q1 - 1.5 * (q3 - q1)
+    high = q3 + 1.5 * (q3 - q1)
+
+    group = np.repeat(np.arange(len(sizes)), sizes)
+    inside = (runs >= low[group]) & (runs <= high[group])
+
+    #a group without values has no whiskers
+    whislo = np.full(len(sizes), np.nan)
+    whishi = np.full(len(sizes), np.nan)
+
+    nonEmpty = np.flatnonzero(sizes > 0)
+    if len(nonEmpty):
+        starts = (np.cumsum(sizes) - sizes)[nonEmpty]
+        whislo[nonEmpty] = np.minimum.reduceat(np.where(inside, runs, np.inf), starts)
+        whishi[nonEmpty] = np.maximum.reduceat(np.where(inside, runs, -np.inf), starts)
+        whislo[np.isinf(whislo)] = np.nan
+        whishi[np.isinf(whishi)] = np.nan
+
+    #the outliers are already sorted within their group
+    outGroup = group[~inside]
+    outSizes = np.bincount(outGroup, minlength = len(sizes))
+    rank = np.arange(len(outGroup)) - (np.cumsum(outSizes) - outSizes)[outGroup]
+    step = np.ceil(outSizes / maxFliers).astype(np.int64)
+
+    sampled = rank % np.maximum(step, 1)[outGroup] == 0
+    kept = np.bincount(outGroup[sampled], minlength = len(sizes))
+    fliers = [part.tolist() for part in np.split(runs[~inside][sampled], np.cumsum(kept)[:-1])]
+
+    return({'q1': q1, 'med': med, 'q3': q3, 'whislo': whislo, 'whishi': whishi, 'fliers': fliers})
+
+
+# Computes count, sum and quantiles of each quantitative column for every group of rows,
+# and the whiskers and outliers of their box plots when boxes is set
+# codes and groups come from groupCodes, sorts holds the sortedValues of each quantitative
+# column
+# Returns one dictionary per group with keys like 'count', 'price_sum', 'price_q50'
+
+def groupStats(codes, groups, sorts, boxes = False):
+
+    stats = {'count': np.bincount(codes[codes >= 0], minlength = groups)}
+
+    for col in QUANT_COLUMNS:
+        order, ordered = sorts[col]
+        runs, sizes = groupRuns(codes, groups, ordered, order)
+
+        stats[f'{col}_sum'] = np.bincount(np.repeat(np.arange(groups), sizes), weights = runs, minlength = groups)
+
+        for q in QUANTILES:
+            stats[f'{col}_q{int(q * 100)}'] = runQuantile(runs, sizes, q)
+
+        if boxes:
+            box = runBoxes(runs, sizes)
+            for stat in ['whislo', 'whishi', 'fliers']:
+                stats[f'{col}_{stat}'] = box[stat]
+
+    names = list(stats)
+    columns = [stats[name] if isinstance(stats[name], list) else stats[name].tolist() for name in names]
+
+    return([dict(zip(names, row)) for row in zip(*columns)])
+
+
+# Computes what a box plot of quant needs for every group of keys, see runBoxes
+# Returns a frame with one row per group and columns q1, med, q3, whislo, whishi, fliers,
+# without rows when df has none
+
+def boxStats(df, keys, quant, maxFliers = MAX_FLIERS):
+
+    if df.empty:
+        return(pd.DataFrame(columns = ['q1', 'med', 'q3', 'whislo', 'whishi', 'fliers']))
+
+    values = df[quant].to_numpy(dtype = 'float64')
+    codes, labels = groupCodes(df, keys)
+
+    order, ordered = sortedValues(values)
+    runs, sizes = groupRuns(codes, len(labels), ordered, order)
+
+    if len(keys) > 1:
+        index = pd.MultiIndex.from_tuples(labels, names = keys)
+    else:
+        index = pd.Index([label[0] if keys else ALL for label in labels])
+
+    return(pd.DataFrame(runBoxes(runs, sizes, maxFliers), index = index))
+
+
+# Builds the cube for the cleaned listings
+# Returns a dictionary with
+#   'cells':  (state, region, column, value) -> dictionary of stats from groupStats, with
+#             the whiskers and outliers for the country and state cells
+#   'values': (state, region, column) -> sorted list of the column's values in that area,
+#             including the 'state' values of the country and the 'region' values of a state
+# scopes and boxScopes limit the levels built, see updateCube
+
+def buildCube(df, scopes = SCOPES, boxScopes = BOX_SCOPES):
+
+    cells = {}
+    values = {}
+
+    #every grouping of a column reuses the one sort of its values
+    sorts = {col: sortedValues(df[col].to_numpy(dtype = 'float64')) for col in QUANT_COLUMNS}
+
+    for scope in scopes:
+        for column in [None] + QUAL_COLUMNS:
+
+            keys = scope + ([column] if column else [])
+            codes, labels = groupCodes(df, keys)
+
+            stats = groupStats(codes, len(labels), sorts, boxes = scope in boxScopes)
+
+            for key, row in zip(labels, stats):
+                area = tuple(key[:len(scope)]) + (ALL,) * (2 - len(scope))
+                value = key[len(scope)] if column else ALL
+
+                cells[area + (column or ALL, value)] = row
+
+                if column:
+                    values.setdefault(area + (column,), []).append(value)
+                elif scope:
+                    #the states of the country and the regions of each state
+                    parent = tuple(key[:len(scope) - 1]) + (ALL,) * (3 - len(scope))
+                    values.setdefault(parent + (scope[-1],), []).append(key[-1])
+
+    for area in values:
+        values[area] = sorted(values[area])
+
+    return({'cells': cells, 'values': values})
+
+
+# Updates a cube after rows were removed from and added to the listings, df being the new
+# frame: the cells of the states either touched are rebuilt from those states' rows and
+# the national cells from df, every other state's cells are kept as they were
+# Returns the new cube
+
+def updateCube(cube, df, removed, added):
+
+    states = set(removed['state'].astype(str)) | set(added['state'].astype(str))
+
+    if not states:
+        return(cube)
+
+    #a delta touching every state costs less as one full build
+    if states >= set(cube['values'].get((ALL, ALL, 'state'), [])):
+        return(buildCube(df))
+
+    local = buildCube(df[df['state'].isin(states)], SCOPES[1:], BOX_SCOPES[1:])
+    country = buildCube(df, SCOPES[:1], BOX_SCOPES[:1])
+
+    cells = {key: stats for key, stats in cube['cells'].items() if key[0] != ALL and key[0] not in states}
+    cells.update(local['cells'])
+    cells.update(country['cells'])
+
+    values = {key: labels for key, labels in cube['values'].items() if key[0] != ALL and key[0] not in states}
+    values.update(local['values'])
+    values.update(country['values'])
+
+    kept = [state for state in cube['values'].get((ALL, ALL, 'state'), []) if state not in states]
+    values[(ALL, ALL, 'state')] = sorted(kept + local['values'].get((ALL, ALL, 'state'), []))
+
+    return({'cells': cells, 'values': values})
+
+
+################################## LOOKUPS ##################################
+
+# Stats of one cube cell, or None when the area has no listings
+
+def areaStats(cube, state = ALL, region = ALL, column = ALL, value = ALL):
+
+    return(cube['cells'].get((state, region, column, value)))
+
+
+# Sorted values of a qualitative column within an area
+
+def choices(cube, column, state = ALL, region = ALL):
+
+    return(cube['values'].get((state, region, column), []))
+
+
+# Share of the area's listings taken by each value of a column
+# Returns the same (percentages, labels) pair the pie charts are drawn from
+
+def shares(cube, column, state = ALL, region = ALL):
+
+    labels = choices(cube, column, state, region)
+    total = areaStats(cube, state, region)['count']
+
+    percentages = [areaStats(cube, state, region, column, label)['count'] / total for label in labels]
+
+    return(percentages, labels)
+
+
+# Mean of a quantitative column within a cube cell
+
+def mean(stats, column):
+
+    return(stats[f'{column}_sum'] / stats['count'])
+
+
+# Box plot summary of quant for one cube cell, in the form matplotlib's bxp draws
+
+def boxSummary(stats, quant, label):
+
+    return({'label': label,
+            'q1': stats[f'{quant}_q25'], 'med': stats[f'{quant}_q50'], 'q3': stats[f'{quant}_q75'],
+            'whislo': stats[f'{quant}_whislo'], 'whishi': stats[f'{quant}_whishi'],
+            'fliers': stats[f'{quant}_fliers']})
+
+
+# Box plot summaries of quant for each value of column within a state (or the country)
+
+def boxSummaries(cube, column, quant, labels, state = ALL):
+
+    return([boxSummary(areaStats(cube, state, ALL, column, label), quant, label) for label in labels])
+
+
+# Box plot summaries of quant for each of a list of states
+
+def stateBoxSummaries(cube, quant, states):
+
+    return([boxSummary(areaStats(cube, state), quant, state) for state in states])
+
+
+# Box plot summaries of quant by column for a frame that isn't in the cube (e.g. filtered),
+# none when the frame is empty
+
+def frameBoxSummaries(df, column, quant):
+
+    box = boxStats(df, [column], quant)
+
+    return([dict(row, label = label) for label, row in box.to_dict('index').items()])
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the Craigslist Used Cars app.
+
+Times the data work behind the page (loading, filtering, coordinates, stats, pie shares,
+box plots and map payloads) on synthetic exports of growing size, calling core.py directly,
+so neither Streamlit nor the page is imported. Every case is run a few times for
+its timing and once more under tracemalloc for its peak memory.
+
+The exports come from synthetic.py with a fixed seed and are kept under
+.listings_cache/bench, so every run measures the same data. Results can be saved as JSON
+and compared with an earlier run:
+
+    python benchmark.py --sizes 7k 100k 1m --repeat 5 --json after.json --compare before.json
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import pandas as pd
+import seaborn as sns
+
+import aggregates
+import charts
+import comparables
+import core
+import datastore
+import filters
+import mapping
+import spatial
+import synthetic
+
+
+BENCH_DIR = os.path.join(datastore.CACHE_DIR, 'bench')
+
+SEED = 0
+
+#the state the per-state cases use, the one with the most listings in the synthetic data
+STATE = 'CA'
+
+
+################################## DATA ##################################
+
+# Path of the synthetic export of a size, generated the first time it is asked for
+
+def benchFile(size, seed = SEED, folder = BENCH_DIR):
+
+    path = os.path.join(folder, f'synthetic-{size}-{seed}.csv')
+
+    if not os.path.exists(path):
+        print(f'generating {size} rows ...', flush = True)
+        synthetic.writeListings(path, synthetic.parseSize(size), seed)
+
+    return(path)
+
+
+################################## MEASURING ##################################
+
+# Seconds taken by each of repeat calls
+
+def timeCalls(case, repeat):
+
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case()
+        times.append(time.perf_counter() - start)
+
+    return(times)
+
+
+# Most memory allocated at once (in bytes) during one call, as seen by tracemalloc: Python
+# objects and numpy arrays, but not the buffers pyarrow allocates itself
+
+def peakMemory(case):
+
+    tracemalloc.start()
+    try:
+        case()
+        return(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+
+
+################################## CASES ##################################
+
+# Builds the benchmark cases for one export: a list of (name, function) pairs run in order
+
+def buildCases(path):
+
+    cachePath = os.path.join(BENCH_DIR, 'parquet', os.path.basename(path) + '.parquet')
+    clean = datastore.ingestFile(path, cachePath)
+
+    df = core.prepareData(clean)
+    index = filters.buildBitmaps(df, core.FILTER_COLUMNS)
+    facets = filters.buildFacets(df, core.FILTER_COLUMNS)
+    partitions = filters.buildPartitions(df)
+    cube = aggregates.buildCube(df)
+    levels = mapping.buildLevels(df)
+    grid = spatial.buildGrid(df)
+    similar = comparables.buildIndex(df)
+
+    state_df = filters.partitionView(df, partitions, 'state', STATE)
+
+    #a typical selection: a couple of check boxes and the most common colors and makes
+    checks = {'fuel': [value.title() for value in filters.facetValues(facets, 'fuel', STATE)[:1]],
+              'drive': [value.title() for value in filters.facetValues(facets, 'drive', STATE)[:2]]}
+    new_df = core.updatedDf(state_df, checks, index)
+
+    multi = {column: sorted(facets[(STATE, column)], key = facets[(STATE, column)].get)[-limit:]
+             for column, limit in (('paint_color', 5), ('manufacturer', 10))}
+    new_df2 = core.updatedDf2(new_df, multi, index)
+
+    states = aggregates.choices(cube, 'state')
+    colors = list(sns.color_palette('flare'))
+    lat, lon = core.mapCenter(state_df)
+    listing = int(state_df.index[0])
+
+    def drawBoxPlot():
+        summaries = aggregates.frameBoxSummaries(state_df, 'drive', 'price')
+        charts.renderPng(charts.drawBoxSummaries(summaries, 'Box Plot', 'drive', 'price', 0, colors))
+
+    return([
+        ('load_data (from source)', lambda: core.prepareData(datastore.ingestFile(path, cachePath))),
+        ('load_data (from cache)', lambda: core.prepareData(datastore.readCache(cachePath))),
+        ('build filter index', lambda: filters.buildBitmaps(df, core.FILTER_COLUMNS)),
+        ('build facets', lambda: filters.buildFacets(df, core.FILTER_COLUMNS)),
+        ('build cube', lambda: aggregates.buildCube(df)),
+        ('build map levels', lambda: mapping.buildLevels(df)),
+        ('build spatial index', lambda: spatial.buildGrid(df)),
+        ('noDupCoors', lambda: core.noDupCoors(df)),
+        ('updatedDf', lambda: core.updatedDf(state_df, checks, index)),
+        ('updatedDf2', lambda: core.updatedDf2(new_df, multi, index)),
+        ('statsByState', lambda: core.statsTable(cube, states)),
+        ('forPie (cube)', lambda: core.forPie(state_df, 'drive', cube, STATE)),
+        ('forPie (filtered)', lambda: core.forPie(new_df2, 'drive')),
+        ('createBoxPlot (summaries)', lambda: core.boxSummaries(state_df, 'drive', 'price')),
+        ('createBoxPlot (cube)', lambda: core.boxSummaries(state_df, 'drive', 'price', cube, STATE)),
+        ('createBoxPlot (drawn)', drawBoxPlot),
+        ('mapRecords (cells)', lambda: core.mapRecords(5, levels = levels)),
+        ('mapRecords (points)', lambda: core.mapRecords(mapping.DETAIL_ZOOM, lat, lon, df = df)),
+        ('mapRecords (points, grid)', lambda: core.mapRecords(mapping.DETAIL_ZOOM, lat, lon, df = df, grid = grid)),
+        ('nearMask (50 miles)', lambda: core.nearMask(grid, lat, lon, 50)),
+        ('build comparables index', lambda: comparables.buildIndex(df)),
+        ('comparableListings', lambda: core.comparableListings(df, similar, listing, 10)),
+        ('comparableListings (region)', lambda: core.comparableListings(df, similar, listing, 10, 'region')),
+    ]), len(df)
+
+
+################################## RUNNING ##################################
+
+def gitRevision():
+
+    try:
+        return(subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True).stdout.strip())
+    except OSError:
+        return('')
+
+
+# Runs every case on every size and returns the results as a list of dictionaries
+
+def runBenchmarks(sizes, repeat = 3, memory = True):
+
+    results = []
+
+    for size in sizes:
+        cases, rows = buildCases(benchFile(size))
+
+        for name, case in cases:
+            times = timeCalls(case, repeat)
+            peak = peakMemory(case) if memory else None
+
+            result = {'size': size, 'rows': rows, 'case': name,
+                      'min s': min(times), 'median s': sorted(times)[len(times) // 2],
+                      'peak MB': None if peak is None else peak / 2 ** 20}
+            results.append(result)
+
+            print(f"{size:>5} {name:<28} {result['median s'] * 1000:10.1f} ms"
+                  + ('' if peak is None else f"{result['peak MB']:10.1f} MB"), flush = True)
+
+    return(results)
+
+
+def environment():
+
+    return({'python': platform.python_version(), 'pandas': pd.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'commit': gitRevision(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+
+# Table of median times of two runs side by side, with the ratio new / old
+
+def compareResults(old, new):
+
+    key = ['size', 'case']
+    before = pd.DataFrame(old['results']).set_index(key)['median s']
+    after = pd.DataFrame(new['results']).set_index(key)['median s']
+
+    table = pd.DataFrame({'before ms': before * 1000, 'after ms': after * 1000}).dropna()
+    table['ratio'] = table['after ms'] / table['before ms']
+
+    return(table.round(2))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Times the app\'s data work on synthetic exports')
+    parser.add_argument('--sizes', nargs = '+', default = ['7k', '100k'], help = 'any of ' + ', '.join(synthetic.SIZES))
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--no-memory', action = 'store_true', help = 'skip the tracemalloc run of each case')
+    parser.add_argument('--json', help = 'file to save the results to')
+    parser.add_argument('--compare', help = 'results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    run = {'environment': environment(), 'repeat': args.repeat,
+           'results': runBenchmarks(args.sizes, args.repeat, not args.no_memory)}
+
+    if args.json:
+        with open(args.json, 'w', encoding = 'utf-8') as f:
+            json.dump(run, f, indent = 1)
+
+    if args.compare:
+        with open(args.compare, encoding = 'utf-8') as f:
+            print(compareResults(json.load(f), run).to_string())
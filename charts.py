@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Chart helpers for the Craigslist Used Cars app.
+
+Rendered charts are kept as PNG bytes in a least-recently-used cache with a byte budget,
+keyed by a fingerprint of the data the chart was drawn from together with its kind,
+columns and title, so a chart whose inputs didn't change is never drawn twice.
+
+The charts missing from the cache are drawn in a pool of worker processes shared by the
+whole server, so the charts of a rerun are drawn side by side and the pool size caps how
+many are drawn at once. The drawing functions take plain data (no Streamlit, no globals)
+so they can be sent to the workers.
+
+"""
+
+import hashlib
+import io
+import math
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib.pyplot as plt
+import pandas as pd
+
+
+#total size of the PNGs kept in a figure cache
+FIGURE_BUDGET = 64 * 1024 * 1024
+
+#worker processes drawing charts per server, 0 or 1 draws them on the script thread instead
+RENDER_WORKERS = int(os.environ.get('CARS_RENDER_WORKERS', min(4, os.cpu_count() or 1)))
+
+
+################################## FINGERPRINTS ##################################
+
+# Hashes the given columns of df (values and, with index, row labels) into a short hex string
+
+def dataFingerprint(df, columns, index = True):
+
+    hashes = pd.util.hash_pandas_object(df[columns], index = index)
+
+    return(hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest())
+
+
+# Combines whatever identifies a chart into one cache key
+
+def figureKey(*parts):
+
+    return(hashlib.sha1(repr(parts).encode()).hexdigest())
+
+
+################################## DRAWING ##################################
+
+# A chart with only its title and a note, drawn when there are no listings to chart
+
+def drawEmpty(title):
+
+    fig, ax = plt.subplots()
+
+    ax.text(.5, .5, 'No listings to show', ha = 'center', va = 'center', size = 13, color = 'gray')
+    ax.axis('off')
+    ax.set_title(title, color = 'purple', size = 15)
+
+    return(fig)
+
+
+def drawPie(percentages, labels, column, title, colors):
+
+    if not sum(percentages):
+        return(drawEmpty(title))
+
+    fig1, ax = plt.subplots()
+
+    explode = [0.05 for label in labels]
+
+    ax.pie(percentages,autopct='%1.1f%%', startangle=90, colors = colors, explode = explode)
+
+    ax.legend(labels,
+          title=column.title(),
+          loc="center left",
+          bbox_to_anchor=(1, 0, 0.5, 1))
+
+    ax.axis('equal')
+    ax.set_title(title, color = 'purple', size = 15)
+
+    return(fig1)
+
+
+# data only needs the qual and quant columns, labels are the qual values in drawing order
+
+def drawBoxPlot(data, title, qual, quant, horizontal, labels, colors):
+
+    import seaborn as sns
+
+    if data.empty:
+        return(drawEmpty(title))
+
+    if horizontal == 1:
+        x = quant
+        y = qual
+    else:
+        x= qual
+        y = quant
+
+    fig2, ax2 = plt.subplots()
+
+    data = data.sort_values(by = [qual, quant])
+
+    #order keeps categorical columns from drawing empty boxes for values not in data
+    ax2 = sns.boxplot(x=x, y=y, data=data, palette = colors, order = labels)
+
+    ax2.legend(labels,
+          title=qual.title(),
+          loc="upper left",
+          bbox_to_anchor=(1, 0, 0.5, 1), labelcolor = colors)
+
+    ax2.set_title(title, color = 'purple', size = 15)
+
+    return(fig2)
+
+
+# Draws box plots from precomputed summaries (see aggregates.boxStats) with matplotlib's
+# bxp, so the cost doesn't depend on how many listings are behind each box
+
+def drawBoxSummaries(summaries, title, qual, quant, horizontal, colors):
+
+    if not summaries:
+        return(drawEmpty(title))
+
+    fig2, ax2 = plt.subplots()
+
+    labels = [summary['label'] for summary in summaries]
+
+    boxes = ax2.bxp(summaries, vert = horizontal != 1, patch_artist = True, showfliers = True)
+
+    for patch, color in zip(boxes['boxes'], colors * (len(labels) // len(colors) + 1)):
+        patch.set_facecolor(color)
+
+    for median in boxes['medians']:
+        median.set_color('black')
+
+    if horizontal == 1:
+        ax2.set_xlabel(quant)
+        ax2.set_ylabel(qual)
+        ax2.invert_yaxis() #first label on top, like seaborn
+    else:
+        ax2.set_xlabel(qual)
+        ax2.set_ylabel(quant)
+
+    ax2.legend(boxes['boxes'], labels,
+          title=qual.title(),
+          loc="upper left",
+          bbox_to_anchor=(1, 0, 0.5, 1))
+
+    ax2.set_title(title, color = 'purple', size = 15)
+
+    return(fig2)
+
+
+# Draws grid cells (see mapping.aggregateCells) as a static map for the reports, a circle
+# per cell sized by its number of listings
+
+def drawCells(cells, title, color):
+
+    if cells.empty:
+        return(drawEmpty(title))
+
+    fig3, ax3 = plt.subplots()
+
+    sizes = (400 * cells['count'] / cells['count'].max()).clip(lower = 4)
+
+    ax3.scatter(cells['lon'], cells['lat'], s = sizes, color = color, alpha = .6, edgecolors = 'white')
+
+    #degrees of longitude shrink with the latitude, this keeps the distances about even
+    ax3.set_aspect(1 / math.cos(math.radians(cells['lat'].mean())))
+
+    ax3.set_xlabel('lon')
+    ax3.set_ylabel('lat')
+    ax3.set_title(title, color = 'purple', size = 15)
+
+    return(fig3)
+
+
+################################## RENDERING ##################################
+
+# Renders a matplotlib figure to PNG bytes and closes it
+
+def renderPng(fig):
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format = 'png', bbox_inches = 'tight')
+    plt.close(fig)
+
+    return(buffer.getvalue())
+
+
+################################## CACHE ##################################
+
+# The cache is a dictionary holding the entries in least- to most-recently used order,
+# their total size and a lock, since Streamlit sessions share it across threads
+
+def newCache(budget = FIGURE_BUDGET):
+
+    return({'entries': OrderedDict(), 'bytes': 0, 'budget': budget, 'lock': threading.Lock()})
+
+
+# Returns the cached PNG for key (marking it recently used), or None
+
+def cacheGet(cache, key):
+
+    with cache['lock']:
+        png = cache['entries'].get(key)
+        if png is not None:
+            cache['entries'].move_to_end(key)
+
+    return(png)
+
+
+# Stores a PNG and drops the least recently used ones until the cache fits its budget
+# A PNG bigger than the whole budget is not stored
+
+def cachePut(cache, key, png):
+
+    if len(png) > cache['budget']:
+        return
+
+    with cache['lock']:
+        old = cache['entries'].pop(key, None)
+        if old is not None:
+            cache['bytes'] -= len(old)
+
+        cache['entries'][key] = png
+        cache['bytes'] += len(png)
+
+        while cache['bytes'] > cache['budget']:
+            _, dropped = cache['entries'].popitem(last = False)
+            cache['bytes'] -= len(dropped)
+
+
+################################## SCHEDULING ##################################
+
+# Pool of worker processes for drawing charts, None when RENDER_WORKERS is below 2
+# Workers are spawned rather than forked, forking the threaded Streamlit server isn't safe
+
+def newRenderPool(workers = RENDER_WORKERS):
+
+    if workers < 2:
+        return(None)
+
+    return(ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('spawn')))
+
+
+# Runs in a worker: draws one chart and returns it as PNG bytes
+
+def renderChart(draw, args):
+
+    return(renderPng(draw(*args)))
+
+
+# A chart job is a dictionary with the cache key, the PNG when it was already cached, and
+# otherwise the drawing function and its arguments, which the caller fills in
+# slot is where the chart goes once drawn, e.g. a Streamlit placeholder
+
+def chartJob(cache, key, slot):
+
+    return({'key': key, 'png': cacheGet(cache, key), 'draw': None, 'args': (), 'slot': slot})
+
+
+# Yields (job, png) for every job, the cached ones first and then the others as soon as
+# their worker is done with them. New PNGs are added to the cache
+
+def renderJobs(cache, jobs, pool = None):
+
+    todo = []
+
+    for job in jobs:
+        if job['png'] is not None:
+            yield(job, job['png'])
+        else:
+            todo.append(job)
+
+    if pool is None:
+        finished = ((job, renderChart(job['draw'], job['args'])) for job in todo)
+    else:
+        futures = {pool.submit(renderChart, job['draw'], job['args']): job for job in todo}
+        finished = ((futures[future], future.result()) for future in as_completed(futures))
+
+    for job, png in finished:
+        cachePut(cache, job['key'], png)
+        yield(job, png)
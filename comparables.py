@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Comparable listings for the Craigslist Used Cars app.
+
+For a listing, finds the k most similar listings of the same manufacturer and model by
+year, odometer and price. The three are normalized (centered and divided by their spread
+over the whole dataset) so a year counts about as much as its share of the spread of years
+as a dollar does of prices, and listings are compared by Euclidean distance.
+
+The index is built once per dataset: the listings are grouped by manufacturer and model,
+and each group's normalized features are stored side by side, so a query only computes the
+distances to its own group in one vectorized NumPy pass and picks the nearest with a
+partial sort, instead of scanning the whole frame. Listings without a manufacturer or
+model have no comparables.
+
+Results are row positions in the frame the index was built from, like the bitmap index in
+filters.py and the spatial index in spatial.py.
+
+"""
+
+import numpy as np
+
+from filters import STATE_REGION, US_REGIONS
+
+
+FEATURES = ['year', 'odometer', 'price']
+
+#comparables returned when no other number is asked for
+COMPARABLES = 5
+
+
+################################## BUILDING ##################################
+
+# Builds the index over df
+# Returns a dictionary with the frame's row count, the group (-1 for none) and slot of every
+# row, the first and last slot of every group, the state codes, and per slot the row's
+# position, state (a number into the codes) and normalized features, ordered by group
+
+def buildIndex(df, features = FEATURES):
+
+    values = np.column_stack([df[feature].to_numpy(dtype = 'float64', na_value = np.nan) for feature in features])
+
+    center = np.nanmean(values, axis = 0)
+    spread = np.nanstd(values, axis = 0)
+    spread[~(spread > 0)] = 1
+
+    #a missing value counts as an average one
+    normalized = np.nan_to_num((values - center) / spread, nan = 0)
+
+    groups = df.groupby(['manufacturer', 'model'], observed = True, sort = False).ngroup().to_numpy()
+
+    grouped = np.flatnonzero(groups >= 0)
+    order = grouped[np.argsort(groups[grouped], kind = 'stable')]
+
+    slotGroups = groups[order]
+    count = int(groups.max()) + 1 if len(grouped) else 0
+
+    slots = np.full(len(df), -1, dtype = np.int32)
+    slots[order] = np.arange(len(order))
+
+    codes, states = np.unique(df['state'].astype(str).to_numpy(), return_inverse = True)
+
+    return({'size': len(df), 'groups': groups.astype(np.int32), 'slots': slots,
+            'starts': np.searchsorted(slotGroups, np.arange(count), side = 'left'),
+            'stops': np.searchsorted(slotGroups, np.arange(count), side = 'right'),
+            'codes': codes, 'positions': order.astype(np.int32), 'states': states[order].astype(np.int16),
+            'features': normalized[order].astype(np.float32)})
+
+
+################################## QUERIES ##################################
+
+# The k listings most like the one at position: same manufacturer and model, nearest by
+# normalized year, odometer and price, the listing itself left out. states limits them to
+# listings in those states
+# Returns the positions and distances of the comparables, nearest first
+
+def comparables(index, position, k = COMPARABLES, states = None):
+
+    group = index['groups'][position]
+
+    if group < 0:
+        return(np.array([], dtype = np.int64), np.array([]))
+
+    start, stop = index['starts'][group], index['stops'][group]
+
+    positions = index['positions'][start:stop]
+    features = index['features'][start:stop]
+
+    keep = positions != position
+    if states is not None:
+        #one lookup per listing instead of comparing state names
+        keep &= np.isin(index['codes'], list(states))[index['states'][start:stop]]
+
+    positions = positions[keep]
+    target = index['features'][index['slots'][position]]
+
+    distances = np.sqrt(((features[keep] - target) ** 2).sum(axis = 1))
+
+    if len(distances) > k:
+        nearest = np.argpartition(distances, k - 1)[:k]
+    else:
+        nearest = np.arange(len(distances))
+
+    #nearest first, equally near ones in frame order
+    nearest = nearest[np.lexsort((positions[nearest], distances[nearest]))]
+
+    return(positions[nearest], distances[nearest])
+
+
+# The states the comparables of a listing in state are looked for in: 'state' for its own,
+# 'region' for its US region (see filters.US_REGIONS), anything else for every state
+
+def scopeStates(state, scope):
+
+    if scope == 'state':
+        return([state])
+
+    if scope == 'region' and state in STATE_REGION:
+        return(US_REGIONS[STATE_REGION[state]])
+
+    return(None)
@@ -0,0 +1,840 @@
+# -*- coding: utf-8 -*-
+"""
+Data work of the Craigslist Used Cars app, without Streamlit.
+
+Loading the listings and the structures derived from them, filtering, per-area stats, pie
+shares, box plot summaries and map payloads. Every function takes plain values (frames,
+selections, the dataset handle from datastore or a database from sqlbackend) and returns
+plain values; nothing here reads a widget or draws on the page, so it can be cached,
+batched, run in other processes and benchmarked on its own.
+
+Lannin_FinalProject.py lays the results out on the page and keeps the per-session caching
+to Streamlit; benchmark.py calls these functions directly.
+
+With the sql backend the listings aren't held in memory: functions taking a db query it
+instead of the in-memory frame and indexes, which are passed as None.
+
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import aggregates
+import comparables
+import datastore
+import filters
+import mapping
+import spatial
+import sqlbackend
+import tracing
+
+
+#stores strings as categories and downcasts the numbers, see datastore.compactDtypes
+COMPACT_DTYPES = True
+
+#draws box plots from quartiles, whiskers and a sample of outliers instead of every row
+BOXPLOT_SUMMARIES = True
+
+#de-duplicates the map coordinates once when loading instead of on every rerun
+PRECOMPUTE_MAP_COORDS = True
+
+#columns the check boxes, multiselects and state selection filter on
+FILTER_COLUMNS = ['state', 'fuel', 'drive', 'condition', 'cylinders', 'size', 'paint_color', 'manufacturer']
+
+
+################################## LOADING ##################################
+
+# turns the cleaned listings into the frame the app works with
+# runs once per dataset version, the result is shared read-only by every caller
+
+def prepareData(df):
+
+    if COMPACT_DTYPES:
+        df = datastore.compactDtypes(df)
+
+    if PRECOMPUTE_MAP_COORDS:
+        df = noDupCoors(df)
+
+    #every state and region becomes one block of rows, see partitions
+    df = filters.sortByRegion(df)
+
+    df = abbrevToState(df) #get state names
+
+    return(df)
+
+
+# prepares the winning rows of a delta for the prepared frame df they join, instead of
+# preparing every row again (see datastore.applyDelta): they take df's dtypes, get their
+# coordinates offset past the listings already at the same spot and are spliced into their
+# state's block, where prepareData would have put them
+
+def spliceRows(df, rows):
+
+    rows = abbrevToState(rows)
+
+    df, rows = datastore.matchDtypes(df, rows)
+
+    if 'lat2' in df.columns:
+        rows = offsetCoors(df, rows)
+
+    return(filters.spliceByRegion(df, rows[list(df.columns)]))
+
+
+#the dataset of a file, loaded once per process, see datastore.getDataset
+#its frame is shared: sessions work on datastore.sessionFrame, and only build indexes from the shared one
+
+@tracing.traced('load_dataset')
+def loadDataset(filename):
+
+    return(datastore.getDataset(filename, prepareData))
+
+
+#the structures below are derived from a dataset once per version and kept on its handle
+
+#bitmap index over the dataset's rows
+def filterIndex(dataset):
+
+    return(datastore.datasetPart(dataset, 'filter_index', lambda df: filters.buildBitmaps(df, FILTER_COLUMNS)))
+
+
+#first and last row of every state and region in the dataset's frame
+def partitions(dataset):
+
+    return(datastore.datasetPart(dataset, 'partitions', filters.buildPartitions))
+
+
+#sorted values and counts of the filter columns per state
+def facets(dataset):
+
+    return(datastore.datasetPart(dataset, 'facets', lambda df: filters.buildFacets(df, FILTER_COLUMNS)))
+
+
+#map grid cells for every zoom level drawn aggregated
+def mapLevels(dataset):
+
+    return(datastore.datasetPart(dataset, 'map_levels', mapping.buildLevels))
+
+
+#counts, sums and quantiles for every state, region and category
+def cube(dataset):
+
+    return(datastore.datasetPart(dataset, 'cube', aggregates.buildCube))
+
+
+#names of the states with listings
+def stateNames(dataset):
+
+    return(datastore.datasetPart(dataset, 'state_names', lambda df: tuple(sorted(df['stateName'].dropna().unique()))))
+
+
+#grid over the listings' positions for radius and map viewport queries, see spatial.py
+def spatialIndex(dataset):
+
+    return(datastore.datasetPart(dataset, 'spatial_index', spatial.buildGrid))
+
+
+#listings grouped by make and model with their normalized year, odometer and price, see comparables.py
+def comparablesIndex(dataset):
+
+    return(datastore.datasetPart(dataset, 'comparables', comparables.buildIndex))
+
+
+#the same names from the database of the sql backend
+def sqlStateNames(db):
+
+    states = pd.DataFrame({'state': sqlbackend.distinctValues(db, 'state')})
+
+    return(tuple(sorted(abbrevToState(states)['stateName'].dropna())))
+
+
+#map grid cells for every zoom level drawn aggregated, grouped by the sql backend
+def sqlMapLevels(db):
+
+    return({z: mapping.addRadius(sqlbackend.gridCells(db, mapping.cellSize(z)), mapping.cellSize(z))
+            for z in range(mapping.DETAIL_ZOOM)})
+
+
+#parts of the dataset updated from the changed rows when a delta is applied, instead of
+#being rebuilt from the whole frame, see datastore.applyDelta
+DELTA_UPDATERS = {
+    'partitions': lambda partitions, df, removed, added: filters.updatePartitions(partitions, removed, added),
+    'facets': lambda facets, df, removed, added: filters.updateFacets(facets, removed, added, FILTER_COLUMNS),
+    'cube': aggregates.updateCube,
+}
+
+
+#reloads the data when the source file changed and upserts the delta files in updatesDir
+#that weren't applied yet, into db with the sql backend
+
+def reloadData(filename, updatesDir, db = None):
+
+    if db is not None:
+        db = sqlbackend.refreshListings(db, filename)
+
+        for deltaFile in datastore.deltaFiles(updatesDir):
+            sqlbackend.upsertFile(db, deltaFile)
+
+    else:
+        #the source is hashed (at most) once per reload
+        key = datastore.sourceKey(filename)
+
+        datastore.reloadDataset(filename, prepareData, key)
+
+        for deltaFile in datastore.deltaFiles(updatesDir):
+            datastore.applyDelta(filename, deltaFile, prepareData, DELTA_UPDATERS, key, spliceRows)
+
+
+#bytes per column of the cleaned data with and without the compact dtypes
+def memoryReport(filename):
+
+    df = datastore.loadListings(filename)
+
+    return(datastore.memoryReport(abbrevToState(df), abbrevToState(datastore.compactDtypes(df))))
+
+
+############################### States Mapping ##############################
+
+def abbrevToState(df):
+    # United States of America Python Dictionary to translate States,
+    # Districts & Territories to Two-Letter codes and vice versa.
+    #
+    # https://gist.github.com/rogerallen/1583593
+    #
+    # Dedicated to the public domain.  To the extent possible under law,
+    # Roger Allen has waived all copyright and related or neighboring
+    # rights to this code.
+
+
+    us_state_abbrev = {
+        'Alabama': 'AL',
+        'Alaska': 'AK',
+        'American Samoa': 'AS',
+        'Arizona': 'AZ',
+        'Arkansas': 'AR',
+        'California': 'CA',
+        'Colorado': 'CO',
+        'Connecticut': 'CT',
+        'Delaware': 'DE',
+        'District of Columbia': 'DC',
+        'Florida': 'FL',
+        'Georgia': 'GA',
+        'Guam': 'GU',
+        'Hawaii': 'HI',
+        'Idaho': 'ID',
+        'Illinois': 'IL',
+        'Indiana': 'IN',
+        'Iowa': 'IA',
+        'Kansas': 'KS',
+        'Kentucky': 'KY',
+        'Louisiana': 'LA',
+        'Maine': 'ME',
+        'Maryland': 'MD',
+        'Massachusetts': 'MA',
+        'Michigan': 'MI',
+        'Minnesota': 'MN',
+        'Mississippi': 'MS',
+        'Missouri': 'MO',
+        'Montana': 'MT',
+        'Nebraska': 'NE',
+        'Nevada': 'NV',
+        'New Hampshire': 'NH',
+        'New Jersey': 'NJ',
+        'New Mexico': 'NM',
+        'New York': 'NY',
+        'North Carolina': 'NC',
+        'North Dakota': 'ND',
+        'Northern Mariana Islands':'MP',
+        'Ohio': 'OH',
+        'Oklahoma': 'OK',
+        'Oregon': 'OR',
+        'Pennsylvania': 'PA',
+        'Puerto Rico': 'PR',
+        'Rhode Island': 'RI',
+        'South Carolina': 'SC',
+        'South Dakota': 'SD',
+        'Tennessee': 'TN',
+        'Texas': 'TX',
+        'Utah': 'UT',
+        'Vermont': 'VT',
+        'Virgin Islands': 'VI',
+        'Virginia': 'VA',
+        'Washington': 'WA',
+        'West Virginia': 'WV',
+        'Wisconsin': 'WI',
+        'Wyoming': 'WY'
+    }
+
+    # thank you to @kinghelix and @trevormarburger for this idea
+    abbrev_us_state = dict(map(reversed, us_state_abbrev.items()))
+
+    # with a categorical state column the names are kept as a category lookup
+    # rather than a merged string column
+    stateName = df['state'].map(abbrev_us_state)
+
+    if isinstance(df['state'].dtype, pd.CategoricalDtype):
+        stateName = stateName.astype('category')
+
+    updated_df = df.assign(stateName = stateName)
+
+    return(updated_df)
+
+
+############################### FILTERING #########################################
+
+#This function helps the suer narrow down the possible options for each column
+#It retunrs a sorted list of possibilities
+
+def getChoices(df, column):
+    col = df[column]
+    choices = col.drop_duplicates()
+
+    return(sorted(list(choices)))
+
+
+# the listings of a state, sliced out of df; None with the sql backend (db), which is asked
+# for what the page needs of them instead, see mapCenter and stateName
+
+def stateDf(df, partitions, state, db = None):
+
+    if db is not None:
+        return(None)
+
+    return(filters.partitionView(df, partitions, 'state', state))
+
+
+# full name of a state from its abbreviation
+
+def stateName(state):
+
+    return(str(abbrevToState(pd.DataFrame({'state': [state]}))['stateName'].iloc[0]))
+
+
+# the listings of a region, sliced out of df; None with the sql backend (db), whose region
+# box plot is computed in the database, see boxSummaries
+
+@tracing.traced('regionDf')
+def regionDf(df, partitions, region, db = None):
+
+    if db is not None:
+        return(None)
+
+    return(filters.partitionView(df, partitions, 'region', region))
+
+
+# The choices for a column's check boxes with how many listings each would match
+# baseMask holds the state's rows and the boxes checked in the columns before it, in the
+# bitmap index; with the sql backend (db) applied holds those checked values instead
+# Returns every value the state has, and a dictionary of value -> count
+
+def checkBoxChoices(index, facets, state, column, baseMask = None, db = None, applied = None):
+
+    if db is not None:
+        choices = sqlbackend.distinctValues(db, column, state)
+        counts = dict.fromkeys(choices, 0)
+        counts.update(sqlbackend.facetCounts(db, column, state, applied or {}))
+    else:
+        choices = filters.facetValues(facets, column, state)
+        counts = filters.liveCounts(index, column, choices, baseMask)
+
+    return(choices, counts)
+
+
+# The same for a multiselect: it offers every value the state has too, those no listing under
+# the current selection has with a count of 0, so its options don't change with the other
+# filters
+
+def multiSelectChoices(index, facets, state, column, baseMask = None, db = None, applied = None):
+
+    return(checkBoxChoices(index, facets, state, column, baseMask, db, applied))
+
+
+# Narrows the selection the next column's counts are taken under to the values chosen in
+# column: baseMask in the bitmap index, or applied with the sql backend (db)
+# Returns the new (baseMask, applied)
+
+def narrowSelection(index, column, values, baseMask = None, db = None, applied = None):
+
+    if db is not None:
+        return(baseMask, dict(applied or {}, **{column: values}))
+
+    return(filters.andMasks(baseMask, filters.facetMask(index, column, values)), applied)
+
+
+# Mask of the listings within miles of lat/lon, over the dataset's rows like the bitmap
+# index, found with the grid from spatialIndex (whose row count is all filters.applyMask
+# needs of an index)
+
+def nearMask(grid, lat, lon, miles):
+
+    positions, _ = spatial.radiusPositions(grid, lat, lon, miles)
+
+    return(filters.positionsMask(grid, positions))
+
+
+# The same for the listings inside (south, north, west, east), e.g. the map's viewport
+
+def boundsMask(grid, bounds):
+
+    return(filters.positionsMask(grid, spatial.boundsPositions(grid, bounds)))
+
+
+# the stored values behind the title-cased labels checked in a column
+
+def checkedValues(choices, chosen):
+
+    return([choice for choice in choices if choice.title() in chosen])
+
+
+# the check box selections as values stored in the database, for the sql backend
+
+def checkedSelections(db, state, selectionsDict):
+
+    return({column: checkedValues(sqlbackend.distinctValues(db, column, state), chosen)
+            for column, chosen in selectionsDict.items() if chosen})
+
+
+# Takes user-selected values and a dataframe (usually narrowed down by state)
+# Checks which line items in the data frame are compatible with user selections
+# One takes in values from the checkboxes, the other one takes in values from the multiselectio boxes
+# Both look the selections up in the bitmap index from filterIndex: values checked
+# within a column are OR'd together and the columns are AND'd, see filters.py
+# with the sql backend (db) the same selection is queried for the state instead
+
+@tracing.traced('updatedDf')
+def updatedDf(df, selectionsDict, index, db = None, state = None):
+
+    if db is not None:
+        return(abbrevToState(sqlbackend.listings(db, state, checkedSelections(db, state, selectionsDict))))
+
+    #check box labels are title-cased, nothing checked in a column means no filter on it
+    mask = filters.selectionMask(index, selectionsDict, normalize = str.title)
+
+    final_df = filters.applyMask(df, index, mask)
+
+    return(final_df)
+
+
+
+#checked holds the check box selections from checkedSelections when querying the sql backend
+
+@tracing.traced('updatedDf2')
+def updatedDf2(df, selectionsDict, index, db = None, state = None, checked = None):
+
+    if db is not None:
+        return(abbrevToState(sqlbackend.listings(db, state, dict(checked or {}, **selectionsDict))))
+
+    #multiselects start with everything selected, so an emptied one matches nothing
+    mask = filters.selectionMask(index, selectionsDict, emptyMeansAll = False)
+
+    final_df = filters.applyMask(df, index, mask)
+
+    return(final_df)
+
+############################### FILTER CACHE ######################################
+
+#filtered frames kept per session and their total size, see newFilterCache; every session
+#has its own, so this is multiplied by the number of sessions
+FILTER_CACHE_ENTRIES = 8
+FILTER_CACHE_BYTES = 32 * 1024 * 1024
+
+
+# A least-recently-used cache of one session's filtered frames, keyed by the dataset version,
+# state and widget selections they were filtered with, so a rerun caused by a widget that
+# doesn't filter (the map zoom, View Data, ...) or going back to a recent selection reuses
+# the frames instead of filtering again
+# Holds at most maxEntries frames of at most maxBytes in total. It isn't locked like the
+# figure cache in charts.py: a session runs one rerun at a time
+
+def newFilterCache(maxEntries = FILTER_CACHE_ENTRIES, maxBytes = FILTER_CACHE_BYTES):
+
+    return({'entries': OrderedDict(), 'bytes': 0, 'maxEntries': maxEntries, 'maxBytes': maxBytes})
+
+
+# Turns widget selections into a hashable key that doesn't depend on the order the values
+# were picked in; emptyMeansAll drops the columns with nothing chosen, like updatedDf does
+
+def selectionKey(selectionsDict, emptyMeansAll = True):
+
+    return(tuple(sorted((column, tuple(sorted(map(str, chosen))))
+                        for column, chosen in selectionsDict.items() if chosen or not emptyMeansAll)))
+
+
+def frameBytes(df):
+
+    return(int(df.memory_usage(index = True, deep = True).sum()))
+
+
+# Returns the frame cached under key (marking it recently used), or filters it with
+# compute() and caches it, dropping the least recently used frames over the limits
+# Cached frames are frozen (see datastore.freezeFrame), later reruns get the same object
+# A frame that only views frozen arrays (the shared dataset or a cached frame, when nothing
+# was filtered out) holds no memory of its own and isn't counted against maxBytes
+
+def cachedFrame(cache, key, compute):
+
+    entries = cache['entries']
+
+    if key in entries:
+        entries.move_to_end(key)
+        tracing.count('filter cache hits')
+        return(entries[key][0])
+
+    tracing.count('filter cache misses')
+
+    df = compute()
+    size = 0 if datastore.isFrozen(df) else frameBytes(df)
+
+    df = datastore.freezeFrame(df)
+
+    if size <= cache['maxBytes']:
+        entries[key] = (df, size)
+        cache['bytes'] += size
+
+        while len(entries) > cache['maxEntries'] or cache['bytes'] > cache['maxBytes']:
+            _, (_, dropped) = entries.popitem(last = False)
+            cache['bytes'] -= dropped
+
+    return(df)
+
+############################### DATA VIEW #########################################
+
+#the columns the data view shows until others are picked, in order
+DATA_COLUMNS = ['date', 'stateName', 'region', 'manufacturer', 'model', 'year', 'price', 'odometer',
+                'condition', 'fuel', 'drive', 'cylinders', 'size', 'paint_color', 'title_status', 'transmission', 'VIN']
+
+DATA_PAGE_SIZE = 50
+
+
+# A float per row that sorts like the column: numbers and dates by value, strings and
+# categories alphabetically (not in category order), missing values as inf so they come
+# last whichever way it is sorted
+
+def sortKey(column, ascending = True):
+
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        ranks = column.cat.categories.astype(str).argsort().argsort()
+        codes = column.cat.codes.to_numpy()
+        key = np.where(codes >= 0, ranks[codes], np.nan)
+
+    elif pd.api.types.is_datetime64_any_dtype(column):
+        key = column.to_numpy().view('int64').astype('float64')
+        key[column.isna().to_numpy()] = np.nan
+
+    elif pd.api.types.is_numeric_dtype(column):
+        key = column.to_numpy(dtype = 'float64', na_value = np.nan)
+
+    else:
+        codes, _ = pd.factorize(column, sort = True)
+        key = np.where(codes >= 0, codes, np.nan)
+
+    key = key.astype('float64') if ascending else -key.astype('float64')
+
+    return(np.where(np.isnan(key), np.inf, key))
+
+
+# Positions of the rows start to stop of the order key sorts the rows in, sorting only as
+# much as needed: the first stop keys are picked out with a partition and only those are
+# sorted. Ties keep the frame's order, so the pages line up with a full stable sort
+
+def sortedPositions(key, start, stop):
+
+    stop = min(stop, len(key))
+
+    if start >= stop:
+        return(np.array([], dtype = np.int64))
+
+    if stop < len(key):
+        bound = np.partition(key, stop - 1)[stop - 1]
+        below = np.flatnonzero(key < bound)
+        tied = np.flatnonzero(key == bound)[:stop - len(below)]
+        chosen = np.concatenate([below, tied])
+    else:
+        chosen = np.arange(len(key))
+
+    order = chosen[np.lexsort((chosen, key[chosen]))]
+
+    return(order[start:stop])
+
+
+def pageCount(rows, pageSize = DATA_PAGE_SIZE):
+
+    return(max(1, -(-rows // pageSize)))
+
+
+# One page of the data view: the rows from page * pageSize on, in the order of sortColumn
+# (the frame's order when None), with only the given columns (DATA_COLUMNS by default)
+# Only the page's rows are taken out of df, so only they are styled and sent
+
+def dataPage(df, columns = None, sortColumn = None, ascending = True, page = 0, pageSize = DATA_PAGE_SIZE):
+
+    page = min(max(page, 0), pageCount(len(df), pageSize) - 1)
+    start = page * pageSize
+
+    if sortColumn is None:
+        rows = np.arange(start, min(start + pageSize, len(df)))
+    else:
+        rows = sortedPositions(sortKey(df[sortColumn], ascending), start, start + pageSize)
+
+    columns = [column for column in (columns or DATA_COLUMNS) if column in df.columns]
+
+    return(df.iloc[rows, df.columns.get_indexer(columns)])
+
+
+############################### COMPARABLES #######################################
+
+# The k listings of df most like the one at position, found with index, the comparables
+# index of df, in scope ('state', 'region' or None for every state)
+# Returns their rows (the given columns, DATA_COLUMNS by default) nearest first, with their
+# distance from the listing
+
+@tracing.traced('comparables')
+def comparableListings(df, index, position, k = comparables.COMPARABLES, scope = None, columns = None):
+
+    states = comparables.scopeStates(str(df['state'].iat[position]), scope)
+    positions, distances = comparables.comparables(index, position, k, states)
+
+    columns = [column for column in (columns or DATA_COLUMNS) if column in df.columns]
+
+    rows = df.iloc[positions, df.columns.get_indexer(columns)].copy()
+    rows['distance'] = distances.round(3)
+
+    return(rows)
+
+###################################STATS###########################################
+
+
+#gets the quantitative metrics we want for a specific area (looked up in the aggregate cube
+# from cube, an area is a state, a region of a state, or the whole country by default)
+# then we iterate to repeat this for each one
+
+def getStatsForArea(cube, state = aggregates.ALL, region = aggregates.ALL):
+
+    area = aggregates.areaStats(cube, state, region)
+
+    statDict = {}
+
+    statDict['Sales Count'] = area['count']
+
+    statDict['Mean Price'] = round(aggregates.mean(area, 'price'), 2)
+    statDict['Median Price'] = round(area['price_q50'], 2)
+
+
+
+    statDict['Mean Mileage'] = round(aggregates.mean(area, 'odometer'),2)
+    statDict['Median Mileage'] = round(area['odometer_q50'],2)
+
+
+    statDict['Oldest Car Year'] = area['year_q0']
+    statDict['Newest Car Year'] = area['year_q100']
+    statDict['Median Car Year'] = area['year_q50']
+
+
+    return(statDict)
+
+
+#the same numbers for a row of sqlbackend.stateStats
+
+def getStatsFromQuery(row):
+
+    statDict = {}
+
+    statDict['Sales Count'] = row['count']
+
+    statDict['Mean Price'] = round(row['price_mean'], 2)
+    statDict['Median Price'] = round(row['price_median'], 2)
+
+    statDict['Mean Mileage'] = round(row['odometer_mean'], 2)
+    statDict['Median Mileage'] = round(row['odometer_median'], 2)
+
+    statDict['Oldest Car Year'] = row['year_min']
+    statDict['Newest Car Year'] = row['year_max']
+    statDict['Median Car Year'] = row['year_median']
+
+    return(statDict)
+
+
+#table of stats for a list of states, all states by default (states without listings are left out)
+#one column per state, one row per stat
+#with the sql backend (db) the numbers are aggregated by the database
+
+@tracing.traced('statsTable')
+def statsTable(cube, states = None, db = None):
+
+    byState = {}
+
+    if db is not None:
+        if states is None:
+            states = sqlbackend.distinctValues(db, 'state')
+
+        for state, row in sqlbackend.stateStats(db, states).iterrows():
+            byState[state] = getStatsFromQuery(row)
+
+    else:
+        if states is None:
+            states = aggregates.choices(cube, 'state')
+
+        for state in sorted(states):
+            if aggregates.areaStats(cube, state) is not None:
+                byState[state] = getStatsForArea(cube, state)
+
+    return(pd.DataFrame(byState))
+
+
+################################# Pie Charts ##############################
+
+#gathers percentages to build pie charts based on column and df
+# depending on what we want, we would use state_df or just df (data comes in filtered)
+# the state and national pies are read from the aggregate cube by passing cube (and state),
+# filtered data isn't in the cube so its values are counted in one pass instead
+# with the sql backend (db) the state and national shares are counted by the database
+
+def forPie(df, column, cube = None, state = aggregates.ALL, db = None):
+
+    if db is not None:
+        return(sqlbackend.shares(db, column, None if state == aggregates.ALL else state))
+
+    if cube is not None:
+        return(aggregates.shares(cube, column, state))
+
+    counts = df[column].value_counts()
+    labels = sorted(counts[counts > 0].index)
+
+    percentages = [counts[label]/df.shape[0] for label in labels]
+
+
+    return(percentages, labels)
+
+################################# Box Plots ##############################
+
+# the listings of a box plot, or with the sql backend, which passes no frame, the two
+# columns it needs read from db (for state, the states of region or the whole country)
+
+def boxFrame(df, qual, quant, state = aggregates.ALL, db = None, region = None):
+
+    if df is None:
+        selections = {'state': filters.US_REGIONS[region]} if region else None
+        df = sqlbackend.listings(db, None if state == aggregates.ALL else state, selections, columns = [qual, quant])
+
+    return(df)
+
+
+# The rows of a box plot and the labels of its boxes, the state and national labels come
+# from the aggregate cube when cube (and state) are passed
+# Returns (rows, labels)
+
+def boxRows(df, qual, quant, cube = None, state = aggregates.ALL, db = None, region = None):
+
+    df = boxFrame(df, qual, quant, state, db, region)
+
+    if cube is not None and qual in aggregates.QUAL_COLUMNS:
+        labels = aggregates.choices(cube, qual, state)
+    else:
+        labels = getChoices(df, qual)
+
+    return(df[[qual, quant]], labels)
+
+
+# Per-box summaries (quartiles, whiskers and a sample of outliers) for a box plot, read from
+# the cube for the state and national plots, computed in the database with the sql backend
+# (for state, the states of region or the whole country) and with one groupby otherwise
+
+def boxSummaries(df, qual, quant, cube = None, state = aggregates.ALL, db = None, region = None):
+
+    if cube is not None and qual in aggregates.QUAL_COLUMNS:
+        return(aggregates.boxSummaries(cube, qual, quant, aggregates.choices(cube, qual, state), state))
+
+    if cube is not None and qual == 'state':
+        return(aggregates.stateBoxSummaries(cube, quant, getChoices(boxFrame(df, qual, quant, state, db), qual)))
+
+    if db is not None:
+        selections = {'state': filters.US_REGIONS[region]} if region else None
+        return(sqlbackend.boxSummaries(db, qual, quant, None if state == aggregates.ALL else state, selections))
+
+    return(aggregates.frameBoxSummaries(df, qual, quant))
+
+
+################################## MAP ##################################
+
+#how far apart noDupCoors moves the repeats of a coordinate pair
+COORD_STEP = .0000000001
+
+
+# This dataset had duplicate coordinates in some instances
+# This function adds a tiny value to the coordinates that are duplicates to avoid a pydeck error
+# The lon and lat values are then rounded elsewhere
+# The nth repeat of a coordinate pair is moved by n tiny steps, numbered with a groupby
+# cumcount, so the result is the same on every run and triplicates don't collide either
+
+@tracing.traced('noDupCoors')
+def noDupCoors(df):
+
+    repeat = df.groupby(['lat', 'lon'], sort = False, observed = True).cumcount().to_numpy()
+
+    #offsets are added in float64, they would be lost in the compact float32 columns
+    df1 = df.assign(lat2 = df['lat'].to_numpy(dtype = 'float64') + repeat * COORD_STEP,
+                    lon2 = df['lon'].to_numpy(dtype = 'float64') + repeat * COORD_STEP)
+
+    return(df1)
+
+
+# The same offsets for rows joining df, which noDupCoors already went over: a row at the
+# coordinates of listings in df is moved past the furthest of them, so only the listings
+# sharing a latitude with a new row are looked at
+
+def offsetCoors(df, rows):
+
+    repeat = rows.groupby(['lat', 'lon'], sort = False, observed = True).cumcount().to_numpy()
+
+    near = np.flatnonzero(np.isin(df['lat'].to_numpy(), rows['lat'].to_numpy()))
+
+    if len(near):
+        lat = df['lat'].to_numpy()[near]
+        taken = pd.DataFrame({'lat': lat, 'lon': df['lon'].to_numpy()[near],
+                              'next': np.rint((df['lat2'].to_numpy()[near] - lat.astype('float64')) / COORD_STEP).astype(np.int64) + 1})
+
+        taken = taken.groupby(['lat', 'lon'], as_index = False)['next'].max()
+        repeat = repeat + rows[['lat', 'lon']].merge(taken, how = 'left')['next'].fillna(0).to_numpy(dtype = np.int64)
+
+    return(rows.assign(lat2 = rows['lat'].to_numpy(dtype = 'float64') + repeat * COORD_STEP,
+                       lon2 = rows['lon'].to_numpy(dtype = 'float64') + repeat * COORD_STEP))
+
+
+# where the map is centered for a state's listings, as plain floats (the means of the compact
+# float32 columns would be numpy scalars, which the sql backend can't take as parameters)
+# with the sql backend (db) the mean is taken in the database for state instead
+
+def mapCenter(state_df, db = None, state = None):
+
+    if db is not None:
+        return(sqlbackend.meanPosition(db, state))
+
+    return(float(state_df['lat'].mean()), float(state_df['lon'].mean()))
+
+
+# The records the map layer is sent for a zoom level (and a viewport center at detail zoom)
+# Below mapping.DETAIL_ZOOM these are the precomputed grid cells of levels, from mapLevels
+# or sqlMapLevels, which look the same whichever state is selected; from there on the
+# listings of df (or db) inside the viewport, looked up in grid, the spatial index of df,
+# when it is passed
+# Returns the records and whether they are grid cells
+
+def mapRecords(z, lat = None, lon = None, levels = None, df = None, db = None, grid = None):
+
+    if z < mapping.DETAIL_ZOOM:
+        return(mapping.cellRecords(levels[z]), True)
+
+    bounds = mapping.viewportBounds(lat, lon, z)
+
+    if db is not None:
+        df = abbrevToState(sqlbackend.listingsInBounds(db, bounds))
+    elif grid is not None:
+        df = df.iloc[spatial.boundsPositions(grid, bounds)]
+    else:
+        df = mapping.pointsInView(df, bounds)
+
+    if 'lat2' not in df.columns:
+        df =  noDupCoors(df) #creating coordinates without duplicates to allow the program to map them
+
+    return(mapping.pointRecords(df), False)
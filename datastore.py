@@ -0,0 +1,640 @@
+# -*- coding: utf-8 -*-
+"""
+Data loading helpers for the Craigslist Used Cars app.
+
+The cleaned listings frame is written to a columnar (Parquet) cache on disk, keyed by
+the hash and modification time of the source file, so later cold starts read the cache
+instead of parsing the spreadsheet and cleaning it again.
+
+New or updated postings arrive as delta files, which are normalized on their own and
+upserted by VIN (the newest posting_date wins). Each applied delta is kept next to the
+cache and replayed on load, so a refresh only has to read and clean the delta.
+
+Once loaded, the listings are held in one read-only dataset handle per process that every
+Streamlit session shares without copying or hashing it. The handle carries the version of
+the data, and whatever is derived from the frame (indexes, aggregates) is built once per
+version and kept on the handle. reloadDataset swaps in a new handle when the source file
+changed; sessions still holding the old one keep a consistent view until their next rerun.
+The new handle is built without holding the lock getDataset takes, so sessions aren't held
+up while the data is reloaded.
+
+"""
+
+import hashlib
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+SOURCE_COLUMNS = ['Unnamed: 0', 'id', 'url', 'region', 'region_url', 'price', 'year',
+       'manufacturer', 'model', 'condition', 'cylinders', 'fuel', 'odometer',
+       'title_status', 'transmission', 'VIN', 'drive', 'size', 'category',
+       'paint_color', 'image_url', 'description', 'state', 'lat', 'lon',
+       'posting_date']
+
+CACHE_DIR = '.listings_cache'
+
+
+#the columns the app uses, OK to drop 'id' because VIN is a unique identifier
+KEEP_COLUMNS = ['region', 'price', 'year', 'manufacturer', 'model', 'condition', 'cylinders',
+       'fuel', 'odometer', 'title_status', 'transmission', 'VIN', 'drive', 'size', 'category',
+       'paint_color', 'state', 'lat', 'lon', 'posting_date']
+
+STRING_COLUMNS = ['region', 'manufacturer', 'model', 'condition', 'cylinders', 'fuel',
+       'title_status', 'transmission', 'VIN', 'drive', 'size', 'category', 'paint_color',
+       'state', 'posting_date']
+
+# the national vehicles export names a couple of columns differently from the sample
+COLUMN_ALIASES = {'type': 'category', 'long': 'lon'}
+
+CHUNK_SIZE = 50000
+
+
+################################## CLEANING ##################################
+
+# Gives a raw frame the column names the app uses. Exports that already carry the
+# expected names are renamed through COLUMN_ALIASES, the sample spreadsheet is renamed
+# by position like it always was
+
+def renameColumns(df):
+
+    renamed = df.rename(columns = COLUMN_ALIASES)
+
+    if set(KEEP_COLUMNS) <= set(renamed.columns):
+        return(renamed)
+
+    df.columns = SOURCE_COLUMNS
+
+    return(df)
+
+
+# Applies the app's clean up to one chunk of listings using vectorized calls only:
+# drop incomplete rows, title-case regions, upper-case states, strip the timezone
+# offset from posting_date and parse it into a datetime
+
+def normalizeChunk(df):
+
+    df = df[KEEP_COLUMNS].dropna()
+
+    df = df.astype({'price': 'int64', 'year': 'int64', 'odometer': 'float64',
+                    'lat': 'float64', 'lon': 'float64'})
+
+    df['region'] = df['region'].str.title()
+
+    df['state'] = df['state'].str.upper()
+
+    #add datetime component, the local posting time is kept and the utc offset dropped
+    df['posting_date'] = df['posting_date'].astype(str).str.replace(r'(Z|[+-]\d{2}:?\d{2})$', '', regex = True)
+    df['DTstr'] = df['posting_date'].astype('string')
+
+    df['date'] = pd.to_datetime(df['posting_date'], format = "%Y-%m-%dT%H:%M:%S", errors = 'coerce')
+
+    df = df.dropna(subset = ['date'])
+
+    return(df.reset_index(drop = True))
+
+
+def cleanData(df):
+
+    return(normalizeChunk(renameColumns(df)))
+
+
+################################## INGEST ##################################
+
+# Yields the raw listings of a CSV or Excel source in chunks of at most chunksize rows.
+# CSV files are only parsed one chunk at a time and only for the columns the app keeps.
+# .xlsx files are streamed row by row through openpyxl; xlrd cannot stream legacy .xls
+# files, so those are read once and then handed out in slices
+
+def readChunks(filename, chunksize = CHUNK_SIZE):
+
+    name = filename.lower()
+
+    if name.endswith(('.csv', '.csv.gz', '.csv.bz2', '.csv.zip')):
+        raw = pd.read_csv(filename, nrows = 0)
+        names = dict(zip(raw.columns, renameColumns(raw.copy()).columns))
+        usecols = [col for col in raw.columns if names[col] in KEEP_COLUMNS]
+        dtypes = {col: str for col in usecols if names[col] in STRING_COLUMNS}
+
+        for chunk in pd.read_csv(filename, usecols = usecols, dtype = dtypes, chunksize = chunksize):
+            yield chunk.rename(columns = names)
+
+    elif name.endswith('.xlsx'):
+        import openpyxl
+
+        book = openpyxl.load_workbook(filename, read_only = True)
+        rows = book.active.iter_rows(values_only = True)
+        header = next(rows)
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == chunksize:
+                yield renameColumns(pd.DataFrame(batch, columns = header))
+                batch = []
+        if batch:
+            yield renameColumns(pd.DataFrame(batch, columns = header))
+
+        book.close()
+
+    else:
+        df = renameColumns(pd.read_excel(filename))
+
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize].copy()
+
+
+# Normalizes a source chunk by chunk and streams the chunks into a Parquet file at path,
+# so peak memory while ingesting is one chunk rather than the whole raw export.
+# Returns the cleaned frame read back from that file. Without pyarrow the chunks are
+# simply concatenated in memory and path is left untouched
+
+def ingestFile(filename, path = None, chunksize = CHUNK_SIZE):
+
+    chunks = (normalizeChunk(chunk) for chunk in readChunks(filename, chunksize))
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        pa = None
+
+    if pa is None or path is None:
+        return(pd.concat(list(chunks), ignore_index = True))
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    tmp = path + '.tmp'
+    writer = None
+
+    for chunk in chunks:
+        if writer is None:
+            table = pa.Table.from_pandas(chunk, preserve_index = False)
+            writer = pq.ParquetWriter(tmp, table.schema)
+        else:
+            table = pa.Table.from_pandas(chunk, schema = writer.schema, preserve_index = False)
+        writer.write_table(table)
+
+    if writer is None:
+        return(normalizeChunk(pd.DataFrame(columns = KEEP_COLUMNS)))
+
+    writer.close()
+    os.replace(tmp, path)
+    removeStaleCaches(path)
+
+    return(pd.read_parquet(path))
+
+
+################################## CACHE ##################################
+
+#keys of the files hashed by this process: path -> (size, mtime, key)
+SOURCE_KEYS = {}
+
+
+# Builds the cache key for a source file out of a hash of its contents and its mtime,
+# so an edited or replaced file never serves a stale cache
+# A file whose size and mtime didn't change since this process hashed it isn't read again
+
+def sourceKey(filename):
+
+    stat = os.stat(filename)
+    known = SOURCE_KEYS.get(os.path.abspath(filename))
+
+    if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+        return(known[2])
+
+    digest = hashlib.sha1()
+
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    key = f'{digest.hexdigest()[:16]}-{stat.st_mtime_ns}'
+    SOURCE_KEYS[os.path.abspath(filename)] = (stat.st_size, stat.st_mtime_ns, key)
+
+    return(key)
+
+
+def cachePath(filename, key, cacheDir = CACHE_DIR):
+
+    base = os.path.splitext(os.path.basename(filename))[0]
+
+    return(os.path.join(cacheDir, f'{base}-{key}.parquet'))
+
+
+# Returns the cached frame, or None when there is no usable cache file
+
+def readCache(path):
+
+    if not os.path.exists(path):
+        return(None)
+
+    try:
+        return(pd.read_parquet(path))
+    except (ImportError, OSError, ValueError):
+        return(None)
+
+
+# Writes the frame to a temporary file first and renames it into place so a reader
+# never sees a half written cache. Older cache files for the same source are removed.
+# Returns False when no Parquet engine is installed, in which case nothing is cached
+
+def writeCache(df, path):
+
+    cacheDir = os.path.dirname(path) or '.'
+    os.makedirs(cacheDir, exist_ok = True)
+
+    tmp = path + '.tmp'
+
+    try:
+        df.to_parquet(tmp, index = False)
+    except ImportError:
+        return(False)
+
+    os.replace(tmp, path)
+    removeStaleCaches(path)
+
+    return(True)
+
+
+# Removes cache files (and applied deltas) written for older versions of the same source
+# file: names of the exact form <base>-<16 hex digits>-<mtime> (plus the delta suffix) whose
+# key differs from path's. Caches of other sources are left alone, even when their base
+# name starts with this one's (listings and listings-2020)
+
+def removeStaleCaches(path):
+
+    cacheDir = os.path.dirname(path) or '.'
+    base, key = re.fullmatch(r'(.*)-([0-9a-f]{16}-\d+)\.parquet', os.path.basename(path)).groups()
+
+    pattern = re.compile(re.escape(base) + r'-([0-9a-f]{16}-\d+)(-delta-\d{4}-[0-9a-f]{16}-\d+)?\.parquet')
+
+    for name in os.listdir(cacheDir):
+        match = pattern.fullmatch(name)
+        if match and match.group(1) != key:
+            os.remove(os.path.join(cacheDir, name))
+
+
+# Loads the cleaned listings for a CSV or Excel source file, serving them from the cache
+# when the file has not changed since the cache was written
+# key is the source's key when the caller already has it, see sourceKey
+
+def loadListings(filename, cacheDir = CACHE_DIR, key = None):
+
+    path = cachePath(filename, key or sourceKey(filename), cacheDir)
+
+    df = readCache(path)
+
+    if df is None:
+        df = ingestFile(filename, path)
+
+    for deltaPath in storedDeltas(path):
+        stale, winners = upsertRows(df, pd.read_parquet(deltaPath))
+        df = pd.concat([df[~stale], winners], ignore_index = True)
+
+    return(df)
+
+
+################################## DELTAS ##################################
+
+# Reads a delta file of new or updated postings (same layout as the source) and applies
+# the same clean up, keeping only the newest posting of each VIN
+
+def readDelta(deltaFile, chunksize = CHUNK_SIZE):
+
+    chunks = [normalizeChunk(chunk) for chunk in readChunks(deltaFile, chunksize)]
+    delta = pd.concat(chunks, ignore_index = True) if chunks else normalizeChunk(pd.DataFrame(columns = KEEP_COLUMNS))
+
+    delta = delta.sort_values('date', kind = 'stable').drop_duplicates('VIN', keep = 'last')
+
+    return(delta.reset_index(drop = True))
+
+
+# Works out what upserting delta into df changes, VIN being the key
+# A delta row wins unless df has a newer posting of its VIN; every df row of a winning VIN
+# is stale. Returns (boolean array of stale df rows, winning delta rows)
+
+def upsertRows(df, delta):
+
+    vins = df['VIN'].astype(str).to_numpy()
+    hit = pd.Series(vins).isin(delta['VIN']).to_numpy()
+
+    #newest stored posting of each delta VIN, NaT for the new ones (reindex keeps the dates'
+    #dtype even when no VIN is stored yet, where map would fall back to float)
+    newest = pd.Series(df['date'].to_numpy()[hit]).groupby(vins[hit]).max()
+    current = pd.Series(newest.reindex(delta['VIN'].astype(str)).to_numpy(dtype = delta['date'].dtype), index = delta.index)
+
+    winners = delta[current.isna() | (delta['date'] >= current)]
+
+    stale = hit & pd.Series(vins).isin(winners['VIN']).to_numpy()
+
+    return(stale, winners)
+
+
+# Applied deltas of the source cached at path, in the order they were applied
+
+def storedDeltas(path):
+
+    cacheDir = os.path.dirname(path) or '.'
+    current = os.path.basename(path)[:-len('.parquet')] + '-delta-'
+
+    if not os.path.isdir(cacheDir):
+        return([])
+
+    return([os.path.join(cacheDir, name) for name in sorted(os.listdir(cacheDir))
+            if name.startswith(current) and name.endswith('.parquet')])
+
+
+# Keeps the winning rows of a delta next to the source's cache, numbered in order and
+# named after the delta file's key so the same delta is never applied twice
+
+def writeDelta(path, deltaKey, winners):
+
+    n = len(storedDeltas(path)) + 1
+    deltaPath = path[:-len('.parquet')] + f'-delta-{n:04d}-{deltaKey}.parquet'
+
+    tmp = deltaPath + '.tmp'
+    winners.to_parquet(tmp, index = False)
+    os.replace(tmp, deltaPath)
+
+    return(deltaPath)
+
+
+def isApplied(path, deltaKey):
+
+    return(any(name.endswith(f'-{deltaKey}.parquet') for name in storedDeltas(path)))
+
+
+# Version of the data for a source: its key plus the number of deltas applied on top
+
+def datasetVersion(filename, cacheDir = CACHE_DIR, key = None):
+
+    key = key or sourceKey(filename)
+    deltas = len(storedDeltas(cachePath(filename, key, cacheDir)))
+
+    return(f'{key}+{deltas}' if deltas else key)
+
+
+# Delta files waiting in a folder, oldest name first
+
+def deltaFiles(folder):
+
+    if not os.path.isdir(folder):
+        return([])
+
+    return([os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if name.lower().endswith(('.csv', '.csv.gz', '.xls', '.xlsx'))])
+
+
+################################## COMPACT DTYPES ##################################
+
+# a string column becomes categorical when it has at most this many distinct values per row
+CATEGORY_RATIO = 0.5
+
+INT_COLUMNS = ['price', 'year']
+FLOAT_COLUMNS = ['odometer', 'lat', 'lon']
+
+
+# Returns a copy of the cleaned listings using less memory: low-cardinality string
+# columns become categoricals, price and year the smallest integer type that holds
+# them, and odometer, lat and lon float32
+
+def compactDtypes(df):
+
+    df = df.copy()
+
+    for col in STRING_COLUMNS:
+        if col in df.columns and df[col].nunique() <= CATEGORY_RATIO * len(df):
+            df[col] = df[col].astype('category')
+
+    for col in INT_COLUMNS:
+        df[col] = pd.to_numeric(df[col], downcast = 'integer')
+
+    for col in FLOAT_COLUMNS:
+        df[col] = pd.to_numeric(df[col], downcast = 'float')
+
+    return(df)
+
+
+# Gives rows joining the compacted frame df the same dtypes, widening a column of both where
+# a value of rows doesn't fit: categoricals get the union of the categories and numbers the
+# wider of the two types (df is only recast in that case). Columns rows lacks are skipped
+# Returns (df, rows)
+
+def matchDtypes(df, rows):
+
+    for col in df.columns.intersection(rows.columns):
+        dtype = df[col].dtype
+
+        if isinstance(dtype, pd.CategoricalDtype):
+            categories = dtype.categories.union(pd.Index(rows[col].dropna().unique()))
+            if len(categories) > len(dtype.categories):
+                df = df.assign(**{col: df[col].cat.set_categories(categories)})
+            rows = rows.assign(**{col: pd.Categorical(rows[col], categories = df[col].cat.categories)})
+
+        elif pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+            downcast = 'integer' if pd.api.types.is_integer_dtype(dtype) else 'float'
+            wider = np.promote_types(dtype, pd.to_numeric(rows[col], downcast = downcast).dtype)
+            if wider != dtype:
+                df = df.astype({col: wider})
+            rows = rows.astype({col: wider})
+
+    return(df, rows)
+
+
+# Compares the memory used by each column of two versions of the same frame
+# Returns a table of bytes per column before and after, with a total row at the bottom
+
+def memoryReport(before, after):
+
+    report = pd.DataFrame({
+        'dtype': after.dtypes.astype(str),
+        'Bytes Before': before.memory_usage(index = False, deep = True),
+        'Bytes After': after.memory_usage(index = False, deep = True),
+    })
+
+    report.loc['Total'] = ['', report['Bytes Before'].sum(), report['Bytes After'].sum()]
+
+    report['Saved %'] = (100 * (1 - report['Bytes After'] / report['Bytes Before'])).round(1)
+
+    return(report)
+
+
+################################## SHARED DATASET ##################################
+
+#loaded datasets of this process by source file
+DATASETS = {}
+DATASETS_LOCK = threading.Lock()
+
+#reloads and deltas of the shared datasets run one at a time
+RELOAD_LOCK = threading.Lock()
+
+
+# Makes the frame's column arrays read-only so writing into the shared values (df.loc[...] = x,
+# writing through .to_numpy(), ...) raises instead of changing the data for everyone
+# This doesn't stop changes to the frame itself (inplace=True, adding or dropping columns),
+# which is why every session gets its own shallow copy, see sessionFrame
+# pandas doesn't offer this publicly, so the block arrays are reached through _mgr
+
+def freezeFrame(df):
+
+    for block in getattr(df._mgr, 'blocks', ()):
+        values = getattr(block.values, '_codes', block.values)
+        if hasattr(values, 'flags'):
+            values.flags.writeable = False
+
+    return(df)
+
+
+# Whether df's column arrays are all frozen ones, i.e. df is the shared frame or a slice of
+# it (a partition, a session's shallow copy) rather than a frame of its own
+
+def isFrozen(df):
+
+    arrays = [getattr(block.values, '_codes', block.values) for block in getattr(df._mgr, 'blocks', ())]
+    arrays = [values for values in arrays if hasattr(values, 'flags')]
+
+    return(bool(arrays) and not any(values.flags.writeable for values in arrays))
+
+
+# A dataset handle for a frozen frame: 'parts' holds what was built from the frame, each
+# under its own lock in 'locks' so one slow build doesn't hold up the others; 'lock' only
+# guards 'locks'
+
+def datasetHandle(filename, version, df):
+
+    return({'filename': filename, 'version': version, 'df': df, 'parts': {}, 'locks': {}, 'lock': threading.Lock()})
+
+
+def newDataset(filename, prepare, key = None):
+
+    key = key or sourceKey(filename)
+    version = datasetVersion(filename, key = key)
+
+    df = freezeFrame(prepare(loadListings(filename, key = key)))
+
+    return(datasetHandle(filename, version, df))
+
+
+# A session's own frame over the dataset's arrays: a shallow copy shares the (read-only)
+# values without copying them, while sorting, resetting the index or adding columns in place
+# only changes the session's frame, never the shared one the indexes are built on
+
+def sessionFrame(dataset):
+
+    return(dataset['df'].copy(deep = False))
+
+
+# Returns the shared dataset handle for a source file, loading it on first use
+# prepare turns the cleaned listings into the frame the app works with (dtypes, sort
+# order, extra columns); the result is frozen with freezeFrame
+# The handle is a dictionary with 'version', 'df' and the derived 'parts', see datasetHandle
+
+def getDataset(filename, prepare):
+
+    with DATASETS_LOCK:
+        if filename not in DATASETS:
+            DATASETS[filename] = newDataset(filename, prepare)
+
+        return(DATASETS[filename])
+
+
+# Loads the source file again if it changed since the handle was made and makes the new
+# data the shared dataset. key is the source's key when the caller already has it
+# The new handle is built outside DATASETS_LOCK and swapped in at the end
+# Returns the current handle
+
+def reloadDataset(filename, prepare, key = None):
+
+    key = key or sourceKey(filename)
+
+    with RELOAD_LOCK:
+        with DATASETS_LOCK:
+            current = DATASETS.get(filename)
+
+        if current is not None and current['version'] == datasetVersion(filename, key = key):
+            return(current)
+
+        dataset = newDataset(filename, prepare, key)
+
+        with DATASETS_LOCK:
+            DATASETS[filename] = dataset
+
+        return(dataset)
+
+
+# Upserts a delta file into the shared dataset of a source file and stores it with the
+# cache, so only the delta is read and cleaned, and makes the result a new handle
+# splice(kept, winners) returns the new frame from the prepared kept rows and the cleaned
+# winning ones, so only the winners are prepared; without it every row is prepared again
+# updaters maps the name of a part to update(part, df, removed, added), which returns the
+# part for the new frame df given the prepared rows that left and joined it; parts without
+# an updater are rebuilt when next asked for. A delta applied before is skipped
+# key is the source's key when the caller already has it; like reloadDataset, the new
+# handle is built outside DATASETS_LOCK
+# Returns the current handle
+
+def applyDelta(filename, deltaFile, prepare, updaters = None, key = None, splice = None):
+
+    key = key or sourceKey(filename)
+    path = cachePath(filename, key)
+    deltaKey = sourceKey(deltaFile)
+
+    with RELOAD_LOCK:
+        current = getDataset(filename, prepare)
+
+        if isApplied(path, deltaKey):
+            return(current)
+
+        delta = readDelta(deltaFile)
+
+        old = current['df']
+        stale, winners = upsertRows(old, delta)
+
+        if splice is None:
+            df = prepare(pd.concat([old.loc[~stale, list(winners.columns)], winners], ignore_index = True))
+        else:
+            df = splice(old[~stale].reset_index(drop = True), winners)
+
+        df = freezeFrame(df)
+
+        writeDelta(path, deltaKey, winners)
+
+        removed = old[stale]
+        added = df[df['VIN'].astype(str).isin(winners['VIN'])]
+
+        dataset = datasetHandle(filename, datasetVersion(filename, key = key), df)
+
+        #parts still being built on the old handle are left for the new one to build
+        for name, part in list(current['parts'].items()):
+            if name in (updaters or {}):
+                dataset['parts'][name] = updaters[name](part, df, removed, added)
+
+        with DATASETS_LOCK:
+            DATASETS[filename] = dataset
+
+        return(dataset)
+
+
+# Returns something derived from the dataset's frame, building it with build(df) the first
+# time it is asked for under this name and keeping it on the handle afterwards
+# A built part is returned without taking a lock (parts are only ever added to the handle);
+# a part being built holds up the callers asking for that part only
+
+def datasetPart(dataset, name, build):
+
+    parts = dataset['parts']
+
+    if name in parts:
+        return(parts[name])
+
+    with dataset['lock']:
+        lock = dataset['locks'].setdefault(name, threading.Lock())
+
+    with lock:
+        if name not in parts:
+            parts[name] = build(dataset['df'])
+
+        return(parts[name])
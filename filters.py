@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Filtering helpers for the Craigslist Used Cars app.
+
+Every (column, value) pair of the listings gets a bitmap (a packed boolean array with one
+bit per row), built once per dataset. A selection is then answered with bitwise
+operations: OR across the chosen values of a column and AND across columns, and the
+filtered frame is materialized once at the end.
+
+The bitmaps refer to rows by position in the frame they were built from, so frames passed
+to applyMask must keep that frame's default RangeIndex labels (plain boolean slices do).
+
+The listings are sorted by US region and state when they are loaded, so every state and
+every region is one contiguous block of rows, and their frames are plain iloc slices
+found through the partition table instead of boolean scans.
+
+The facet index holds the sorted values of each column per state (and for the whole
+country) with their counts, so building the filter widgets is a dictionary lookup. Live
+counts for the current selection come from counting the set bits of the bitmaps. When
+postings are upserted the new rows are spliced into their state's block, and the facet
+counts and the partitions are updated from the changed rows alone.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from aggregates import ALL
+
+
+#states in each region of the United States, in the order the region check boxes are shown
+US_REGIONS = {
+    'Western': ['WA', 'ID', 'MT', 'CO', 'UT', 'NV', 'OR', 'CA', 'WY', 'AK', 'HI'],
+    'Midwestern': ['ND', 'SD', 'NE', 'KS', 'MN', 'IA', 'MO', 'WI', 'IL', 'IN', 'OH', 'MI'],
+    'Southwestern': ['AZ', 'NM', 'OK', 'TX'],
+    'Southeastern': ['AR', 'LA', 'MS', 'AL', 'TN', 'KY', 'GA', 'FL', 'SC', 'NC', 'VA', 'WV'],
+    'Northeastern': ['ME', 'NH', 'MA', 'VT', 'NY', 'NJ', 'PA', 'DE', 'MD', 'CT', 'RI'],
+}
+
+STATE_REGION = {state: region for region, states in US_REGIONS.items() for state in states}
+
+#number of set bits in each possible byte
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype = np.int64)
+
+
+################################## BUILDING ##################################
+
+# Builds the bitmap index for the given columns of df
+# Returns a dictionary with the row count and, for each column, a dictionary of value -> bitmap
+
+def buildBitmaps(df, columns):
+
+    bitmaps = {}
+
+    for column in columns:
+        codes, values = pd.factorize(df[column], sort = True)
+        bitmaps[column] = {value: np.packbits(codes == k) for k, value in enumerate(values)}
+
+    return({'size': len(df), 'bitmaps': bitmaps})
+
+
+# Builds the facet index: (state, column) -> {value: count} ordered by value, with ALL
+# as the state for the whole country (the state column itself is only indexed for ALL)
+
+def buildFacets(df, columns):
+
+    facets = {}
+
+    for column in columns:
+        counts = df[column].value_counts()
+        facets[(ALL, column)] = {value: int(counts[value]) for value in sorted(counts[counts > 0].index)}
+
+        if column == 'state':
+            continue
+
+        byState = df.groupby(['state', column], observed = True).size()
+        for (state, value), count in sorted(byState.items()):
+            if count > 0:
+                facets.setdefault((state, column), {})[value] = int(count)
+
+    return(facets)
+
+
+# Updates a facet index after rows were removed from and added to the listings, by taking
+# the counts of those rows off and on again, so the cost depends on the delta only
+# Returns the new index, without the values no listing has any more
+
+def updateFacets(facets, removed, added, columns):
+
+    facets = {key: dict(counts) for key, counts in facets.items()}
+
+    for rows, sign in ((removed, -1), (added, 1)):
+        for key, counts in buildFacets(rows, columns).items():
+            current = facets.setdefault(key, {})
+            for value, count in counts.items():
+                current[value] = current.get(value, 0) + sign * count
+
+    updated = {}
+
+    for key, counts in facets.items():
+        counts = {value: count for value, count in sorted(counts.items()) if count > 0}
+        if counts:
+            updated[key] = counts
+
+    return(updated)
+
+
+# Sorted values of a column within a state, or the whole country
+
+def facetValues(facets, column, state = ALL):
+
+    return(list(facets.get((state, column), {})))
+
+
+################################## PARTITIONS ##################################
+
+# Sort key of each of the sorted distinct states: the rank of its US region (in US_REGIONS
+# order, states outside every region last), then the state itself
+
+def stateKeys(states):
+
+    ranks = {region: rank for rank, region in enumerate(US_REGIONS)}
+    stateRanks = np.array([ranks.get(STATE_REGION.get(state), len(ranks)) for state in states], dtype = np.int64)
+
+    return(stateRanks * len(states) + np.arange(len(states)))
+
+
+# Sorts the listings by US region and then by state, keeping the original order within a
+# state, and renumbers the rows
+
+def sortByRegion(df):
+
+    #ranked once per distinct state, then looked up for every row by its code
+    codes, states = pd.factorize(df['state'], sort = True, use_na_sentinel = False)
+
+    order = np.argsort(stateKeys(states)[codes], kind = 'stable')
+
+    return(df.take(order).reset_index(drop = True))
+
+
+# Adds rows to a frame sorted by sortByRegion without sorting it again: each row goes at the
+# end of its state's block, where sortByRegion of the two concatenated would put it
+
+def spliceByRegion(df, rows):
+
+    _, states = pd.factorize(pd.concat([df['state'].drop_duplicates(), rows['state']]), sort = True, use_na_sentinel = False)
+    keys = stateKeys(states)
+
+    if isinstance(df['state'].dtype, pd.CategoricalDtype):
+        dfKeys = keys[states.get_indexer(df['state'].cat.categories)][df['state'].cat.codes.to_numpy()]
+    else:
+        dfKeys = keys[states.get_indexer(df['state'])]
+
+    rowKeys = keys[states.get_indexer(rows['state'])]
+    rowOrder = np.argsort(rowKeys, kind = 'stable')
+
+    at = np.searchsorted(dfKeys, rowKeys[rowOrder], side = 'right')
+    order = np.insert(np.arange(len(df)), at, len(df) + rowOrder)
+
+    return(pd.concat([df, rows], ignore_index = True).take(order).reset_index(drop = True))
+
+
+# The block of rows of every state and every region from the states' (state, start, stop)
+# in row order
+
+def blockPartitions(blocks):
+
+    partitions = {'state': {}, 'region': {}}
+
+    for state, start, stop in blocks:
+        partitions['state'][state] = (int(start), int(stop))
+
+        region = STATE_REGION.get(state)
+        if region is not None:
+            first, last = partitions['region'].get(region, (int(start), int(stop)))
+            partitions['region'][region] = (min(first, int(start)), max(last, int(stop)))
+
+    return(partitions)
+
+
+# Finds the block of rows of every state and every region in a frame sorted by sortByRegion
+# Returns {'state': {state: (start, stop)}, 'region': {region: (start, stop)}}
+
+def buildPartitions(df):
+
+    state = df['state'].astype(str).to_numpy()
+
+    starts = np.flatnonzero(np.r_[True, state[1:] != state[:-1]])
+    stops = np.r_[starts[1:], len(state)]
+
+    return(blockPartitions((state[start], start, stop) for start, stop in zip(starts, stops)))
+
+
+# Updates the partitions after rows were removed from and added to the listings (added ones
+# spliced in by spliceByRegion), from the change in each state's row count
+# Returns the new partitions
+
+def updatePartitions(partitions, removed, added):
+
+    counts = {state: stop - start for state, (start, stop) in partitions['state'].items()}
+
+    for rows, sign in ((removed, -1), (added, 1)):
+        for state, count in rows['state'].astype(str).value_counts().items():
+            counts[state] = counts.get(state, 0) + sign * int(count)
+
+    states = sorted(state for state, count in counts.items() if count > 0)
+    blocks = [states[k] for k in np.argsort(stateKeys(states))]
+
+    sizes = np.array([counts[state] for state in blocks], dtype = np.int64)
+    stops = np.cumsum(sizes)
+
+    return(blockPartitions(zip(blocks, stops - sizes, stops)))
+
+
+# The rows of one state or region (kind is 'state' or 'region') as a slice of df
+
+def partitionView(df, partitions, kind, name):
+
+    start, stop = partitions[kind].get(name, (0, 0))
+
+    return(df.iloc[start:stop])
+
+
+################################## SELECTING ##################################
+
+# ORs together the bitmaps of every value of a column the user selected
+# normalize is applied to the stored values before comparing, e.g. str.title for the
+# check boxes whose labels are title-cased
+
+def facetMask(index, column, chosen, normalize = None):
+
+    mask = np.zeros((index['size'] + 7) // 8, dtype = np.uint8)
+    chosen = set(chosen)
+
+    for value, bits in index['bitmaps'][column].items():
+        label = normalize(value) if normalize else value
+        if label in chosen:
+            mask |= bits
+
+    return(mask)
+
+
+# ANDs together the facet masks of every column in selectionsDict
+# With emptyMeansAll a column with nothing selected does not filter at all (check boxes),
+# otherwise it matches nothing (multiselects, where everything starts selected)
+# Returns None when the selection does not restrict anything
+
+def selectionMask(index, selectionsDict, normalize = None, emptyMeansAll = True):
+
+    mask = None
+
+    for column, chosen in selectionsDict.items():
+
+        if not chosen and emptyMeansAll:
+            continue
+
+        facet = facetMask(index, column, chosen, normalize)
+        mask = facet if mask is None else mask & facet
+
+    return(mask)
+
+
+# Mask of the rows at the given positions, e.g. the listings a spatial query found
+
+def positionsMask(index, positions):
+
+    bits = np.zeros(index['size'], dtype = bool)
+    bits[positions] = True
+
+    return(np.packbits(bits))
+
+
+# ANDs two masks where None stands for "every row"
+
+def andMasks(mask, other):
+
+    if mask is None:
+        return(other)
+    if other is None:
+        return(mask)
+
+    return(mask & other)
+
+
+def countBits(mask):
+
+    return(int(POPCOUNT[mask].sum()))
+
+
+# Number of rows with each of values in column that are also set in baseMask (None for
+# every row), i.e. the counts the column's values would have under the current selection
+
+def liveCounts(index, column, values, baseMask = None):
+
+    counts = {}
+
+    for value in values:
+        bits = index['bitmaps'][column][value]
+        counts[value] = countBits(bits if baseMask is None else bits & baseMask)
+
+    return(counts)
+
+
+# Materializes the rows of df whose bit is set in mask, in a single slice
+
+def applyMask(df, index, mask):
+
+    if mask is None:
+        return(df)
+
+    keep = np.unpackbits(mask, count = index['size']).astype(bool)
+
+    return(df[keep[df.index.to_numpy()]])
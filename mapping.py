@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Map helpers for the Craigslist Used Cars app.
+
+At low zoom the listings are drawn as aggregated grid cells (count and median price per
+cell) precomputed once for every zoom level below DETAIL_ZOOM. From DETAIL_ZOOM on the
+map switches to individual listings, but only the ones inside the viewport around the
+selected state.
+
+"""
+
+import json
+import math
+
+import numpy as np
+
+
+#first zoom level at which individual listings are drawn
+DETAIL_ZOOM = 7
+
+#grid cells across one 256 pixel map tile, i.e. a cell is roughly 32 pixels wide
+CELLS_PER_TILE = 8
+
+#approximate size in pixels of the map in the page, used to work out the viewport
+VIEW_WIDTH = 1200
+VIEW_HEIGHT = 500
+
+METERS_PER_DEGREE = 111320
+
+
+################################## GRID CELLS ##################################
+
+# Size in degrees of a grid cell at a zoom level, halving with every zoom step like the
+# map tiles do
+
+def cellSize(zoom):
+
+    return(360 / (2 ** zoom) / CELLS_PER_TILE)
+
+
+# Bins the listings into a lat/lon grid for one zoom level
+# Returns one row per non-empty cell with its count, median price, the mean position of
+# its listings and its radius
+
+def aggregateCells(df, zoom):
+
+    size = cellSize(zoom)
+
+    cellRow = np.floor(df['lat'].to_numpy(dtype = 'float64') / size).astype(np.int64)
+    cellCol = np.floor(df['lon'].to_numpy(dtype = 'float64') / size).astype(np.int64)
+
+    grouped = df.assign(cell_row = cellRow, cell_col = cellCol).groupby(['cell_row', 'cell_col'], sort = False)
+
+    cells = grouped.agg(count = ('price', 'size'),
+                        median_price = ('price', 'median'),
+                        lat = ('lat', 'mean'),
+                        lon = ('lon', 'mean')).reset_index()
+
+    return(addRadius(cells, size))
+
+
+# Gives every cell of a level a radius (in meters) growing with its count
+
+def addRadius(cells, size):
+
+    share = np.sqrt(cells['count'] / cells['count'].max())
+    cells['radius'] = size * METERS_PER_DEGREE / 2 * share.clip(lower = .2)
+
+    return(cells)
+
+
+# Precomputes the grid cells of every zoom level that is drawn aggregated
+# Returns a dictionary of zoom level -> cells frame
+
+def buildLevels(df, detailZoom = DETAIL_ZOOM):
+
+    return({zoom: aggregateCells(df, zoom) for zoom in range(detailZoom)})
+
+
+################################## VIEWPORT ##################################
+
+# Approximate (south, north, west, east) bounds of a map of VIEW_WIDTH by VIEW_HEIGHT
+# pixels centered on lat/lon. A 256 pixel tile spans 360 / 2^zoom degrees of longitude,
+# and latitude degrees shrink with cos(lat) on the web mercator projection
+
+def viewportBounds(lat, lon, zoom, width = VIEW_WIDTH, height = VIEW_HEIGHT):
+
+    degreesPerPixel = 360 / (2 ** zoom) / 256
+
+    halfLon = degreesPerPixel * width / 2
+    halfLat = degreesPerPixel * height / 2 * math.cos(math.radians(lat))
+
+    return(lat - halfLat, lat + halfLat, lon - halfLon, lon + halfLon)
+
+
+# Keeps the listings inside the bounds returned by viewportBounds
+
+def pointsInView(df, bounds):
+
+    south, north, west, east = bounds
+
+    lat = df['lat'].to_numpy()
+    lon = df['lon'].to_numpy()
+
+    return(df[(lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)])
+
+
+################################## PAYLOAD ##################################
+
+#the only listing columns the map tooltip shows
+TOOLTIP_COLUMNS = ['region', 'stateName', 'year', 'price', 'manufacturer', 'model', 'date']
+
+CELL_COLUMNS = ['lon', 'lat', 'radius', 'count', 'median_price']
+
+
+# Turns listings into the records the map layer is sent: the de-duped position plus the
+# tooltip columns, with categoricals as plain strings and the date pre-formatted
+
+def pointRecords(df):
+
+    points = df[TOOLTIP_COLUMNS].astype({'region': object, 'stateName': object, 'manufacturer': object, 'model': object})
+    points = points.fillna({'stateName': ''})
+
+    points['date'] = df['date'].dt.strftime('%Y-%m-%d %H:%M')
+    points['lon'] = df['lon2'].to_numpy(dtype = 'float64')
+    points['lat'] = df['lat2'].to_numpy(dtype = 'float64')
+
+    return(points.to_dict(orient = 'records'))
+
+
+# Turns grid cells into layer records, rounded since the map can't show more precision
+# (float32 means are widened first, they would otherwise print as long decimals)
+
+def cellRecords(cells):
+
+    cells = cells[CELL_COLUMNS].astype({'lon': 'float64', 'lat': 'float64'}).round({'lon': 4, 'lat': 4, 'radius': 0, 'median_price': 0})
+
+    return(cells.to_dict(orient = 'records'))
+
+
+# Size in bytes of layer records once serialized, roughly what the browser is sent
+
+def payloadBytes(records):
+
+    return(len(json.dumps(records, default = str)))
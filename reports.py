@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Static reports for the Craigslist Used Cars app.
+
+Builds a report bundle for every state and every US region: an HTML page with the stats
+table, pie charts, box plots and a map embedded as PNG images, and a JSON file with the
+stats, so snapshots can be published without clicking through the page one state at a
+time. The numbers come from core.py and the charts are drawn with charts.py, the same
+functions the page uses.
+
+The data work (stats, pie shares, box plot summaries, map cells) is read from the
+aggregate cube and the partition slices in this process, which is quick; drawing the
+charts and writing the files is what takes the time, and is fanned out across a pool of
+worker processes, one report per task.
+
+Every report is recorded in a manifest with a fingerprint of the rows it was built from,
+so a rerun only rebuilds the states and regions whose listings changed:
+
+    python reports.py --file cl_used_cars_7000_sample.xls --out reports --workers 4
+
+"""
+
+import argparse
+import base64
+import html
+import json
+import os
+import time
+from concurrent.futures import as_completed
+
+import pandas as pd
+import seaborn as sns
+
+import aggregates
+import charts
+import core
+import filters
+import mapping
+
+
+REPORT_DIR = 'reports'
+
+#part of every report's fingerprint, changing it rebuilds all reports with the new layout
+REPORT_VERSION = 1
+
+#worker processes drawing the reports, 0 or 1 draws them in this process instead
+REPORT_WORKERS = os.cpu_count() or 1
+
+#columns a pie chart is drawn for, and the (qual, quant) pairs drawn as box plots
+PIE_COLUMNS = ['fuel', 'drive', 'condition', 'size']
+BOX_PLOTS = [('drive', 'price'), ('condition', 'price'), ('drive', 'odometer')]
+
+#zoom level of the grid cells drawn on the map of each kind of report, see mapping.cellSize
+MAP_ZOOM = {'state': 7, 'region': 5}
+
+#the color of the map circles on the page
+MAP_COLOR = '#ff8c00'
+
+#the columns a report is drawn from, a report is rebuilt when any of them changes
+REPORT_COLUMNS = ['state', 'region', 'price', 'odometer', 'year', 'lat', 'lon'] + aggregates.QUAL_COLUMNS
+
+MANIFEST = 'manifest.json'
+
+
+################################## CONTENT ##################################
+
+# Names reports are stored under
+
+def reportName(kind, name):
+
+    return(f'{kind}-{name}')
+
+
+# Identifies the rows a report is built from, by value only (the row labels of a state
+# shift when the states before it change), so an unchanged state keeps its fingerprint
+
+def areaFingerprint(area_df):
+
+    return(charts.figureKey(REPORT_VERSION, charts.dataFingerprint(area_df, REPORT_COLUMNS, index = False)))
+
+
+# Everything a worker needs to write one report: the stats, the tables and the chart jobs
+# as (drawing function, arguments) pairs, all plain values that can be sent to a process
+# state reports read the cube; the stats table has a column per craigslist region
+
+def stateReport(state_df, cube, state):
+
+    colors = sns.color_palette('flare')
+    stateName = str(state_df['stateName'].iloc[0])
+
+    regions = {region: core.getStatsForArea(cube, state, region) for region in aggregates.choices(cube, 'region', state)}
+
+    draws = []
+
+    for column in PIE_COLUMNS:
+        percentages, labels = core.forPie(state_df, column, cube, state)
+        draws.append((charts.drawPie, (percentages, labels, column, f'{column.title()} in {stateName}', colors)))
+
+    for qual, quant in BOX_PLOTS:
+        summaries = core.boxSummaries(state_df, qual, quant, cube, state)
+        draws.append((charts.drawBoxSummaries, (summaries, f'Distribution of {quant} by {qual} in {stateName}', qual, quant, 0, colors)))
+
+    cells = mapping.aggregateCells(state_df, MAP_ZOOM['state'])
+    draws.append((charts.drawCells, (cells, f'Listings in {stateName}', MAP_COLOR)))
+
+    return({'kind': 'state', 'name': state, 'title': stateName,
+            'stats': core.getStatsForArea(cube, state), 'table': pd.DataFrame(regions), 'draws': draws})
+
+
+# The same for a US region, whose stats table has a column per state; the region's pie
+# shares aren't in the cube and are counted from its rows
+
+def regionReport(region_df, cube, region):
+
+    colors = sns.color_palette('flare')
+    title = f'{region} United States'
+
+    states = aggregates.choices(cube, 'state')
+    table = core.statsTable(cube, [state for state in filters.US_REGIONS[region] if state in states])
+
+    draws = []
+
+    for column in PIE_COLUMNS:
+        percentages, labels = core.forPie(region_df, column)
+        draws.append((charts.drawPie, (percentages, labels, column, f'{column.title()} in the {title}', colors)))
+
+    for quant in ['price', 'odometer']:
+        summaries = core.boxSummaries(region_df, 'state', quant, cube)
+        draws.append((charts.drawBoxSummaries, (summaries, f'Distribution of {quant} by state in the {title}', 'state', quant, 1, colors)))
+
+    cells = mapping.aggregateCells(region_df, MAP_ZOOM['region'])
+    draws.append((charts.drawCells, (cells, f'Listings in the {title}', MAP_COLOR)))
+
+    return({'kind': 'region', 'name': region, 'title': title,
+            'stats': None, 'table': table, 'draws': draws})
+
+
+################################## WRITING ##################################
+
+# numpy numbers in the stats become plain JSON numbers
+
+def jsonValue(value):
+
+    return(value.item() if hasattr(value, 'item') else str(value))
+
+
+def reportHtml(report, pngs):
+
+    images = '\n'.join(f'<img src="data:image/png;base64,{base64.b64encode(png).decode()}">' for png in pngs)
+
+    table = report['table'].to_html(float_format = '{:.0f}'.format)
+
+    return(f"""<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{html.escape(report['title'])} - Craigslist Cars</title>
+<style>body {{font-family: sans-serif; margin: 2em}} img {{max-width: 48%; margin: .5%}} td, th {{padding: 0 .5em; text-align: right}}</style>
+</head>
+<body>
+<h1>Cars Sales on Craigslist: {html.escape(report['title'])}</h1>
+{table}
+{images}
+</body>
+</html>
+""")
+
+
+# Runs in a worker: draws the charts of a report and writes its HTML and JSON files
+# Returns the report's name and the seconds it took
+
+def writeReport(report, folder):
+
+    start = time.perf_counter()
+
+    pngs = [charts.renderChart(draw, args) for draw, args in report['draws']]
+
+    path = os.path.join(folder, reportName(report['kind'], report['name']))
+
+    with open(path + '.html', 'w', encoding = 'utf-8') as f:
+        f.write(reportHtml(report, pngs))
+
+    with open(path + '.json', 'w', encoding = 'utf-8') as f:
+        json.dump({'kind': report['kind'], 'name': report['name'], 'title': report['title'],
+                   'stats': report['stats'], 'table': report['table'].to_dict()}, f, indent = 1, default = jsonValue)
+
+    return(reportName(report['kind'], report['name']), time.perf_counter() - start)
+
+
+def readManifest(folder):
+
+    try:
+        with open(os.path.join(folder, MANIFEST), encoding = 'utf-8') as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return({})
+
+
+def writeManifest(folder, manifest):
+
+    with open(os.path.join(folder, MANIFEST), 'w', encoding = 'utf-8') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+
+
+# A page linking every report in the folder
+
+def writeIndex(folder, manifest):
+
+    links = '\n'.join(f'<li><a href="{name}.html">{name}</a></li>' for name in sorted(manifest))
+
+    with open(os.path.join(folder, 'index.html'), 'w', encoding = 'utf-8') as f:
+        f.write(f'<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>Craigslist Cars reports</title></head>\n'
+                f'<body>\n<h1>Craigslist Cars reports</h1>\n<ul>\n{links}\n</ul>\n</body>\n</html>\n')
+
+
+def isCurrent(folder, manifest, name, fingerprint):
+
+    return(manifest.get(name) == fingerprint
+           and all(os.path.exists(os.path.join(folder, name + ext)) for ext in ('.html', '.json')))
+
+
+################################## BATCH ##################################
+
+# Builds the reports of every state and region of a file's listings (or only the given
+# states, and the regions they are in) into folder, skipping the ones whose rows didn't
+# change since they were last built unless force is set
+# Returns a summary with the reports built and skipped, the seconds taken and the
+# throughput in states per second
+
+def buildReports(filename, folder = REPORT_DIR, workers = REPORT_WORKERS, states = None, force = False):
+
+    start = time.perf_counter()
+
+    dataset = core.loadDataset(filename)
+    df = dataset['df']
+    partitions = core.partitions(dataset)
+    cube = core.cube(dataset)
+
+    os.makedirs(folder, exist_ok = True)
+    manifest = {} if force else readManifest(folder)
+
+    areas = [('state', state) for state in partitions['state'] if states is None or state in states]
+    areas += [('region', region) for region in partitions['region']
+              if states is None or set(filters.US_REGIONS[region]) & set(states)]
+
+    reports = []
+    fingerprints = {}
+
+    for kind, name in areas:
+        area_df = filters.partitionView(df, partitions, kind, name)
+        fingerprint = areaFingerprint(area_df)
+
+        if not force and isCurrent(folder, manifest, reportName(kind, name), fingerprint):
+            continue
+
+        fingerprints[reportName(kind, name)] = fingerprint
+        reports.append(stateReport(area_df, cube, name) if kind == 'state' else regionReport(area_df, cube, name))
+
+    pool = charts.newRenderPool(workers)
+
+    try:
+        if pool is None:
+            finished = (writeReport(report, folder) for report in reports)
+        else:
+            futures = [pool.submit(writeReport, report, folder) for report in reports]
+            finished = (future.result() for future in as_completed(futures))
+
+        for name, seconds in finished:
+            manifest[name] = fingerprints[name]
+            print(f'{name:<24} {seconds:6.2f} s', flush = True)
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        writeManifest(folder, manifest)
+
+    writeIndex(folder, manifest)
+
+    seconds = time.perf_counter() - start
+    built = sum(report['kind'] == 'state' for report in reports)
+
+    return({'states built': built, 'regions built': len(reports) - built,
+            'skipped': len(areas) - len(reports), 'seconds': seconds,
+            'states per second': built / seconds if built else None})
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Writes an HTML and JSON report for every state and region')
+    parser.add_argument('--file', default = 'cl_used_cars_7000_sample.xls', help = 'listings export, as the page loads it')
+    parser.add_argument('--out', default = REPORT_DIR, help = 'folder the reports are written to')
+    parser.add_argument('--workers', type = int, default = REPORT_WORKERS)
+    parser.add_argument('--states', nargs = '+', help = 'only these states (and their regions)')
+    parser.add_argument('--force', action = 'store_true', help = 'rebuild reports whose data didn\'t change')
+    args = parser.parse_args()
+
+    summary = buildReports(args.file, args.out, args.workers, args.states, args.force)
+
+    rate = summary['states per second']
+    print(f"{summary['states built']} states and {summary['regions built']} regions built, {summary['skipped']} unchanged, "
+          f"{summary['seconds']:.1f} s" + ('' if rate is None else f', {rate:.2f} states/s'))
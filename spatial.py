@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial index for the Craigslist Used Cars app.
+
+The listings are bucketed into a grid of CELL_DEGREES by CELL_DEGREES cells, built once per
+dataset. The rows are stored grouped by cell, with the cells numbered row by row across the
+globe, so the occupied cells of one grid row that overlap a bounding box hold one contiguous
+run of rows, found with two binary searches. A bounding box query takes two searches per
+grid row it spans and then only looks at the listings of the cells it overlaps, instead of
+scanning every listing; a radius query is the bounding box of the circle, refined with the
+great-circle (haversine) distance.
+
+Queries return row positions in the frame the grid was built from, the same numbering the
+bitmap index in filters.py uses, so results can be turned into a mask and combined with
+the check box and multiselect selections.
+
+"""
+
+import math
+
+import numpy as np
+
+
+CELL_DEGREES = .25
+
+EARTH_MILES = 3958.8
+
+MILES_PER_DEGREE = 2 * math.pi * EARTH_MILES / 360
+
+
+################################## BUILDING ##################################
+
+# Number of each lat/lon's grid cell, counted row by row from the south-west corner
+
+def cellIds(lat, lon, cell = CELL_DEGREES):
+
+    columns = math.ceil(360 / cell)
+
+    row = np.floor((np.asarray(lat, dtype = 'float64') + 90) / cell).astype(np.int64)
+    column = np.floor((np.asarray(lon, dtype = 'float64') + 180) / cell).astype(np.int64)
+
+    return(row * columns + column)
+
+
+# Builds the grid over the lat and lon columns of df, leaving out listings without a position
+# Returns a dictionary with the cell size, the frame's row count, and the positions, cell
+# numbers and coordinates of the located rows ordered by cell
+
+def buildGrid(df, cell = CELL_DEGREES):
+
+    lat = df['lat'].to_numpy(dtype = 'float64')
+    lon = df['lon'].to_numpy(dtype = 'float64')
+
+    located = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    ids = cellIds(lat[located], lon[located], cell)
+
+    order = np.argsort(ids, kind = 'stable')
+    positions = located[order]
+
+    return({'cell': cell, 'size': len(df), 'positions': positions.astype(np.int32), 'ids': ids[order].astype(np.int32),
+            'lat': lat[positions].astype(np.float32), 'lon': lon[positions].astype(np.float32)})
+
+
+################################## QUERIES ##################################
+
+# Indexes into the grid's arrays of the listings inside (south, north, west, east), ordered
+# by cell
+
+def boundsCandidates(grid, bounds):
+
+    south, north, west, east = bounds
+    cell = grid['cell']
+    columns = math.ceil(360 / cell)
+
+    first = max(0, math.floor((south + 90) / cell))
+    last = min(math.ceil(180 / cell) - 1, math.floor((north + 90) / cell))
+    left = max(0, math.floor((west + 180) / cell))
+    right = min(columns - 1, math.floor((east + 180) / cell))
+
+    if first > last or left > right:
+        return(np.array([], dtype = np.int64))
+
+    #in the dtype of the cell numbers, searchsorted would otherwise convert all of them
+    rows = np.arange(first, last + 1, dtype = grid['ids'].dtype) * columns
+
+    starts = np.searchsorted(grid['ids'], rows + left, side = 'left')
+    stops = np.searchsorted(grid['ids'], rows + right, side = 'right')
+
+    #the runs of every grid row laid end to end
+    lengths = stops - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    candidates = offsets + np.arange(lengths.sum())
+
+    lat = grid['lat'][candidates]
+    lon = grid['lon'][candidates]
+
+    return(candidates[(lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)])
+
+
+# Row positions of the listings inside the bounds, in frame order
+
+def boundsPositions(grid, bounds):
+
+    return(np.sort(grid['positions'][boundsCandidates(grid, bounds)]))
+
+
+# Great-circle distance in miles between lat/lon pairs
+
+def haversine(lat1, lon1, lat2, lon2):
+
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype = 'float64')) for value in (lat1, lon1, lat2, lon2))
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return(2 * EARTH_MILES * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+# Bounds around a circle: a degree of longitude shrinks with the latitude, so the widest
+# point of the circle is taken on its side away from the equator
+
+def radiusBounds(lat, lon, miles):
+
+    latDegrees = miles / MILES_PER_DEGREE
+    widest = min(89.9, abs(lat) + latDegrees)
+    lonDegrees = min(180, latDegrees / math.cos(math.radians(widest)))
+
+    return(lat - latDegrees, lat + latDegrees, lon - lonDegrees, lon + lonDegrees)
+
+
+# Row positions (in frame order) and distances of the listings within miles of lat/lon
+
+def radiusPositions(grid, lat, lon, miles):
+
+    candidates = boundsCandidates(grid, radiusBounds(lat, lon, miles))
+
+    distances = haversine(lat, lon, grid['lat'][candidates], grid['lon'][candidates])
+    inside = distances <= miles
+
+    positions = grid['positions'][candidates[inside]]
+    order = np.argsort(positions)
+
+    return(positions[order], distances[inside][order])
@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+"""
+Embedded SQL backend for the Craigslist Used Cars app.
+
+For listing archives too big to hold as a pandas frame, the cleaned listings are
+streamed chunk by chunk into a local database file and the app's selections and
+aggregations are pushed down to it as queries, so only result-sized frames come back.
+DuckDB is used when it is installed, SQLite (which ships with Python) otherwise; the
+queries are written to run on both.
+
+The pandas frame stays the default backend. compareWithFrame runs the same questions
+against a frame and a database and lists every answer that differs.
+
+"""
+
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+import aggregates
+import datastore
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+ENGINE = 'duckdb' if duckdb is not None else 'sqlite'
+
+DB_DIR = datastore.CACHE_DIR
+
+#columns the where clauses may name, anything else is refused
+COLUMNS = set(datastore.KEEP_COLUMNS)
+
+#columns with an index in SQLite, DuckDB doesn't need them for these scans
+INDEXED_COLUMNS = ['state', 'fuel', 'drive', 'condition', 'cylinders', 'size', 'paint_color', 'manufacturer']
+
+
+################################## CONNECTION ##################################
+
+# A database is a dictionary with its engine, connection and a lock; Streamlit sessions
+# run on different threads and both engines want one query on a connection at a time
+
+def connect(path, engine = ENGINE):
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+
+    if engine == 'duckdb':
+        con = duckdb.connect(path)
+    else:
+        con = sqlite3.connect(path, check_same_thread = False)
+
+    return({'engine': engine, 'path': path, 'con': con, 'lock': threading.Lock()})
+
+
+def query(db, sql, params = ()):
+
+    with db['lock']:
+        if db['engine'] == 'duckdb':
+            result = db['con'].execute(sql, list(params)).df()
+        else:
+            result = pd.read_sql_query(sql, db['con'], params = list(params))
+
+    if 'date' in result.columns:
+        result['date'] = pd.to_datetime(result['date'])
+
+    return(result)
+
+
+def execute(db, sql, params = ()):
+
+    with db['lock']:
+        db['con'].execute(sql, list(params))
+        if db['engine'] == 'sqlite':
+            db['con'].commit()
+
+
+# Runs statements in one transaction, so queries never see the changes half done
+
+def transaction(db, statements):
+
+    with db['lock']:
+        con = db['con']
+        con.execute('BEGIN TRANSACTION')
+        try:
+            for sql, params in statements:
+                con.execute(sql, list(params))
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+        con.execute('COMMIT')
+
+
+################################## STORING ##################################
+
+# Appends a chunk of cleaned listings to a table, creating it on the first chunk
+
+def appendChunk(db, chunk, create = False, table = 'listings'):
+
+    chunk = chunk.astype({col: object for col in chunk.columns if isinstance(chunk[col].dtype, pd.CategoricalDtype)})
+
+    with db['lock']:
+        if db['engine'] == 'duckdb':
+            db['con'].register('chunk', chunk)
+            if create:
+                db['con'].execute(f'CREATE OR REPLACE TABLE {table} AS SELECT * FROM chunk')
+            else:
+                db['con'].execute(f'INSERT INTO {table} SELECT * FROM chunk')
+            db['con'].unregister('chunk')
+        else:
+            chunk.to_sql(table, db['con'], if_exists = 'replace' if create else 'append', index = False)
+            db['con'].commit()
+
+
+# Swaps the freshly stored table in for the old one and records the source version in one
+# transaction, so sessions querying during a reload see the old listings until the new ones
+# are complete, and never a moment without a listings table
+
+def finishStore(db, version):
+
+    statements = [('CREATE TABLE IF NOT EXISTS meta (version TEXT)', []),
+                  ('DROP TABLE IF EXISTS listings', []),
+                  ('ALTER TABLE listings_new RENAME TO listings', [])]
+
+    if db['engine'] == 'sqlite':
+        statements += [(f'CREATE INDEX IF NOT EXISTS listings_{column} ON listings ({column})', []) for column in INDEXED_COLUMNS + ['VIN']]
+
+    transaction(db, statements + [('DELETE FROM meta', []), ('INSERT INTO meta VALUES (?)', [version])])
+
+
+# Streams a CSV or Excel source into the database one normalized chunk at a time, so the
+# whole export is never in memory at once
+
+def storeFile(db, filename, version, chunksize = datastore.CHUNK_SIZE):
+
+    create = True
+
+    for chunk in datastore.readChunks(filename, chunksize):
+        appendChunk(db, datastore.normalizeChunk(chunk), create, 'listings_new')
+        create = False
+
+    if create:
+        appendChunk(db, datastore.normalizeChunk(pd.DataFrame(columns = datastore.KEEP_COLUMNS)), create, 'listings_new')
+
+    finishStore(db, version)
+
+
+def storedVersion(db):
+
+    try:
+        return(query(db, 'SELECT version FROM meta')['version'].iloc[0])
+    except Exception:
+        return(None)
+
+
+# (Re)loads the database from a source file when the file changed since it was stored
+# The stored version is the source's key followed by the keys of the deltas upserted since
+
+def refreshListings(db, filename):
+
+    version = datastore.sourceKey(filename)
+    stored = storedVersion(db)
+
+    if stored is None or stored.split('+')[0] != version:
+        storeFile(db, filename, version)
+        stored = version
+
+    db['version'] = stored
+
+    return(db)
+
+
+# Upserts a delta file of new or updated postings by VIN, like datastore.applyDelta: a
+# delta row replaces every stored posting of its VIN unless one of them is newer
+# Only the delta is read and cleaned, and one applied before is skipped
+
+def upsertFile(db, deltaFile):
+
+    deltaKey = datastore.sourceKey(deltaFile)
+
+    if deltaKey in (db.get('version') or '').split('+')[1:]:
+        return(db)
+
+    appendChunk(db, datastore.readDelta(deltaFile), True, 'delta')
+
+    version = f"{db['version']}+{deltaKey}"
+
+    transaction(db, [
+        ('DELETE FROM delta WHERE EXISTS (SELECT 1 FROM listings WHERE listings.VIN = delta.VIN AND listings.date > delta.date)', []),
+        ('DELETE FROM listings WHERE VIN IN (SELECT VIN FROM delta)', []),
+        ('INSERT INTO listings SELECT * FROM delta', []),
+        ('DELETE FROM meta', []),
+        ('INSERT INTO meta VALUES (?)', [version]),
+    ])
+
+    execute(db, 'DROP TABLE delta')
+
+    db['version'] = version
+
+    return(db)
+
+
+# Opens the database for a source file, named after the source like the Parquet cache
+
+def openListings(filename, engine = ENGINE, dbDir = DB_DIR):
+
+    base = os.path.splitext(os.path.basename(filename))[0]
+
+    db = connect(os.path.join(dbDir, f'{base}.{engine}'), engine)
+
+    return(refreshListings(db, filename))
+
+
+################################## QUERIES ##################################
+
+# Builds the where clause for a state (None for every state) and a selection
+# selections maps a column to the values to keep: None doesn't filter the column and an
+# empty list keeps nothing, values within a column are OR'd and the columns AND'd
+# Returns the clause and its parameters
+
+def whereClause(state = None, selections = None):
+
+    conditions = []
+    params = []
+
+    if state is not None:
+        conditions.append('state = ?')
+        params.append(state)
+
+    for column, values in (selections or {}).items():
+
+        if column not in COLUMNS:
+            raise ValueError(f'Unknown column {column!r}')
+
+        if values is None:
+            continue
+
+        if not values:
+            conditions.append('1 = 0')
+        else:
+            conditions.append(f'{column} IN ({", ".join("?" * len(values))})')
+            params.extend(values)
+
+    if not conditions:
+        return('', params)
+
+    return('WHERE ' + ' AND '.join(conditions), params)
+
+
+# The listings of a state matching a selection, with all or only the given columns
+
+def listings(db, state = None, selections = None, columns = None):
+
+    where, params = whereClause(state, selections)
+    select = ', '.join(col for col in columns if col in COLUMNS or col in ('DTstr', 'date')) if columns else '*'
+
+    return(query(db, f'SELECT {select} FROM listings {where}', params))
+
+
+# Number of listings with each value of a column under a selection, ordered by value
+
+def facetCounts(db, column, state = None, selections = None):
+
+    if column not in COLUMNS:
+        raise ValueError(f'Unknown column {column!r}')
+
+    where, params = whereClause(state, selections)
+    counts = query(db, f'SELECT {column} AS value, COUNT(*) AS n FROM listings {where} GROUP BY {column} ORDER BY {column}', params)
+
+    return({value: int(n) for value, n in zip(counts['value'], counts['n'])})
+
+
+def distinctValues(db, column, state = None):
+
+    return(list(facetCounts(db, column, state)))
+
+
+# Mean position of the listings of a state (or every listing), as plain floats
+
+def meanPosition(db, state = None):
+
+    where, params = whereClause(state)
+    center = query(db, f'SELECT AVG(lat) AS lat, AVG(lon) AS lon FROM listings {where}', params)
+
+    return(float(center['lat'].iloc[0]), float(center['lon'].iloc[0]))
+
+
+# Share of the selected listings taken by each value of a column, as the pie charts use
+
+def shares(db, column, state = None, selections = None):
+
+    counts = facetCounts(db, column, state, selections)
+    total = sum(counts.values())
+
+    return([count / total for count in counts.values()], list(counts))
+
+
+# Median of a column per group, in SQL both engines run: rank the values within each group
+# and average the middle one or two (the integer arithmetic avoids / meaning different
+# things to DuckDB and SQLite)
+
+def medianQuery(column, groups, source):
+
+    keys = ', '.join(groups)
+
+    return(f"""SELECT {keys}, AVG({column}) AS median FROM (
+                   SELECT {keys}, {column},
+                          ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY {column}) AS rn,
+                          COUNT(*) OVER (PARTITION BY {keys}) AS n
+                   FROM {source}) AS ranked
+               WHERE rn IN ((n + 1 - (n + 1) % 2) / 2, (n + 2 - (n + 2) % 2) / 2)
+               GROUP BY {keys}""")
+
+
+# The numbers statsByState shows for each of a list of states
+# Returns a frame indexed by state
+
+def stateStats(db, states):
+
+    where, params = whereClause(selections = {'state': list(states)})
+    source = f'(SELECT * FROM listings {where}) AS area'
+
+    totals = query(db, f"""SELECT state, COUNT(*) AS count, AVG(price) AS price_mean, AVG(odometer) AS odometer_mean,
+                                  MIN(year) AS year_min, MAX(year) AS year_max
+                           FROM {source} GROUP BY state""", params).set_index('state')
+
+    for column in ['price', 'odometer', 'year']:
+        medians = query(db, medianQuery(column, ['state'], source), params).set_index('state')
+        totals[f'{column}_median'] = medians['median']
+
+    return(totals.sort_index())
+
+
+# Quartile k (1 to 3) of the ranked values of each group, interpolated between the two
+# nearest values like pandas does: position (n - 1) * k / 4, split into its whole part and
+# fraction with integer arithmetic, as medianQuery does
+
+def quartileSum(k):
+
+    step = f'(n - 1) * {k}'
+    low = f'(({step}) - ({step}) % 4) / 4'
+    fraction = f'(({step}) % 4) / 4.0'
+
+    return(f'SUM(CASE WHEN rn = {low} + 1 THEN value * (1 - {fraction}) WHEN rn = {low} + 2 THEN value * {fraction} ELSE 0 END)')
+
+
+# The groups of a box plot: area holds each listing's label (the qual value) and value, fenced
+# each label's quartiles and the bounds the whiskers reach to, 1.5 IQR from the box
+
+def boxSource(qual, quant, where):
+
+    return(f"""WITH area AS (SELECT {qual} AS label, {quant} AS value FROM listings
+                              {where} {'AND' if where else 'WHERE'} {qual} IS NOT NULL AND {quant} IS NOT NULL),
+              ranked AS (SELECT label, value, ROW_NUMBER() OVER (PARTITION BY label ORDER BY value) AS rn,
+                                COUNT(*) OVER (PARTITION BY label) AS n
+                         FROM area),
+              fenced AS (SELECT label, q1, med, q3, q1 - 1.5 * (q3 - q1) AS low, q3 + 1.5 * (q3 - q1) AS high
+                         FROM (SELECT label, {quartileSum(1)} AS q1, {quartileSum(2)} AS med, {quartileSum(3)} AS q3
+                               FROM ranked GROUP BY label) AS box)""")
+
+
+# What a box plot of quant by qual needs, like aggregates.boxStats but computed in the
+# database, so only a row per box and the sampled outliers come back
+# Returns a list of box summaries ordered by label, as charts.drawBoxSummaries takes them
+
+def boxSummaries(db, qual, quant, state = None, selections = None, maxFliers = aggregates.MAX_FLIERS):
+
+    if qual not in COLUMNS or quant not in COLUMNS:
+        raise ValueError(f'Unknown column {qual!r} or {quant!r}')
+
+    where, params = whereClause(state, selections)
+    source = boxSource(qual, quant, where)
+
+    box = query(db, f"""{source}
+                       SELECT fenced.label, q1, med, q3, MIN(area.value) AS whislo, MAX(area.value) AS whishi
+                       FROM fenced LEFT JOIN area ON area.label = fenced.label AND area.value BETWEEN low AND high
+                       GROUP BY fenced.label, q1, med, q3 ORDER BY fenced.label""", params)
+
+    #every step-th outlier of a box in order of value, step chosen to keep at most maxFliers
+    fliers = query(db, f"""{source}
+                          SELECT label, value FROM (
+                              SELECT area.label, area.value,
+                                     ROW_NUMBER() OVER (PARTITION BY area.label ORDER BY area.value) - 1 AS rk,
+                                     COUNT(*) OVER (PARTITION BY area.label) AS size
+                              FROM area JOIN fenced ON area.label = fenced.label
+                              WHERE area.value < low OR area.value > high) AS outside
+                          WHERE rk % CAST((size + {maxFliers} - 1 - (size + {maxFliers} - 1) % {maxFliers}) / {maxFliers} AS INTEGER) = 0
+                          ORDER BY label, value""", params)
+
+    fliers = fliers.groupby('label')['value'].agg(list)
+
+    return([{'label': row.label, 'q1': float(row.q1), 'med': float(row.med), 'q3': float(row.q3),
+             'whislo': float(row.whislo), 'whishi': float(row.whishi), 'fliers': [float(v) for v in fliers.get(row.label, [])]}
+            for row in box.itertuples(index = False)])
+
+
+# Grid cells of the map for a zoom level, like mapping.aggregateCells but grouped in the
+# database. floor() isn't portable, so cells are numbered by rounding the shifted
+# (always positive) coordinate down by half a cell instead
+
+def gridCells(db, size):
+
+    source = f"""(SELECT price, lat, lon,
+                         ROUND(lat / {size} + 100000 - 0.5) - 100000 AS cell_row,
+                         ROUND(lon / {size} + 100000 - 0.5) - 100000 AS cell_col
+                  FROM listings) AS cells"""
+
+    cells = query(db, f"""SELECT cell_row, cell_col, COUNT(*) AS count, AVG(lat) AS lat, AVG(lon) AS lon
+                          FROM {source} GROUP BY cell_row, cell_col""")
+
+    medians = query(db, medianQuery('price', ['cell_row', 'cell_col'], source)).rename(columns = {'median': 'median_price'})
+
+    return(cells.merge(medians, on = ['cell_row', 'cell_col']))
+
+
+# Listings inside (south, north, west, east) bounds
+
+def listingsInBounds(db, bounds, columns = None):
+
+    south, north, west, east = bounds
+    select = ', '.join(col for col in columns if col in COLUMNS or col in ('DTstr', 'date')) if columns else '*'
+
+    return(query(db, f'SELECT {select} FROM listings WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?',
+                 [south, north, west, east]))
+
+
+################################## CHECKING ##################################
+
+# Asks a frame (the pandas backend) and a database the same questions for every state:
+# counts and shares of each filter column, the statsByState numbers, a box plot and a
+# filtered selection, and returns a list describing every answer that differs (empty when they agree)
+
+def compareWithFrame(df, db, columns = INDEXED_COLUMNS[1:]):
+
+    problems = []
+    states = sorted(df['state'].astype(str).unique())
+
+    stats = stateStats(db, states)
+
+    for state in states:
+        area = df[df['state'] == state]
+
+        expected = {'count': len(area), 'price_mean': area['price'].mean(), 'price_median': area['price'].median(),
+                    'odometer_mean': area['odometer'].mean(), 'odometer_median': area['odometer'].median(),
+                    'year_min': area['year'].min(), 'year_max': area['year'].max(), 'year_median': area['year'].median()}
+
+        for name, value in expected.items():
+            if abs(float(stats.loc[state, name]) - float(value)) > 1e-6 * max(1, abs(float(value))):
+                problems.append(f'{state} {name}: sql {stats.loc[state, name]} pandas {value}')
+
+        for column in columns:
+            counts = area[column].astype(str).value_counts()
+            if facetCounts(db, column, state) != {value: int(counts[value]) for value in sorted(counts[counts > 0].index)}:
+                problems.append(f'{state} {column}: counts differ')
+
+        expected = aggregates.frameBoxSummaries(area, columns[0], 'price')
+        answered = boxSummaries(db, columns[0], 'price', state)
+
+        if [str(box['label']) for box in expected] != [box['label'] for box in answered]:
+            problems.append(f'{state} {columns[0]} box plot: labels differ')
+        elif any(abs(float(mine[stat]) - float(box[stat])) > 1e-6 * max(1, abs(float(box[stat])))
+                 or list(map(float, mine['fliers'])) != box['fliers']
+                 for mine, box in zip(expected, answered) for stat in ['q1', 'med', 'q3', 'whislo', 'whishi']):
+            problems.append(f'{state} {columns[0]} box plot: summaries differ')
+
+        first = {column: sorted(area[column].astype(str).unique())[:1] for column in columns[:2]}
+        mask = pd.Series(True, index = area.index)
+        for column, values in first.items():
+            mask &= area[column].astype(str).isin(values)
+
+        if len(listings(db, state, first, ['VIN'])) != int(mask.sum()):
+            problems.append(f'{state} {first}: selection sizes differ')
+
+    return(problems)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Craigslist listings for the Craigslist Used Cars app.
+
+Generates raw exports with the same 26 columns as the sample spreadsheet, at any size, so
+the app and the benchmarks can be run on realistic volumes. The shape follows the full
+Craigslist vehicles data rather than the sample: listings are skewed towards the big
+states and a handful of manufacturers, most cars are recent gas cars, dealers post many
+listings from the same coordinates, some cars are reposted under the same VIN, and a
+small share of rows has missing values for the cleaning to drop.
+
+The output only depends on the seed, the size and the chunk size, so a file can be
+regenerated exactly. Usage:
+
+    python synthetic.py 100k listings_100k.csv [--seed 0]
+
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import datastore
+
+
+SIZES = {'7k': 7000, '100k': 100000, '1m': 1000000, '10m': 10000000}
+
+#rows generated and written at a time
+CHUNK_SIZE = 250000
+
+#share of rows with one missing value, dropped by the cleaning
+MISSING = 0.02
+
+#share of listings posted from a dealer's lot (reused coordinates)
+DEALER_SHARE = 0.35
+
+#share of listings reposting a car listed earlier in the same chunk
+REPOST_SHARE = 0.04
+
+#state -> (share of the listings, latitude, longitude) of the full Craigslist data
+STATES = {
+    'ca': (.110, 36.8, -119.4), 'fl': (.066, 27.8, -81.7), 'tx': (.053, 31.0, -97.6), 'ny': (.046, 42.2, -74.9),
+    'oh': (.042, 40.4, -82.8), 'mi': (.040, 43.3, -84.5), 'nc': (.035, 35.6, -79.8), 'wa': (.033, 47.4, -121.5),
+    'pa': (.032, 40.6, -77.2), 'wi': (.027, 44.3, -89.6), 'or': (.025, 44.6, -122.1), 'tn': (.025, 35.7, -86.7),
+    'co': (.024, 39.1, -105.3), 'nj': (.022, 40.3, -74.5), 'va': (.021, 37.8, -78.2), 'il': (.021, 40.3, -89.0),
+    'ia': (.020, 42.0, -93.2), 'id': (.020, 44.2, -114.5), 'mn': (.019, 45.7, -93.9), 'ma': (.018, 42.2, -71.5),
+    'az': (.018, 33.7, -111.4), 'sc': (.016, 33.9, -80.9), 'mt': (.016, 46.9, -110.5), 'ga': (.015, 33.0, -83.6),
+    'ks': (.014, 38.5, -96.7), 'ok': (.014, 35.6, -96.9), 'in': (.013, 39.8, -86.3), 'al': (.013, 32.8, -86.8),
+    'ky': (.012, 37.7, -84.7), 'ct': (.011, 41.6, -72.8), 'mo': (.011, 38.5, -92.3), 'md': (.010, 39.1, -76.8),
+    'ar': (.009, 35.0, -92.4), 'nm': (.009, 34.8, -106.2), 'la': (.008, 31.2, -91.9), 'nv': (.008, 38.3, -117.1),
+    'ak': (.007, 61.4, -152.3), 'nh': (.007, 43.5, -71.6), 'vt': (.006, 44.0, -72.7), 'ri': (.006, 41.7, -71.5),
+    'dc': (.006, 38.9, -77.0), 'me': (.006, 44.7, -69.4), 'ne': (.005, 41.1, -98.3), 'hi': (.005, 21.1, -157.5),
+    'ut': (.004, 40.2, -111.9), 'ms': (.004, 32.7, -89.7), 'sd': (.003, 44.3, -99.4), 'wv': (.003, 38.5, -81.0),
+    'de': (.002, 39.3, -75.5), 'wy': (.002, 42.8, -107.3), 'nd': (.001, 47.5, -99.8),
+}
+
+#manufacturer -> share of the listings, the rest are spread evenly over the others
+MANUFACTURERS = {
+    'ford': .17, 'chevrolet': .13, 'toyota': .08, 'honda': .05, 'jeep': .045, 'nissan': .045, 'ram': .043,
+    'gmc': .04, 'bmw': .035, 'dodge': .032, 'mercedes-benz': .028, 'hyundai': .024, 'subaru': .022,
+    'volkswagen': .022, 'kia': .02, 'lexus': .019, 'audi': .018, 'cadillac': .016, 'chrysler': .014,
+    'acura': .014, 'buick': .013, 'mazda': .013, 'infiniti': .011, 'lincoln': .01, 'volvo': .008,
+    'mitsubishi': .008, 'mini': .006, 'pontiac': .005, 'rover': .005, 'jaguar': .004, 'porsche': .003,
+    'mercury': .003, 'saturn': .003, 'alfa-romeo': .002, 'tesla': .002, 'fiat': .002,
+}
+
+#best selling models of the biggest manufacturers, the others get numbered models
+MODELS = {
+    'ford': ['f-150', 'escape', 'explorer', 'mustang', 'focus', 'fusion', 'f-250 super duty', 'edge', 'ranger'],
+    'chevrolet': ['silverado 1500', 'malibu', 'equinox', 'tahoe', 'impala', 'camaro', 'cruze', 'colorado'],
+    'toyota': ['camry', 'tacoma', 'corolla', 'rav4', 'prius', '4runner', 'tundra', 'highlander'],
+    'honda': ['civic', 'accord', 'cr-v', 'odyssey', 'pilot', 'fit'],
+    'jeep': ['wrangler', 'grand cherokee', 'cherokee', 'liberty', 'compass'],
+    'nissan': ['altima', 'rogue', 'sentra', 'frontier', 'maxima', 'pathfinder'],
+    'ram': ['1500', '2500', '3500', 'promaster'],
+}
+
+#column -> {value: share} of the full data
+CATEGORIES = {
+    'condition': {'good': .48, 'excellent': .41, 'like new': .08, 'fair': .025, 'new': .003, 'salvage': .002},
+    'cylinders': {'6 cylinders': .36, '4 cylinders': .33, '8 cylinders': .28, '5 cylinders': .01,
+                  '10 cylinders': .01, 'other': .005, '3 cylinders': .003, '12 cylinders': .002},
+    'fuel': {'gas': .84, 'other': .07, 'diesel': .07, 'hybrid': .014, 'electric': .006},
+    'title_status': {'clean': .97, 'rebuilt': .017, 'salvage': .009, 'lien': .003, 'missing': .001},
+    'transmission': {'automatic': .80, 'other': .15, 'manual': .05},
+    'drive': {'4wd': .45, 'fwd': .36, 'rwd': .19},
+    'size': {'full-size': .53, 'mid-size': .28, 'compact': .17, 'sub-compact': .02},
+    'category': {'sedan': .21, 'SUV': .20, 'pickup': .13, 'truck': .10, 'other': .08, 'coupe': .06,
+                 'hatchback': .05, 'wagon': .05, 'van': .04, 'convertible': .03, 'mini-van': .03,
+                 'offroad': .01, 'bus': .01},
+    'paint_color': {'white': .25, 'black': .22, 'silver': .14, 'blue': .10, 'red': .10, 'grey': .09,
+                    'green': .03, 'brown': .02, 'custom': .02, 'yellow': .01, 'orange': .01, 'purple': .01},
+}
+
+#Craigslist regions per state grow with its share of the listings
+REGIONS_PER_SHARE = 150
+
+#dealer lots per region
+DEALERS_PER_REGION = 20
+
+VIN_CHARS = np.frombuffer(b'ABCDEFGHJKLMNPRSTUVWXYZ0123456789', dtype = np.uint8)
+
+FIRST_POST = pd.Timestamp('2021-04-04')
+POSTING_DAYS = 31
+
+
+################################## GEOGRAPHY ##################################
+
+# Builds the regions of every state, each with a center near the state's and its dealer
+# lots, from a generator of its own so the geography is the same for every chunk
+# Returns a frame with one row per region: state, region, share, lat, lon, dealer lats/lons
+
+def buildRegions(seed = 0):
+
+    rng = np.random.default_rng([seed, 0])
+    rows = []
+
+    for state, (share, lat, lon) in STATES.items():
+        count = max(1, int(round(share * REGIONS_PER_SHARE)))
+        weights = rng.dirichlet(np.ones(count))
+
+        for k in range(count):
+            centerLat = lat + rng.normal(0, 1)
+            centerLon = lon + rng.normal(0, 1.3)
+
+            rows.append({'state': state, 'region': f'{state} area {k + 1}' if count > 1 else f'{state} statewide',
+                         'share': share * weights[k], 'lat': centerLat, 'lon': centerLon,
+                         'dealer_lat': np.round(centerLat + rng.normal(0, .2, DEALERS_PER_REGION), 4),
+                         'dealer_lon': np.round(centerLon + rng.normal(0, .2, DEALERS_PER_REGION), 4)})
+
+    regions = pd.DataFrame(rows)
+    regions['share'] = regions['share'] / regions['share'].sum()
+
+    return(regions)
+
+
+# UTC offset of each listing's posting time, from its longitude (Alaska and Hawaii apart)
+
+def utcOffsets(states, lon):
+
+    offsets = np.select([lon > -87, lon > -101, lon > -115], ['-0400', '-0500', '-0600'], '-0700').astype(object)
+    offsets[states == 'ak'] = '-0800'
+    offsets[states == 'hi'] = '-1000'
+
+    return(offsets)
+
+
+################################## GENERATING ##################################
+
+def choose(rng, shares, n):
+
+    values = list(shares)
+    p = np.array([shares[value] for value in values], dtype = 'float64')
+
+    return(np.array(values, dtype = object)[rng.choice(len(values), n, p = p / p.sum())])
+
+
+def chooseModels(rng, manufacturers):
+
+    models = np.empty(len(manufacturers), dtype = object)
+
+    for make in np.unique(manufacturers):
+        rows = np.flatnonzero(manufacturers == make)
+        names = MODELS.get(make, [f'{make} model {k}' for k in range(1, 6)])
+
+        #model popularity falls off like 1/rank
+        weights = 1 / np.arange(1, len(names) + 1)
+        models[rows] = np.array(names, dtype = object)[rng.choice(len(names), len(rows), p = weights / weights.sum())]
+
+    return(models)
+
+
+# 17 random VIN characters per row, built as one byte array and split into strings
+
+def randomVins(rng, n):
+
+    chars = VIN_CHARS[rng.integers(0, len(VIN_CHARS), (n, 17))]
+
+    return(np.ascontiguousarray(chars).view('S17').ravel().astype(str).astype(object))
+
+
+# Generates n raw listings, numbered from start, in the layout of the sample spreadsheet
+# (datastore.SOURCE_COLUMNS). Chunks generated with the same seed and different starts
+# fit together into one export
+
+def generateListings(n, seed = 0, start = 0, regions = None):
+
+    if regions is None:
+        regions = buildRegions(seed)
+
+    rng = np.random.default_rng([seed, 1, start])
+
+    where = regions.iloc[rng.choice(len(regions), n, p = regions['share'].to_numpy())].reset_index(drop = True)
+
+    #dealers post from a few fixed spots per region, private sellers from anywhere around it
+    dealer = rng.random(n) < DEALER_SHARE
+    lot = rng.integers(0, DEALERS_PER_REGION, n)
+
+    lat = np.round(where['lat'].to_numpy() + rng.normal(0, .35, n), 4)
+    lon = np.round(where['lon'].to_numpy() + rng.normal(0, .45, n), 4)
+    lat[dealer] = [lats[k] for lats, k in zip(where['dealer_lat'][dealer], lot[dealer])]
+    lon[dealer] = [lons[k] for lons, k in zip(where['dealer_lon'][dealer], lot[dealer])]
+
+    age = np.minimum(rng.gamma(2, 4, n), 70).astype(int)
+    year = 2021 - age
+    odometer = np.round(np.maximum(age, .3) * 12000 * rng.lognormal(0, .35, n), -2)
+    price = np.round(rng.lognormal(9.9, .7, n) * np.exp(-age / 25), -1).astype(np.int64)
+
+    manufacturer = choose(rng, MANUFACTURERS, n)
+
+    #numpy prints second-resolution datetimes as 2021-04-04T10:10:51 far quicker than strftime
+    posted = np.datetime64(FIRST_POST, 's') + rng.integers(0, POSTING_DAYS * 86400, n).astype('timedelta64[s]')
+    offsets = utcOffsets(where['state'].to_numpy(), lon)
+    numbers = pd.Series(np.arange(start, start + n)).astype(str)
+
+    df = pd.DataFrame({
+        'Unnamed: 0': np.arange(start, start + n),
+        'id': 7300000000 + start * 7 + np.arange(n) * 7,
+        'url': 'https://example.craigslist.org/cto/d/' + numbers + '.html',
+        'region': where['region'],
+        'region_url': 'https://' + where['region'].str.replace(' ', '') + '.craigslist.org',
+        'price': price,
+        'year': year.astype('float64'),
+        'manufacturer': manufacturer,
+        'model': chooseModels(rng, manufacturer),
+        'condition': choose(rng, CATEGORIES['condition'], n),
+        'cylinders': choose(rng, CATEGORIES['cylinders'], n),
+        'fuel': choose(rng, CATEGORIES['fuel'], n),
+        'odometer': odometer,
+        'title_status': choose(rng, CATEGORIES['title_status'], n),
+        'transmission': choose(rng, CATEGORIES['transmission'], n),
+        'VIN': randomVins(rng, n),
+        'drive': choose(rng, CATEGORIES['drive'], n),
+        'size': choose(rng, CATEGORIES['size'], n),
+        'category': choose(rng, CATEGORIES['category'], n),
+        'paint_color': choose(rng, CATEGORIES['paint_color'], n),
+        'image_url': '',
+        'description': '',
+        'state': where['state'],
+        'lat': lat,
+        'lon': lon,
+        'posting_date': posted.astype(str).astype(object) + offsets,
+    })
+
+    #reposts: the same car (VIN, make, model, year) listed again by the same seller
+    repost = np.flatnonzero(rng.random(n) < REPOST_SHARE)
+    original = rng.integers(0, n, len(repost))
+    for col in ['VIN', 'manufacturer', 'model', 'year', 'region', 'state', 'lat', 'lon']:
+        df.loc[repost, col] = df[col].to_numpy()[original]
+
+    #missing values in the columns the real data most often leaves empty
+    missing = np.flatnonzero(rng.random(n) < MISSING)
+    columns = np.array(['condition', 'cylinders', 'drive', 'size', 'paint_color', 'VIN'])[rng.integers(0, 6, len(missing))]
+    for col in np.unique(columns):
+        df.loc[missing[columns == col], col] = None
+
+    return(df[datastore.SOURCE_COLUMNS])
+
+
+# Writes a synthetic export of n listings to a CSV file, one chunk at a time so a 10M row
+# file never has to fit in memory. Returns the path
+
+def writeListings(path, n, seed = 0, chunksize = CHUNK_SIZE):
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+
+    regions = buildRegions(seed)
+    tmp = path + '.tmp'
+
+    for start in range(0, n, chunksize):
+        chunk = generateListings(min(chunksize, n - start), seed, start, regions)
+        chunk.to_csv(tmp, mode = 'w' if start == 0 else 'a', header = start == 0, index = False)
+
+    os.replace(tmp, path)
+
+    return(path)
+
+
+def parseSize(size):
+
+    return(SIZES.get(str(size).lower()) or int(size))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Writes a synthetic Craigslist export as CSV')
+    parser.add_argument('size', help = 'number of rows or one of ' + ', '.join(SIZES))
+    parser.add_argument('path')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    writeListings(args.path, parseSize(args.size), args.seed)
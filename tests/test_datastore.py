@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the pandas backend's delta upserts: deltas of new postings only, deltas mixing new
+and stored VINs, splicing the new rows into the prepared frame and updating what was built
+from it, and replaying the stored deltas when the process starts again. Also checks that
+a new version of a source only clears that source's caches, and that the parts of a dataset
+are built independently of each other.
+
+"""
+
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+import aggregates
+import core
+import datastore
+import filters
+import synthetic
+
+
+ROWS = 2000
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(datastore, 'DATASETS', {})
+
+    path = tmp_path / 'listings.csv'
+    synthetic.generateListings(ROWS, seed = 3).to_csv(path, index = False)
+
+    return(str(path))
+
+
+def writeDelta(path, df):
+
+    df.to_csv(path, index = False)
+
+    return(str(path))
+
+
+# New postings only, none of their VINs is stored yet
+
+@pytest.fixture
+def insertDelta(source, tmp_path):
+
+    return(writeDelta(tmp_path / 'insert.csv', synthetic.generateListings(100, seed = 11)))
+
+
+# Re-posts of stored cars older than what is stored (which lose) and new postings, so every
+# stored winner is a new VIN
+
+@pytest.fixture
+def mixedDelta(source, tmp_path):
+
+    older = pd.read_csv(source).dropna(subset = ['VIN']).iloc[:50].copy()
+    older['posting_date'] = '2020-01-01T12:00:00-0700'
+
+    return(writeDelta(tmp_path / 'mixed.csv', pd.concat([older, synthetic.generateListings(100, seed = 12)], ignore_index = True)))
+
+
+def expectedRows(source, deltaFile):
+
+    df = datastore.ingestFile(source)
+    stale, winners = datastore.upsertRows(df, datastore.readDelta(deltaFile))
+
+    return(len(df) - int(stale.sum()) + len(winners), winners)
+
+
+def test_insert_only_delta(source, insertDelta):
+
+    rows, winners = expectedRows(source, insertDelta)
+    assert len(winners) > 0
+
+    dataset = datastore.applyDelta(source, insertDelta, core.prepareData, core.DELTA_UPDATERS)
+
+    assert len(dataset['df']) == rows
+    assert set(winners['VIN']) <= set(dataset['df']['VIN'].astype(str))
+
+
+@pytest.mark.parametrize('delta', ['insertDelta', 'mixedDelta'])
+def test_replay_after_restart(source, delta, request, monkeypatch):
+
+    deltaFile = request.getfixturevalue(delta)
+    rows, _ = expectedRows(source, deltaFile)
+
+    applied = datastore.applyDelta(source, deltaFile, core.prepareData, core.DELTA_UPDATERS)
+
+    #a new process: nothing loaded, the stored deltas are replayed from the cache
+    monkeypatch.setattr(datastore, 'DATASETS', {})
+    reloaded = datastore.getDataset(source, core.prepareData)
+
+    assert len(reloaded['df']) == rows
+    assert reloaded['version'] == applied['version']
+    assert sorted(reloaded['df']['VIN'].astype(str)) == sorted(applied['df']['VIN'].astype(str))
+
+
+@pytest.mark.parametrize('delta', ['insertDelta', 'mixedDelta'])
+def test_spliced_delta_matches_full_build(source, delta, request):
+
+    deltaFile = request.getfixturevalue(delta)
+
+    dataset = core.loadDataset(source)
+    for part in [core.partitions, core.facets, core.cube]:
+        part(dataset)
+
+    old = dataset['df']
+    stale, winners = datastore.upsertRows(old, datastore.readDelta(deltaFile))
+    prepared = core.prepareData(pd.concat([old.loc[~stale, list(winners.columns)], winners], ignore_index = True))
+
+    spliced = datastore.applyDelta(source, deltaFile, core.prepareData, core.DELTA_UPDATERS, splice = core.spliceRows)
+    df = spliced['df']
+
+    #the offsets of repeated coordinates only have to keep them apart
+    columns = [col for col in prepared.columns if col not in ('lat2', 'lon2')]
+    pd.testing.assert_frame_equal(df[columns], prepared[columns], check_categorical = False)
+    assert not df.duplicated(['lat2', 'lon2']).any()
+
+    assert spliced['parts']['partitions'] == filters.buildPartitions(df)
+    assert spliced['parts']['facets'] == filters.buildFacets(df, core.FILTER_COLUMNS)
+    assert repr(sorted(spliced['parts']['cube']['cells'].items())) == repr(sorted(aggregates.buildCube(df)['cells'].items()))
+
+
+def test_new_version_keeps_other_sources_caches(source, insertDelta, tmp_path):
+
+    #a second source whose name starts with the first one's
+    other = str(tmp_path / 'listings-2020.csv')
+    synthetic.generateListings(100, seed = 5).to_csv(other, index = False)
+
+    datastore.loadListings(other)
+    datastore.applyDelta(other, insertDelta, core.prepareData)
+    datastore.loadListings(source)
+
+    kept = {name for name in os.listdir(datastore.CACHE_DIR) if name.startswith('listings-2020-')}
+    stale = os.path.basename(datastore.cachePath(source, datastore.sourceKey(source)))
+
+    synthetic.generateListings(200, seed = 6).to_csv(source, index = False)
+    datastore.loadListings(source)
+
+    names = set(os.listdir(datastore.CACHE_DIR))
+
+    assert len(kept) == 2 and kept <= names
+    assert stale not in names
+    assert os.path.basename(datastore.cachePath(source, datastore.sourceKey(source))) in names
+
+
+def test_parts_build_independently():
+
+    dataset = datastore.datasetHandle('listings.csv', 'v', pd.DataFrame())
+    started, release = threading.Event(), threading.Event()
+
+    def slow(df):
+        started.set()
+        release.wait(5)
+        return('slow')
+
+    worker = threading.Thread(target = datastore.datasetPart, args = (dataset, 'slow', slow))
+    worker.start()
+    started.wait(5)
+
+    #another part doesn't wait for the slow build
+    assert datastore.datasetPart(dataset, 'fast', lambda df: 'fast') == 'fast'
+    assert worker.is_alive()
+
+    release.set()
+    worker.join(5)
+
+    assert datastore.datasetPart(dataset, 'slow', lambda df: 'again') == 'slow'
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the sql backend answers like the pandas one, on both engines, for a synthetic
+export and after a delta file is upserted into it, and that it refuses column names it
+doesn't know.
+
+"""
+
+import pandas as pd
+import pytest
+
+import datastore
+import sqlbackend
+import synthetic
+
+
+ROWS = 3000
+
+ENGINES = [pytest.param('duckdb', marks = pytest.mark.skipif(sqlbackend.duckdb is None, reason = 'duckdb not installed')),
+           'sqlite']
+
+
+@pytest.fixture(scope = 'module')
+def source(tmp_path_factory):
+
+    path = tmp_path_factory.mktemp('source') / 'listings.csv'
+    synthetic.generateListings(ROWS, seed = 3).to_csv(path, index = False)
+
+    return(str(path))
+
+
+# A delta with new postings, newer postings of stored cars (which win) and older ones
+# (which don't)
+
+@pytest.fixture(scope = 'module')
+def deltaFile(source, tmp_path_factory):
+
+    base = pd.read_csv(source)
+    base = base[base['VIN'].notna()]
+
+    newer = base.iloc[:200].copy()
+    newer['price'] += 500
+    newer['posting_date'] = '2021-06-01T12:00:00-0700'
+
+    older = base.iloc[200:300].copy()
+    older['price'] = 1
+    older['posting_date'] = '2020-01-01T12:00:00-0700'
+
+    fresh = synthetic.generateListings(300, seed = 4)
+
+    path = tmp_path_factory.mktemp('updates') / 'delta.csv'
+    pd.concat([newer, older, fresh], ignore_index = True).to_csv(path, index = False)
+
+    return(str(path))
+
+
+@pytest.fixture(params = ENGINES)
+def db(request, source, tmp_path):
+
+    return(sqlbackend.openListings(source, request.param, str(tmp_path)))
+
+
+def test_store_matches_frame(db, source):
+
+    assert sqlbackend.compareWithFrame(datastore.ingestFile(source), db) == []
+
+
+def test_upsert_matches_frame(db, source, deltaFile):
+
+    df = datastore.ingestFile(source)
+    stale, winners = datastore.upsertRows(df, datastore.readDelta(deltaFile))
+    expected = pd.concat([df[~stale], winners], ignore_index = True)
+
+    sqlbackend.upsertFile(db, deltaFile)
+
+    assert len(sqlbackend.listings(db, columns = ['VIN'])) == len(expected)
+    assert sqlbackend.compareWithFrame(expected, db) == []
+
+
+def test_upsert_is_applied_once(db, deltaFile):
+
+    sqlbackend.upsertFile(db, deltaFile)
+    count = len(sqlbackend.listings(db, columns = ['VIN']))
+
+    sqlbackend.upsertFile(db, deltaFile)
+
+    assert len(sqlbackend.listings(db, columns = ['VIN'])) == count
+
+
+def test_mean_position_matches_frame(db, source):
+
+    df = datastore.ingestFile(source)
+    state = df['state'].iloc[0]
+
+    lat, lon = sqlbackend.meanPosition(db, state)
+
+    assert lat == pytest.approx(df.loc[df['state'] == state, 'lat'].mean())
+    assert lon == pytest.approx(df.loc[df['state'] == state, 'lon'].mean())
+
+
+def test_unknown_column_is_refused(db):
+
+    with pytest.raises(ValueError):
+        sqlbackend.facetCounts(db, 'state FROM listings; DROP TABLE listings; --')
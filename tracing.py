@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Timing spans and counters for the Craigslist Used Cars app.
+
+Every rerun of the page collects a trace: a list of timed spans (loading, filtering, the
+map, each chart, each Wikipedia fetch) and counters such as rows processed and bytes sent
+to the browser. The trace of the current rerun is kept per thread, since Streamlit runs
+each session's script on its own thread; spans recorded on other threads (e.g. the cache
+warming pool) go to a background trace. The most recent traces are kept in memory and can
+be written out in Chrome's trace event format, to be opened in chrome://tracing or Perfetto.
+
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+#traces of the last reruns of this process kept for export
+MAX_TRACES = 50
+
+#spans kept per trace, later ones are dropped (the background trace lives as long as the process)
+MAX_SPANS = 10000
+
+TRACE_DIR = os.path.join('.listings_cache', 'traces')
+
+CURRENT = threading.local()
+
+RECENT = deque(maxlen = MAX_TRACES)
+RECENT_LOCK = threading.Lock()
+
+
+################################## TRACES ##################################
+
+# Time in seconds for record, from a clock that only goes forward
+
+def clock():
+
+    return(time.perf_counter())
+
+
+def newTrace(name):
+
+    return({'name': name, 'start': clock(), 'wall': time.time(), 'spans': [], 'counters': {},
+            'lock': threading.Lock()})
+
+
+BACKGROUND = newTrace('background')
+
+
+# Starts the trace of this thread's rerun and keeps it with the recent ones
+
+def startTrace(name):
+
+    trace = newTrace(name)
+    CURRENT.trace = trace
+
+    with RECENT_LOCK:
+        RECENT.append(trace)
+
+    return(trace)
+
+
+def currentTrace():
+
+    return(getattr(CURRENT, 'trace', None) or BACKGROUND)
+
+
+def elapsedMs(trace):
+
+    return((clock() - trace['start']) * 1000)
+
+
+# Adds a span that started and ended at the given clock() times
+
+def record(name, start, end, **args):
+
+    trace = currentTrace()
+
+    with trace['lock']:
+        if len(trace['spans']) >= MAX_SPANS:
+            return
+        trace['spans'].append({'name': name, 'start': start, 'end': end,
+                               'thread': threading.get_ident(), 'args': args})
+
+
+# Times the block inside it as one span
+
+@contextmanager
+def span(name, **args):
+
+    start = clock()
+    try:
+        yield(args)
+    finally:
+        record(name, start, clock(), **args)
+
+
+# Decorator timing every call of a function as a span, with the rows of the result when
+# it returns a frame
+
+def traced(name):
+
+    def decorate(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name) as spanArgs:
+                result = function(*args, **kwargs)
+                if isinstance(result, pd.DataFrame):
+                    spanArgs['rows'] = len(result)
+                return(result)
+
+        return(wrapper)
+
+    return(decorate)
+
+
+def count(name, n = 1):
+
+    trace = currentTrace()
+
+    with trace['lock']:
+        trace['counters'][name] = trace['counters'].get(name, 0) + n
+
+
+################################## REPORTS ##################################
+
+# Per-stage breakdown of a trace: calls, total and slowest time in milliseconds
+# Returns a frame ordered by total time
+
+def breakdown(trace):
+
+    with trace['lock']:
+        spans = list(trace['spans'])
+
+    if not spans:
+        return(pd.DataFrame(columns = ['calls', 'total ms', 'max ms', 'rows']))
+
+    table = pd.DataFrame({'stage': [s['name'] for s in spans],
+                          'ms': [(s['end'] - s['start']) * 1000 for s in spans],
+                          'rows': [s['args'].get('rows', 0) for s in spans]})
+
+    stages = table.groupby('stage').agg(calls = ('ms', 'size'), total = ('ms', 'sum'), slowest = ('ms', 'max'), rows = ('rows', 'sum'))
+    stages = stages.rename(columns = {'total': 'total ms', 'slowest': 'max ms'}).round(1)
+
+    return(stages.sort_values('total ms', ascending = False))
+
+
+# Turns traces into Chrome's trace event format: a complete event ('X') per span and a
+# counter event ('C') per trace, timestamps in microseconds since the first trace began
+
+def chromeTrace(traces):
+
+    traces = list(traces)
+    origin = min((trace['start'] for trace in traces), default = 0)
+    pid = os.getpid()
+
+    events = []
+
+    for trace in traces:
+        with trace['lock']:
+            spans = list(trace['spans'])
+            counters = dict(trace['counters'])
+
+        for s in spans:
+            events.append({'name': s['name'], 'cat': trace['name'], 'ph': 'X', 'pid': pid, 'tid': s['thread'],
+                           'ts': (s['start'] - origin) * 1e6, 'dur': (s['end'] - s['start']) * 1e6,
+                           'args': s['args']})
+
+        if counters:
+            end = max((s['end'] for s in spans), default = trace['start'])
+            events.append({'name': 'counters', 'cat': trace['name'], 'ph': 'C', 'pid': pid,
+                           'ts': (end - origin) * 1e6, 'args': counters})
+
+    return({'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+
+# Writes the recent traces (and the background one) to a Chrome trace JSON file
+# Returns its path
+
+def exportTraces(folder = TRACE_DIR):
+
+    with RECENT_LOCK:
+        traces = [BACKGROUND] + list(RECENT)
+
+    os.makedirs(folder, exist_ok = True)
+    path = os.path.join(folder, time.strftime('trace-%Y%m%d-%H%M%S.json'))
+
+    with open(path, 'w', encoding = 'utf-8') as f:
+        json.dump(chromeTrace(traces), f, default = str)
+
+    return(path)
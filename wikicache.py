@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Wikipedia summary cache for the Craigslist Used Cars app.
+
+Summaries are kept in a JSON file on disk. warmCache fetches every summary the page can
+show concurrently and refreshes entries older than the TTL, normally on a background
+thread started by warmInBackground; getSummary only ever reads the cache, so a rerun never
+waits on the network. When Wikipedia can't be reached (offline, a title that is ambiguous,
+...) the stored text is served even if it is stale, or OFFLINE_TEXT when there is none, and
+the failure is recorded so the title is only tried again after RETRY_TTL.
+
+The summaries come from `source`, the wikipedia module by default, so any object with a
+summary(title, sentences = n) function can stand in for it, e.g. a local stub in tests.
+
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+
+WIKI_CACHE_FILE = os.path.join('.listings_cache', 'wikipedia.json')
+
+#summaries older than this are fetched again when the cache is warmed
+TTL = 7 * 24 * 60 * 60
+
+#titles whose fetch failed are tried again after this long
+RETRY_TTL = 15 * 60
+
+OFFLINE_TEXT = 'No summary is available right now.'
+
+
+def cacheKey(title, sentences):
+
+    return(f'{title}|{sentences}')
+
+
+################################## DISK ##################################
+
+# A cache is a dictionary with its entries (cache key -> text, when it was fetched and when
+# a fetch last failed), the file they are kept in and a lock; sessions read the entries
+# while a warming thread updates and saves them
+
+def newCache(path = WIKI_CACHE_FILE):
+
+    return({'entries': readCache(path), 'path': path, 'lock': threading.Lock(), 'warming': False})
+
+
+def readCache(path = WIKI_CACHE_FILE):
+
+    try:
+        with open(path, encoding = 'utf-8') as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return({})
+
+
+# Writes to a temporary file and renames it into place so the file is never half written
+# warmCache calls it holding the cache's lock, so the entries don't change while saved
+
+def writeCache(entries, path = WIKI_CACHE_FILE):
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding = 'utf-8') as f:
+        json.dump(entries, f)
+
+    os.replace(tmp, path)
+
+
+################################## FETCHING ##################################
+
+def fetchSummary(title, sentences, source = None):
+
+    if source is None:
+        import wikipedia as source
+
+    with tracing.span('wikipedia.summary', title = title):
+        return(source.summary(title, sentences = sentences))
+
+
+# Whether an entry has to be fetched: it is missing, or older than ttl and didn't fail in
+# the last retry seconds
+
+def isDue(entry, now, ttl = TTL, retry = RETRY_TTL):
+
+    if entry is None:
+        return(True)
+
+    if now - entry.get('failed', float('-inf')) < retry:
+        return(False)
+
+    return(now - entry['fetched'] >= ttl)
+
+
+def dueTitles(cache, wanted, ttl = TTL, retry = RETRY_TTL):
+
+    now = time.time()
+
+    with cache['lock']:
+        return([(title, sentences) for title, sentences in wanted
+                if isDue(cache['entries'].get(cacheKey(title, sentences)), now, ttl, retry)])
+
+
+# Fetches the (title, sentences) pairs of wanted that are due concurrently, and saves the
+# cache once at the end
+# A fetch that fails keeps whatever text was stored before (OFFLINE_TEXT when none) and
+# records when it failed
+# Returns the cache
+
+def warmCache(cache, wanted, ttl = TTL, retry = RETRY_TTL, source = None, workers = 8):
+
+    todo = dueTitles(cache, wanted, ttl, retry)
+
+    def fetch(item):
+        try:
+            return(item, fetchSummary(item[0], item[1], source))
+        except Exception:
+            return(item, None)
+
+    if todo:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(fetch, todo))
+
+        now = time.time()
+
+        with cache['lock']:
+            entries = cache['entries']
+
+            for (title, sentences), text in results:
+                key = cacheKey(title, sentences)
+
+                if text is not None:
+                    entries[key] = {'text': text, 'fetched': now}
+                else:
+                    old = entries.get(key, {'text': OFFLINE_TEXT, 'fetched': 0})
+                    entries[key] = {'text': old['text'], 'fetched': old['fetched'], 'failed': now}
+
+            writeCache(entries, cache['path'])
+
+    return(cache)
+
+
+# Warms the cache on a background thread when some of wanted is due and no warming is
+# running already, so the rerun calling it doesn't wait
+# Returns the thread, None when nothing was started
+
+def warmInBackground(cache, wanted, ttl = TTL, retry = RETRY_TTL, source = None):
+
+    if not dueTitles(cache, wanted, ttl, retry):
+        return(None)
+
+    with cache['lock']:
+        if cache['warming']:
+            return(None)
+        cache['warming'] = True
+
+    def warm():
+        try:
+            warmCache(cache, wanted, ttl, retry, source)
+        finally:
+            with cache['lock']:
+                cache['warming'] = False
+
+    thread = threading.Thread(target = warm, name = 'wikipedia-warm', daemon = True)
+    thread.start()
+
+    return(thread)
+
+
+# Returns the summary for a title from the cache, whatever its age, or OFFLINE_TEXT when
+# it was never fetched; never touches the network
+
+def getSummary(cache, title, sentences):
+
+    with cache['lock']:
+        entry = cache['entries'].get(cacheKey(title, sentences))
+
+    return(OFFLINE_TEXT if entry is None else entry['text'])